@@ -70,19 +70,43 @@ def func_attention(query, context, gamma1):
 
 
 class GlobalAttentionGeneral(nn.Module):
-    def __init__(self, idf, cdf):
+    def __init__(self, idf, cdf, chunk_size=0):
         super(GlobalAttentionGeneral, self).__init__()
         self.conv_context = conv1x1(cdf, idf)
-        self.sm = nn.Softmax(dim=1)
+        self.sm = nn.Softmax(dim=2)
         self.mask = None
+        # number of query positions attended at once, 0 for all of them
+        self.chunk_size = chunk_size
 
     def applyMask(self, mask):
         self.mask = mask  # batch x sourceL
 
-    def forward(self, input, context):
+    def attend(self, targetT, sourceT, mask):
+        """
+            targetT: batch x chunk x idf
+            sourceT: batch x idf x sourceL
+            mask: batch x 1 x sourceL
+        """
+        # (batch x chunk x idf)(batch x idf x sourceL)
+        # -->batch x chunk x sourceL
+        attn = torch.bmm(targetT, sourceT)
+        if mask is not None:
+            attn = attn.masked_fill(mask, -float('inf'))
+        attn = self.sm(attn)  # Eq. (2)
+        # --> batch x sourceL x chunk
+        attn = torch.transpose(attn, 1, 2)
+
+        # (batch x idf x sourceL)(batch x sourceL x chunk)
+        # --> batch x idf x chunk
+        weightedContext = torch.bmm(sourceT, attn)
+        return weightedContext, attn
+
+    def forward(self, input, context, return_att=True):
         """
             input: batch x idf x ih x iw (queryL=ihxiw)
             context: batch x cdf x sourceL
+            return_att: False returns None for the attention map, which
+                is then freed as soon as the context is computed
         """
         ih, iw = input.size(2), input.size(3)
         queryL = ih * iw
@@ -90,32 +114,37 @@ class GlobalAttentionGeneral(nn.Module):
 
         # --> batch x queryL x idf
         target = input.view(batch_size, -1, queryL)
-        targetT = torch.transpose(target, 1, 2).contiguous()
+        targetT = torch.transpose(target, 1, 2)
         # batch x cdf x sourceL --> batch x cdf x sourceL x 1
         sourceT = context.unsqueeze(3)
         # --> batch x idf x sourceL
         sourceT = self.conv_context(sourceT).squeeze(3)
 
-        # Get attention
-        # (batch x queryL x idf)(batch x idf x sourceL)
-        # -->batch x queryL x sourceL
-        attn = torch.bmm(targetT, sourceT)
-        # --> batch*queryL x sourceL
-        attn = attn.view(batch_size*queryL, sourceL)
+        mask = None
         if self.mask is not None:
-            # batch_size x sourceL --> batch_size*queryL x sourceL
-            mask = self.mask.repeat(queryL, 1)
-            attn.data.masked_fill_(mask.data, -float('inf'))
-        attn = self.sm(attn)  # Eq. (2)
-        # --> batch x queryL x sourceL
-        attn = attn.view(batch_size, queryL, sourceL)
-        # --> batch x sourceL x queryL
-        attn = torch.transpose(attn, 1, 2).contiguous()
-
-        # (batch x idf x sourceL)(batch x sourceL x queryL)
-        # --> batch x idf x queryL
-        weightedContext = torch.bmm(sourceT, attn)
-        weightedContext = weightedContext.view(batch_size, -1, ih, iw)
-        attn = attn.view(batch_size, -1, ih, iw)
+            # batch_size x sourceL --> batch_size x 1 x sourceL,
+            # broadcast over the query positions
+            mask = self.mask.unsqueeze(1)
+
+        chunk = self.chunk_size
+        if chunk <= 0 or chunk >= queryL:
+            weightedContext, attn = self.attend(targetT, sourceT, mask)
+        else:
+            # attend over query tiles so only batch x chunk x sourceL
+            # scores are alive at once, writing each tile into the output
+            weightedContext = input.new_empty(batch_size, sourceT.size(1), queryL)
+            attn = input.new_empty(batch_size, sourceL, queryL) if return_att else None
+            for start in range(0, queryL, chunk):
+                end = min(start + chunk, queryL)
+                context_tile, attn_tile = \
+                    self.attend(targetT[:, start:end], sourceT, mask)
+                weightedContext[:, :, start:end] = context_tile
+                if attn is not None:
+                    attn[:, :, start:end] = attn_tile
+
+        weightedContext = weightedContext.contiguous().view(batch_size, -1, ih, iw)
+        if not return_att:
+            return weightedContext, None
+        attn = attn.contiguous().view(batch_size, -1, ih, iw)
 
         return weightedContext, attn
@@ -0,0 +1,137 @@
+from __future__ import print_function
+
+from miscc.config import cfg, cfg_from_file
+from model import G_NET
+
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+import torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark G_NET inference with and '
+                                                 'without the attention maps')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='',
+                        help='optional config file, the default config otherwise')
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=0)
+    parser.add_argument('--batch_sizes', type=str, default='1,8,16')
+    parser.add_argument('--branch_num', type=int, default=3,
+                        help='TREE.BRANCH_NUM, 3 benchmarks the 256px stage')
+    parser.add_argument('--chunk', type=int, default=-1,
+                        help='GAN.ATT_CHUNK_SIZE, -1 keeps the config value')
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--worker', type=str, default='',
+                        help='internal: "batch_size,return_att" on the CPU, prints JSON')
+    args = parser.parse_args()
+    return args
+
+
+def make_inputs(batch_size, device):
+    nef = cfg.TEXT.EMBEDDING_DIM
+    seq_len = cfg.TEXT.WORDS_NUM
+    noise = torch.randn(batch_size, cfg.GAN.Z_DIM, device=device)
+    sent_emb = torch.randn(batch_size, nef, device=device)
+    words_embs = torch.randn(batch_size, nef, seq_len, device=device)
+    cap_lens = torch.randint(3, seq_len + 1, (batch_size,))
+    mask = torch.arange(seq_len).unsqueeze(0) >= cap_lens.unsqueeze(1)
+    return noise, sent_emb, words_embs, mask.to(device)
+
+
+def rss_mb():
+    # peak RSS of this process, ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run(netG, batch_size, return_att, iters, device):
+    """
+        ms per forward pass and the peak memory it needs on top of the
+        model, in MB (allocator peak on the GPU, RSS growth on the CPU)
+    """
+    inputs = make_inputs(batch_size, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    else:
+        base = rss_mb()
+    start_t = time.time()
+    for _ in range(iters):
+        fake_imgs, att_maps, _, _ = netG(*inputs, return_att=return_att)
+        # the 256px image and the maps are alive together, as for a caller
+        del fake_imgs, att_maps
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2. ** 20
+    else:
+        peak = rss_mb() - base
+    return (time.time() - start_t) * 1000. / iters, peak
+
+
+def build_netG(device):
+    netG = G_NET()
+    netG.eval()
+    return netG.to(device)
+
+
+def run_worker(args):
+    # one process per configuration, RSS peaks cannot be reset
+    batch_size, return_att = args.worker.split(',')
+    cfg.CUDA = False
+    device = torch.device('cpu')
+    netG = build_netG(device)
+    with torch.no_grad():
+        ms, peak = run(netG, int(batch_size), return_att == '1', args.iters, device)
+    print(json.dumps({'ms': ms, 'peak_mb': peak}))
+
+
+def run_cpu(args, batch_size, return_att):
+    command = [sys.executable, __file__, '--worker', '%d,%d' % (batch_size, return_att),
+               '--iters', str(args.iters), '--chunk', str(args.chunk),
+               '--branch_num', str(args.branch_num)]
+    if args.cfg_file:
+        command += ['--cfg', args.cfg_file]
+    output = subprocess.check_output(command).decode('utf8')
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['ms'], result['peak_mb']
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file:
+        cfg_from_file(args.cfg_file)
+    cfg.TREE.BRANCH_NUM = args.branch_num
+    if args.chunk >= 0:
+        cfg.GAN.ATT_CHUNK_SIZE = args.chunk
+    if args.worker:
+        run_worker(args)
+        sys.exit(0)
+
+    if args.gpu_id == -1 or not torch.cuda.is_available():
+        cfg.CUDA = False
+        device = torch.device('cpu')
+    else:
+        torch.cuda.set_device(args.gpu_id)
+        device = torch.device('cuda', args.gpu_id)
+        netG = build_netG(device)
+    imsize = 64 * 2 ** (cfg.TREE.BRANCH_NUM - 1)
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        results = []
+        for return_att in [True, False]:
+            if device.type == 'cuda':
+                with torch.no_grad():
+                    # the first pass pays for the cuDNN setup
+                    run(netG, batch_size, return_att, 1, device)
+                    results.append(run(netG, batch_size, return_att, args.iters, device))
+            else:
+                results.append(run_cpu(args, batch_size, return_att))
+        (att_ms, att_mb), (free_ms, free_mb) = results
+        print('| {}px batch {:3d} | with maps {:8.1f} ms {:8.1f} MB | '
+              'without {:8.1f} ms {:8.1f} MB | memory saved {:5.1f}%'
+              .format(imsize, batch_size, att_ms, att_mb, free_ms, free_mb,
+                      100. * (att_mb - free_mb) / att_mb if att_mb > 0 else 0.))
@@ -0,0 +1,57 @@
+from __future__ import print_function
+
+from miscc.image_io import open_image, resize_shorter
+
+import os
+import time
+import argparse
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark full vs reduced JPEG decoding')
+    parser.add_argument('--image_dir', dest='image_dir', type=str,
+                        default='../data/birds/CUB_200_2011/images')
+    parser.add_argument('--size', type=int, default=304,
+                        help='shorter side after the resize, imsize * 76 / 64')
+    parser.add_argument('--limit', type=int, default=500)
+    args = parser.parse_args()
+    return args
+
+
+def find_images(image_dir, limit):
+    paths = []
+    for root, _, files in sorted(os.walk(image_dir)):
+        for name in sorted(files):
+            if name.lower().endswith(('.jpg', '.jpeg')):
+                paths.append(os.path.join(root, name))
+                if len(paths) == limit:
+                    return paths
+    return paths
+
+
+def load(paths, size, reduced):
+    imgs = []
+    start_t = time.time()
+    for path in paths:
+        img = open_image(path, size if reduced else None)
+        imgs.append(np.asarray(resize_shorter(img, size), dtype='float32'))
+    return imgs, time.time() - start_t
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    paths = find_images(args.image_dir, args.limit)
+    if len(paths) == 0:
+        print('Error: no JPEGs under %s' % args.image_dir)
+    else:
+        # warm the page cache so both runs only measure decoding
+        load(paths, args.size, True)
+        full_imgs, full_t = load(paths, args.size, False)
+        reduced_imgs, reduced_t = load(paths, args.size, True)
+        diff = np.mean([np.abs(a - b).mean() / 255.
+                        for a, b in zip(full_imgs, reduced_imgs)])
+        print('| %d images | full %.1f img/s | reduced %.1f img/s | '
+              'speedup %.2fx | mean abs diff %.4f'
+              % (len(paths), len(paths) / full_t, len(paths) / reduced_t,
+                 full_t / reduced_t, diff))
@@ -0,0 +1,78 @@
+from __future__ import print_function
+
+from miscc.config import cfg, cfg_from_file
+from inference import ReplicaPool, split_cores
+
+import os
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark CPU inference replicas '
+                                                 'pinned to core sets')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='',
+                        help='optional config file, TRAIN.NET_E / NET_G are loaded '
+                             'if set, random weights otherwise')
+    parser.add_argument('--replicas', type=str, default='',
+                        help='replica counts to compare, e.g. 1,2,4; '
+                             'default 1 and every power of 2 up to the core count')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--batches', type=int, default=16)
+    parser.add_argument('--branch_num', type=int, default=-1,
+                        help='TREE.BRANCH_NUM, -1 keeps the config value')
+    parser.add_argument('--n_words', type=int, default=5450)
+    args = parser.parse_args()
+    return args
+
+
+def make_batches(n_batches, batch_size, n_words, rng):
+    # [(captions, cap_lens)], sorted by length in a decreasing order
+    seq_len = cfg.TEXT.WORDS_NUM
+    batches = []
+    for _ in range(n_batches):
+        cap_lens = np.sort(rng.randint(3, seq_len + 1, batch_size))[::-1].copy()
+        captions = rng.randint(1, n_words, (batch_size, cap_lens[0]))
+        for i in range(batch_size):
+            captions[i, cap_lens[i]:] = 0
+        batches.append((captions.astype('int64'), cap_lens.astype('int64')))
+    return batches
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file:
+        cfg_from_file(args.cfg_file)
+    if args.branch_num > 0:
+        cfg.TREE.BRANCH_NUM = args.branch_num
+    cfg.CUDA = False
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(multiprocessing.cpu_count()))
+    if args.replicas:
+        replica_counts = [int(n) for n in args.replicas.split(',')]
+    else:
+        replica_counts = [n for n in [2 ** i for i in range(8)] if n <= len(cores)]
+    batches = make_batches(args.batches, args.batch_size, args.n_words,
+                           np.random.RandomState(100))
+    imsize = 64 * 2 ** (cfg.TREE.BRANCH_NUM - 1)
+
+    print('%d cores, %d batches of %d captions, %dpx' %
+          (len(cores), args.batches, args.batch_size, imsize))
+    for n_replicas in replica_counts:
+        core_sets = split_cores(n_replicas, cores)
+        pool = ReplicaPool(args.n_words, core_sets)
+        # the first batch of every replica pays for the allocations
+        pool.generate(batches[:n_replicas])
+        start_t = time.time()
+        images = pool.generate(batches)
+        elapsed = time.time() - start_t
+        pool.close()
+        n_images = sum(len(im) for im in images)
+        n_cores = sum(len(c) for c in core_sets)
+        print('| {:3d} replicas x {:3d} cores | {:8.2f} img/s | {:8.3f} img/s per core'
+              .format(n_replicas, len(core_sets[0]), n_images / elapsed,
+                      n_images / elapsed / n_cores))
@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+from miscc.config import cfg
+from model import G_NET, RNN_ENCODER
+from inference import generate_samples
+
+import time
+import argparse
+
+import torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark K samples per caption, one '
+                                                 'text encoding vs one per sample')
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=0)
+    parser.add_argument('--captions', type=int, default=4)
+    parser.add_argument('--n_samples', type=str, default='1,10,100')
+    parser.add_argument('--max_batch', type=int, default=64,
+                        help='rows per netG forward pass of the batched path')
+    parser.add_argument('--branch_num', type=int, default=3)
+    parser.add_argument('--n_words', type=int, default=5450)
+    parser.add_argument('--truncation', type=float, default=0.)
+    args = parser.parse_args()
+    return args
+
+
+def make_captions(n_captions, n_words, device):
+    # sorted by length in a decreasing order, as prepare_data does
+    seq_len = cfg.TEXT.WORDS_NUM
+    cap_lens = torch.randint(3, seq_len + 1, (n_captions,))
+    cap_lens = torch.sort(cap_lens, 0, True)[0]
+    cap_lens[0] = seq_len
+    captions = torch.randint(1, n_words, (n_captions, seq_len))
+    for i in range(n_captions):
+        captions[i, cap_lens[i]:] = 0
+    return captions.to(device), cap_lens.to(device)
+
+
+def encode(text_encoder, captions, cap_lens):
+    hidden = text_encoder.init_hidden(captions.size(0))
+    words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
+    return words_embs, sent_emb, captions == 0
+
+
+def per_sample(text_encoder, netG, captions, cap_lens, n_samples):
+    # encode the captions and run netG again for every noise draw
+    imgs = []
+    for _ in range(n_samples):
+        words_embs, sent_emb, mask = encode(text_encoder, captions, cap_lens)
+        noise = torch.randn(captions.size(0), cfg.GAN.Z_DIM, device=captions.device)
+        fake_imgs, _, _, _ = netG(noise, sent_emb, words_embs, mask, return_att=False)
+        imgs.append(fake_imgs[-1].cpu())
+    return imgs
+
+
+def amortized(text_encoder, netG, captions, cap_lens, n_samples, args):
+    words_embs, sent_emb, mask = encode(text_encoder, captions, cap_lens)
+    fake_imgs, _ = generate_samples(netG, sent_emb, words_embs, mask, n_samples,
+                                    truncation=args.truncation, max_batch=args.max_batch,
+                                    stages=[-1])
+    return fake_imgs[-1]
+
+
+def images_per_sec(fn, n_images, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_t = time.time()
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return n_images / (time.time() - start_t)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg.TREE.BRANCH_NUM = args.branch_num
+    if args.gpu_id == -1 or not torch.cuda.is_available():
+        cfg.CUDA = False
+        device = torch.device('cpu')
+    else:
+        torch.cuda.set_device(args.gpu_id)
+        device = torch.device('cuda', args.gpu_id)
+
+    text_encoder = RNN_ENCODER(args.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM).to(device).eval()
+    netG = G_NET().to(device).eval()
+    captions, cap_lens = make_captions(args.captions, args.n_words, device)
+
+    # same seeds give the same images whatever the batching
+    words_embs, sent_emb, mask = encode(text_encoder, captions, cap_lens)
+    with torch.no_grad():
+        seeds = range(args.captions)
+        one_pass = generate_samples(netG, sent_emb, words_embs, mask, 3, seeds)[0][-1]
+        chunked = generate_samples(netG, sent_emb, words_embs, mask, 3, seeds,
+                                   max_batch=2)[0][-1]
+    print('seeded max diff, one pass vs max_batch 2: %.2e' %
+          (one_pass - chunked).abs().max().item())
+
+    imsize = 64 * 2 ** (cfg.TREE.BRANCH_NUM - 1)
+    with torch.no_grad():
+        # the first pass pays for the allocations and the cuDNN setup
+        amortized(text_encoder, netG, captions, cap_lens, 1, args)
+        for n_samples in [int(k) for k in args.n_samples.split(',')]:
+            n_images = args.captions * n_samples
+            loop_ips = images_per_sec(
+                lambda: per_sample(text_encoder, netG, captions, cap_lens, n_samples),
+                n_images, device)
+            batched_ips = images_per_sec(
+                lambda: amortized(text_encoder, netG, captions, cap_lens, n_samples, args),
+                n_images, device)
+            print('| {}px {:3d} captions x K {:4d} | per sample {:8.2f} img/s | '
+                  'one encoding {:8.2f} img/s | speedup {:5.2f}x'
+                  .format(imsize, args.captions, n_samples, loop_ips, batched_ips,
+                          batched_ips / loop_ips))
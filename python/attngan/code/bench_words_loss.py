@@ -0,0 +1,77 @@
+from __future__ import print_function
+
+from miscc.config import cfg
+from miscc.losses import words_similarity, batched_words_similarity
+
+import time
+import argparse
+
+import torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the DAMSM words_loss')
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=0)
+    parser.add_argument('--batch_sizes', type=str, default='10,48,128')
+    parser.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+    return args
+
+
+def make_inputs(batch_size, device):
+    nef = cfg.TEXT.EMBEDDING_DIM
+    seq_len = cfg.TEXT.WORDS_NUM
+    img_features = torch.randn(batch_size, nef, 17, 17, device=device)
+    # captions arrive sorted by length in a decreasing order (prepare_data)
+    cap_lens = torch.randint(3, seq_len + 1, (batch_size,))
+    cap_lens = torch.sort(cap_lens, 0, True)[0]
+    cap_lens[0] = seq_len
+    words_emb = torch.randn(batch_size, nef, seq_len, device=device)
+    for i in range(batch_size):
+        words_emb[i, :, cap_lens[i]:] = 0
+    return img_features, words_emb, cap_lens.to(device)
+
+
+def time_fn(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_t = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_t) * 1000. / iters
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.gpu_id == -1 or not torch.cuda.is_available():
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda', args.gpu_id)
+
+    with torch.no_grad():
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            img_features, words_emb, cap_lens = make_inputs(batch_size, device)
+
+            sim_loop, att_loop = words_similarity(img_features, words_emb,
+                                                  cap_lens, batch_size)
+            sim_batched, att_batched = batched_words_similarity(img_features,
+                                                                words_emb,
+                                                                cap_lens)
+            sim_diff = (sim_loop - sim_batched).abs().max().item()
+            att_diff = max((a - b).abs().max().item()
+                           for a, b in zip(att_loop, att_batched))
+
+            loop_ms = time_fn(lambda: words_similarity(img_features, words_emb,
+                                                       cap_lens, batch_size),
+                              args.iters, device)
+            batched_ms = time_fn(lambda: batched_words_similarity(img_features,
+                                                                  words_emb,
+                                                                  cap_lens),
+                                 args.iters, device)
+            print('| batch {:4d} | loop {:8.2f} ms | batched {:8.2f} ms | '
+                  'speedup {:5.2f}x | max diff sim {:.2e} attn {:.2e}'
+                  .format(batch_size, loop_ms, batched_ms,
+                          loop_ms / batched_ms, sim_diff, att_diff))
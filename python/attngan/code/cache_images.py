@@ -0,0 +1,50 @@
+from __future__ import print_function
+
+from miscc.config import cfg, cfg_from_file
+from miscc.image_cache import build_image_cache, load_size_for
+from datasets import TextDataset
+
+import os
+import sys
+import time
+import pprint
+import argparse
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Cache bbox-cropped, pre-resized images')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/bird_attn2.yml', type=str)
+    parser.add_argument('--data_dir', dest='data_dir', type=str, default='')
+    parser.add_argument('--split', dest='split', type=str, default='train')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+
+    if args.data_dir != '':
+        cfg.DATA_DIR = args.data_dir
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    if cfg.TREE.IMG_CACHE == '':
+        print('Error: TREE.IMG_CACHE is required')
+        sys.exit(1)
+
+    dataset = TextDataset(cfg.DATA_DIR, args.split,
+                          base_size=cfg.TREE.BASE_SIZE)
+    imsize = cfg.TREE.BASE_SIZE * (2 ** (cfg.TREE.BRANCH_NUM - 1))
+
+    start_t = time.time()
+    build_image_cache(os.path.join(cfg.TREE.IMG_CACHE, args.split),
+                      dataset.get_img_path, len(dataset.filenames),
+                      load_size_for(imsize))
+    print('Total time for caching:', time.time() - start_t)
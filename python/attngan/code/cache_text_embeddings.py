@@ -0,0 +1,75 @@
+from __future__ import print_function
+
+from miscc.config import cfg, cfg_from_file
+from miscc.text_cache import build_text_cache
+from datasets import TextDataset
+from model import RNN_ENCODER
+
+import os
+import sys
+import pprint
+import argparse
+import numpy as np
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Cache the frozen DAMSM text embeddings')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/bird_attn2.yml', type=str)
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=-1)
+    parser.add_argument('--data_dir', dest='data_dir', type=str, default='')
+    parser.add_argument('--split', dest='split', type=str, default='train')
+    parser.add_argument('--batch_size', type=int, default=100)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+
+    if args.gpu_id != -1:
+        cfg.GPU_ID = args.gpu_id
+        torch.cuda.set_device(cfg.GPU_ID)
+    else:
+        cfg.CUDA = False
+
+    if args.data_dir != '':
+        cfg.DATA_DIR = args.data_dir
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    if cfg.TEXT.EMB_CACHE == '' or cfg.TRAIN.NET_E == '':
+        print('Error: TEXT.EMB_CACHE and TRAIN.NET_E are required')
+        sys.exit(1)
+
+    # captions longer than WORDS_NUM keep a random subset of their words,
+    # TEXT.EMB_CACHE_DRAWS of them are cached; seeded so the cache is
+    # reproducible
+    np.random.seed(100)
+
+    dataset = TextDataset(cfg.DATA_DIR, args.split,
+                          base_size=cfg.TREE.BASE_SIZE)
+    n_captions = len(dataset.filenames) * dataset.embeddings_num
+
+    text_encoder = RNN_ENCODER(dataset.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
+    state_dict = \
+        torch.load(cfg.TRAIN.NET_E, map_location=lambda storage, loc: storage)
+    text_encoder.load_state_dict(state_dict)
+    print('Load text encoder from:', cfg.TRAIN.NET_E)
+    if cfg.CUDA:
+        text_encoder = text_encoder.cuda()
+
+    build_text_cache(os.path.join(cfg.TEXT.EMB_CACHE, args.split),
+                     dataset.get_caption, n_captions,
+                     {'text': (text_encoder, cfg.TRAIN.NET_E)},
+                     batch_size=args.batch_size,
+                     caption_length=dataset.caption_length,
+                     draws=cfg.TEXT.EMB_CACHE_DRAWS)
@@ -4,9 +4,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 
-from nltk.tokenize import RegexpTokenizer
-from collections import defaultdict
 from miscc.config import cfg
+from miscc.caption_store import tokenize, CaptionStore, has_caption_store
+from miscc.caption_store import save_caption_store, load_caption_store
+from miscc.caption_store import save_vocab, load_vocab
+from miscc.image_cache import random_crop_flip, branch_imgs, load_size_for
+from miscc.image_io import open_image
 
 import torch
 import torch.utils.data as data
@@ -26,49 +29,42 @@ else:
 
 
 def prepare_data(data):
-    imgs, captions, captions_lens, class_ids, keys = data
-
-    # sort data by the length in a decreasing order
-    sorted_cap_lens, sorted_cap_indices = \
-        torch.sort(captions_lens, 0, True)
+    # RNN_ENCODER packs with enforce_sorted=False, so the batch keeps
+    # the order it was sampled in. The copies are non_blocking, which
+    # overlaps them with compute when the loader pins its memory.
+    imgs, captions, captions_lens, class_ids, keys = data[:5]
 
     real_imgs = []
     for i in range(len(imgs)):
-        imgs[i] = imgs[i][sorted_cap_indices]
         if cfg.CUDA:
-            real_imgs.append(Variable(imgs[i]).cuda())
+            real_imgs.append(Variable(imgs[i]).cuda(non_blocking=True))
         else:
             real_imgs.append(Variable(imgs[i]))
 
-    captions = captions[sorted_cap_indices].squeeze()
-    class_ids = class_ids[sorted_cap_indices].numpy()
-    # sent_indices = sent_indices[sorted_cap_indices]
-    keys = [keys[i] for i in sorted_cap_indices.numpy()]
-    # print('keys', type(keys), keys[-1])  # list
+    captions = captions.squeeze()
+    class_ids = class_ids.numpy()
+    keys = list(keys)
     if cfg.CUDA:
-        captions = Variable(captions).cuda()
-        sorted_cap_lens = Variable(sorted_cap_lens).cuda()
+        captions = Variable(captions).cuda(non_blocking=True)
+        captions_lens = Variable(captions_lens).cuda(non_blocking=True)
     else:
         captions = Variable(captions)
-        sorted_cap_lens = Variable(sorted_cap_lens)
+        captions_lens = Variable(captions_lens)
 
-    return [real_imgs, captions, sorted_cap_lens,
-            class_ids, keys]
+    ret = [real_imgs, captions, captions_lens,
+           class_ids, keys]
+    # words_embs / sent_emb from a TextEmbeddingCache
+    for emb in data[5:]:
+        if cfg.CUDA:
+            emb = emb.cuda(non_blocking=True)
+        ret.append(Variable(emb))
+    return ret
 
 
 def get_imgs(img_path, imsize, bbox=None,
-             transform=None, normalize=None):
-    img = Image.open(img_path).convert('RGB')
-    width, height = img.size
-    if bbox is not None:
-        r = int(np.maximum(bbox[2], bbox[3]) * 0.75)
-        center_x = int((2 * bbox[0] + bbox[2]) / 2)
-        center_y = int((2 * bbox[1] + bbox[3]) / 2)
-        y1 = np.maximum(0, center_y - r)
-        y2 = np.minimum(height, center_y + r)
-        x1 = np.maximum(0, center_x - r)
-        x2 = np.minimum(width, center_x + r)
-        img = img.crop([x1, y1, x2, y2])
+             transform=None, normalize=None, load_size=None):
+    # load_size: the shorter side transform resizes to, if it does
+    img = open_image(img_path, load_size, bbox)
 
     if transform is not None:
         img = transform(img)
@@ -88,10 +84,17 @@ def get_imgs(img_path, imsize, bbox=None,
     return ret
 
 
+def get_cached_imgs(img, imsize):
+    # img: a pre-resized image from ImageCache
+    img = random_crop_flip(img, imsize[-1])
+    return branch_imgs(img, imsize, single=cfg.GAN.B_DCGAN)
+
+
 class TextDataset(data.Dataset):
     def __init__(self, data_dir, split='train',
                  base_size=64,
-                 transform=None, target_transform=None):
+                 transform=None, target_transform=None,
+                 text_cache=None, image_cache=None):
         self.transform = transform
         self.norm = transforms.Compose([
             transforms.ToTensor(),
@@ -103,6 +106,10 @@ class TextDataset(data.Dataset):
         for i in range(cfg.TREE.BRANCH_NUM):
             self.imsize.append(base_size)
             base_size = base_size * 2
+        # the image transforms start with Resize(imsize * 76 / 64)
+        self.load_size = None
+        if transform is not None:
+            self.load_size = load_size_for(self.imsize[-1])
 
         self.data = []
         self.data_dir = data_dir
@@ -117,6 +124,10 @@ class TextDataset(data.Dataset):
 
         self.class_id = self.load_class_id(split_dir, len(self.filenames))
         self.number_example = len(self.filenames)
+        # precomputed text embeddings, see cache_text_embeddings.py
+        self.text_cache = text_cache
+        # pre-resized images, see cache_images.py
+        self.image_cache = image_cache
 
     def load_bbox(self):
         data_dir = self.data_dir
@@ -157,12 +168,8 @@ class TextDataset(data.Dataset):
                     if len(cap) == 0:
                         continue
                     cap = cap.replace("\ufffd\ufffd", " ")
-                    # picks out sequences of alphanumeric characters as tokens
-                    # and drops everything else
-                    #tokenizer = RegexpTokenizer(r'\w+')
-                    # parse whitespace, commas, and periods instead
-                    tokenizer = RegexpTokenizer('\s+|\.$|\.\s+|,$|,\s+', gaps=True)
-                    tokens = tokenizer.tokenize(cap.lower())
+                    # parse whitespace, commas, and periods
+                    tokens = tokenize(cap.lower())
                     # print('tokens', tokens)
                     if len(tokens) == 0:
                         print('cap', cap)
@@ -183,75 +190,71 @@ class TextDataset(data.Dataset):
         return all_captions
 
     def build_dictionary(self, train_captions, test_captions):
-        word_counts = defaultdict(float)
         captions = train_captions + test_captions
-        for sent in captions:
-            for word in sent:
-                word_counts[word] += 1
-
-        vocab = [w for w in word_counts if word_counts[w] >= 0]
+        words = np.array([w for sent in captions for w in sent])
+        # index the words in order of first appearance, 0 is '<end>'
+        vocab, first, inverse = \
+            np.unique(words, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.zeros(len(vocab), dtype='int32')
+        rank[order] = np.arange(1, len(vocab) + 1)
+        tokens = rank[inverse.reshape(-1)]
 
         ixtoword = {}
         ixtoword[0] = '<end>'
         wordtoix = {}
         wordtoix['<end>'] = 0
-        ix = 1
-        for w in vocab:
-            wordtoix[w] = ix
-            ixtoword[ix] = w
-            ix += 1
-            
-        train_captions_new = []
-        for t in train_captions:
-            rev = []
-            for w in t:
-                if w in wordtoix:
-                    rev.append(wordtoix[w])
-            # rev.append(0)  # do not need '<end>' token
-            train_captions_new.append(rev)
-
-        test_captions_new = []
-        for t in test_captions:
-            rev = []
-            for w in t:
-                if w in wordtoix:
-                    rev.append(wordtoix[w])
-            # rev.append(0)  # do not need '<end>' token
-            test_captions_new.append(rev)
+        for ix, w in enumerate(vocab[order], 1):
+            wordtoix[str(w)] = ix
+            ixtoword[ix] = str(w)
+
+        offsets = np.zeros(len(captions) + 1, dtype='int64')
+        np.cumsum([len(sent) for sent in captions], out=offsets[1:])
+        n_train = len(train_captions)
+        train_captions_new = CaptionStore(tokens[:offsets[n_train]],
+                                          offsets[:n_train + 1])
+        test_captions_new = CaptionStore(tokens[offsets[n_train]:],
+                                         offsets[n_train:] - offsets[n_train])
 
         return [train_captions_new, test_captions_new,
                 ixtoword, wordtoix, len(ixtoword)]
 
     def load_text_data(self, data_dir, split):
+        store_dir = os.path.join(data_dir, 'caption_store')
         filepath = os.path.join(data_dir, 'captions.pickle')
         train_names = self.load_filenames(data_dir, 'train')
         test_names = self.load_filenames(data_dir, 'test')
-        if not os.path.isfile(filepath):
-            train_captions = self.load_captions(data_dir, train_names)
-            test_captions = self.load_captions(data_dir, test_names)
-
-            train_captions, test_captions, ixtoword, wordtoix, n_words = \
-                self.build_dictionary(train_captions, test_captions)
-            with open(filepath, 'wb') as f:
-                pickle.dump([train_captions, test_captions,
-                             ixtoword, wordtoix], f, protocol=2)
-                print('Save to: ', filepath)
-        else:
-            with open(filepath, 'rb') as f:
-                x = pickle.load(f)
-                train_captions, test_captions = x[0], x[1]
-                ixtoword, wordtoix = x[2], x[3]
-                del x
-                n_words = len(ixtoword)
-                print('Load from: ', filepath)
+        if not has_caption_store(store_dir):
+            if os.path.isfile(filepath):
+                # convert an existing captions.pickle, keeping its indices
+                with open(filepath, 'rb') as f:
+                    x = pickle.load(f)
+                    train_captions, test_captions = x[0], x[1]
+                    ixtoword = x[2]
+                    del x
+                    print('Load from: ', filepath)
+            else:
+                train_captions = self.load_captions(data_dir, train_names)
+                test_captions = self.load_captions(data_dir, test_names)
+
+                train_captions, test_captions, ixtoword, wordtoix, n_words = \
+                    self.build_dictionary(train_captions, test_captions)
+            save_caption_store(store_dir, 'train', train_captions)
+            save_caption_store(store_dir, 'test', test_captions)
+            save_vocab(store_dir, ixtoword)
+            print('Save to: ', store_dir)
+
+        ixtoword, wordtoix = load_vocab(store_dir)
+        n_words = len(ixtoword)
         if split == 'train':
-            # a list of list: each list contains
-            # the indices of words in a sentence
-            captions = train_captions
+            # word indices of every sentence, sliced out of one
+            # memory-mapped array
+            captions = load_caption_store(store_dir, 'train')
             filenames = train_names
         else:  # split=='test'
-            captions = test_captions
+            captions = load_caption_store(store_dir, 'test')
             filenames = test_names
+        print('Load from: ', store_dir)
         return filenames, captions, ixtoword, wordtoix, n_words
 
     def load_class_id(self, data_dir, total_num):
@@ -272,6 +275,10 @@ class TextDataset(data.Dataset):
             filenames = []
         return filenames
 
+    def caption_length(self, sent_ix):
+        # the number of words, before get_caption keeps WORDS_NUM of them
+        return len(self.captions[sent_ix])
+
     def get_caption(self, sent_ix):
         # a list of indices for a sentence
         sent_caption = np.asarray(self.captions[sent_ix]).astype('int64')
@@ -292,27 +299,91 @@ class TextDataset(data.Dataset):
             x_len = cfg.TEXT.WORDS_NUM
         return x, x_len
 
-    def __getitem__(self, index):
-        #
+    def get_img_path(self, index):
         key = self.filenames[index]
-        cls_id = self.class_id[index]
-        #
         if self.bbox is not None:
             bbox = self.bbox[key]
             data_dir = '%s/dataset' % self.data_dir
         else:
             bbox = None
             data_dir = self.data_dir
-        #
         img_name = '%s/images/%s.jpg' % (data_dir, key)
-        imgs = get_imgs(img_name, self.imsize,
-                        bbox, self.transform, normalize=self.norm)
+        return img_name, bbox
+
+    def caption_lengths(self):
+        # n_images x embeddings_num, the cap_len get_caption returns
+        n_captions = len(self.filenames) * self.embeddings_num
+        lens = np.diff(np.asarray(self.captions.offsets[:n_captions + 1]))
+        lens = np.minimum(lens, cfg.TEXT.WORDS_NUM)
+        return lens.reshape(-1, self.embeddings_num)
+
+    def __getitem__(self, index):
+        sent_ix = None
+        if isinstance(index, tuple):
+            # (index, sent_ix) from a BucketBatchSampler
+            index, sent_ix = index
+        #
+        key = self.filenames[index]
+        cls_id = self.class_id[index]
+        #
+        if self.image_cache is not None:
+            imgs = get_cached_imgs(self.image_cache.get(index), self.imsize)
+        else:
+            img_name, bbox = self.get_img_path(index)
+            imgs = get_imgs(img_name, self.imsize,
+                            bbox, self.transform, normalize=self.norm,
+                            load_size=self.load_size)
         # random select a sentence
-        sent_ix = random.randint(0, self.embeddings_num)
+        if sent_ix is None:
+            sent_ix = random.randint(0, self.embeddings_num)
         new_sent_ix = index * self.embeddings_num + sent_ix
+        if self.text_cache is not None:
+            caps, cap_len, words_emb, sent_emb = \
+                self.text_cache.get(new_sent_ix)
+            return imgs, caps, cap_len, cls_id, key, words_emb, sent_emb
         caps, cap_len = self.get_caption(new_sent_ix)
         return imgs, caps, cap_len, cls_id, key
 
 
     def __len__(self):
         return len(self.filenames)
+
+
+class BucketBatchSampler(data.Sampler):
+    """
+        Batches of (index, sent_ix) with similar caption lengths.
+        Like TextDataset.__getitem__, one random caption is drawn per image
+        each epoch. The shuffled images are split into pools of pool_size
+        batches, each pool is sorted by caption length in a decreasing
+        order and cut into batches, and the batches are shuffled again.
+    """
+    def __init__(self, cap_lens, batch_size, pool_size=50, drop_last=True):
+        # cap_lens: n_images x embeddings_num, see TextDataset.caption_lengths
+        self.cap_lens = cap_lens
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        n_images, embeddings_num = self.cap_lens.shape
+        sent_ix = random.randint(0, embeddings_num, n_images)
+        lens = self.cap_lens[np.arange(n_images), sent_ix]
+        order = random.permutation(n_images)
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, n_images, pool):
+            ix = order[start:start + pool]
+            ix = ix[np.argsort(-lens[ix], kind='mergesort')]
+            for b in range(0, len(ix), self.batch_size):
+                if len(ix) - b < self.batch_size and self.drop_last:
+                    break
+                batches.append(ix[b:b + self.batch_size])
+        random.shuffle(batches)
+        for batch in batches:
+            yield [(int(i), int(sent_ix[i])) for i in batch]
+
+    def __len__(self):
+        n_images = len(self.cap_lens)
+        if self.drop_last:
+            return n_images // self.batch_size
+        return (n_images + self.batch_size - 1) // self.batch_size
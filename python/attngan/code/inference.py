@@ -0,0 +1,273 @@
+from __future__ import print_function
+
+from miscc.config import cfg
+from model import G_DCGAN, G_NET, RNN_ENCODER
+
+import os
+import numpy as np
+import multiprocessing
+
+import torch
+
+
+def default_device():
+    # the GPU of cfg.GPU_ID when cfg.CUDA is set and one exists, else the CPU
+    if cfg.CUDA and torch.cuda.is_available():
+        return torch.device('cuda', cfg.GPU_ID)
+    return torch.device('cpu')
+
+
+def set_threads(intra_threads=0, inter_threads=0):
+    # torch intra-op / inter-op threads of this process, 0 keeps the default
+    if intra_threads > 0:
+        torch.set_num_threads(intra_threads)
+    if inter_threads > 0 and torch.get_num_interop_threads() != inter_threads:
+        try:
+            torch.set_num_interop_threads(inter_threads)
+        except RuntimeError:
+            # the inter-op pool is sized once, before its first parallel work
+            print('Warning: keep %d inter-op threads, set them before any inference'
+                  % torch.get_num_interop_threads())
+
+
+def split_cores(n_replicas, cores=None):
+    # cores (the ones this process may run on by default) in n_replicas
+    # contiguous sets of the same size, the remainder is left idle
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+            else list(range(multiprocessing.cpu_count()))
+    per_replica = len(cores) // n_replicas
+    if per_replica == 0:
+        raise ValueError('%d replicas do not fit on %d cores' % (n_replicas, len(cores)))
+    return [cores[i * per_replica:(i + 1) * per_replica] for i in range(n_replicas)]
+
+
+def truncated_normal(randn, shape, truncation=0.):
+    # randn(*shape): standard normal floats, the values outside
+    # [-truncation, truncation] are redrawn from it until none is left
+    z = randn(*shape)
+    if truncation > 0:
+        out = np.abs(z) > truncation
+        while out.any():
+            z[out] = randn(int(out.sum()))
+            out = np.abs(z) > truncation
+    return z.astype('float32')
+
+
+def sample_noise(n_captions, n_samples, seeds=None, truncation=0.):
+    """
+        z and the CA_NET noise of n_samples images for each of the
+        n_captions captions, the rows of a caption next to each other.
+        seeds: one per caption, a caption then always gets the same
+            images whatever batch it is generated in
+        truncation: > 0 redraws the z values outside [-truncation, truncation]
+    """
+    nz = cfg.GAN.Z_DIM
+    ncf = cfg.GAN.CONDITION_DIM
+    if seeds is None:
+        noise = truncated_normal(np.random.randn, (n_captions * n_samples, nz), truncation)
+        eps = np.random.randn(n_captions * n_samples, ncf).astype('float32')
+    else:
+        noise, eps = [], []
+        for seed in seeds:
+            rng = np.random.RandomState(seed)
+            noise.append(truncated_normal(rng.randn, (n_samples, nz), truncation))
+            eps.append(rng.randn(n_samples, ncf).astype('float32'))
+        noise, eps = np.concatenate(noise), np.concatenate(eps)
+    return torch.from_numpy(noise), torch.from_numpy(eps)
+
+
+def iter_samples(netG, sent_emb, words_embs, mask, n_samples, seeds=None,
+                 truncation=0., max_batch=0, return_att=False, stages=None):
+    """
+        n_samples images for each caption from a single text encoding:
+        netG expands the caption inputs to the noise rows, so the text
+        encoder and the CA_NET projection run once per caption.
+        max_batch: rows per netG forward pass, 0 for all at once
+        stages: indices of the stages to return (e.g. [-1]), None for all
+        Yields (rows, fake_imgs, att_maps) per forward pass, on the CPU:
+        rows indexes caption * n_samples + sample, the images and
+        attention maps hold those rows, so a caller that saves them as
+        they come never holds more than max_batch rows.
+    """
+    n_captions = sent_emb.size(0)
+    noise, eps = sample_noise(n_captions, n_samples, seeds, truncation)
+    noise, eps = noise.to(sent_emb.device), eps.to(sent_emb.device)
+    # samples of a caption, and captions, per forward pass
+    k_step = n_samples if max_batch <= 0 else min(n_samples, max_batch)
+    c_step = n_captions if max_batch <= 0 else max(1, max_batch // n_samples)
+    for c_start in range(0, n_captions, c_step):
+        c_end = min(c_start + c_step, n_captions)
+        for k_start in range(0, n_samples, k_step):
+            k_end = min(k_start + k_step, n_samples)
+            rows = (torch.arange(c_start, c_end).unsqueeze(1) * n_samples +
+                    torch.arange(k_start, k_end).unsqueeze(0)).view(-1)
+            # not around the yield, the caller keeps its own grad mode
+            with torch.no_grad():
+                imgs, atts, _, _ = netG(noise[rows.to(sent_emb.device)],
+                                        sent_emb[c_start:c_end],
+                                        words_embs[c_start:c_end], mask[c_start:c_end],
+                                        return_att=return_att, n_samples=k_end - k_start,
+                                        eps=eps[rows.to(sent_emb.device)])
+            if stages is not None:
+                imgs = [imgs[k] for k in stages]
+            yield rows, [im.cpu() for im in imgs], [attn.cpu() for attn in atts]
+
+
+def generate_samples(netG, sent_emb, words_embs, mask, n_samples, seeds=None,
+                     truncation=0., max_batch=0, return_att=False, stages=None):
+    """
+        iter_samples, all at once. Returns the images (of stages) and
+        attention maps of every stage on the CPU, (batch x n_samples) x
+        ... each, the samples of a caption next to each other.
+    """
+    fake_imgs, att_maps = [], []
+    for _, imgs, atts in iter_samples(netG, sent_emb, words_embs, mask, n_samples, seeds,
+                                      truncation, max_batch, return_att, stages):
+        fake_imgs.append(imgs)
+        att_maps.append(atts)
+    fake_imgs = [torch.cat(stage) for stage in zip(*fake_imgs)]
+    att_maps = [torch.cat(stage) for stage in zip(*att_maps)]
+    return fake_imgs, att_maps
+
+
+def to_images(fake_img):
+    # batch x 3 x H x W in [-1, 1] --> batch x H x W x 3 uint8
+    im = fake_img.add(1).mul(127.5).clamp(0, 255).byte()
+    return im.permute(0, 2, 3, 1).numpy()
+
+
+class InferenceEngine(object):
+    """
+        The text encoder of cfg.TRAIN.NET_E and the generator of
+        cfg.TRAIN.NET_G on one device, for generating images outside of
+        training. An empty path keeps the random weights (benchmarks).
+        device: torch.device or a string like 'cpu' or 'cuda:1',
+            default_device() if None
+        intra_threads, inter_threads: torch threads of the process, 0
+            keeps the default
+    """
+    def __init__(self, n_words, device=None, intra_threads=0, inter_threads=0):
+        set_threads(intra_threads, inter_threads)
+        self.device = default_device() if device is None else torch.device(device)
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
+        self.text_encoder = self.load_text_encoder(n_words)
+        self.netG = self.load_generator()
+
+    def load_state(self, model, path, name):
+        if path != '':
+            state_dict = torch.load(path, map_location=lambda storage, loc: storage)
+            model.load_state_dict(state_dict)
+            print('Load %s from: %s' % (name, path))
+        return model.to(self.device).eval()
+
+    def load_text_encoder(self, n_words):
+        text_encoder = RNN_ENCODER(n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
+        return self.load_state(text_encoder, cfg.TRAIN.NET_E, 'text encoder')
+
+    def load_generator(self):
+        if cfg.GAN.B_DCGAN:
+            netG = G_DCGAN()
+        else:
+            netG = G_NET()
+        return self.load_state(netG, cfg.TRAIN.NET_G, 'G')
+
+    def encode(self, captions, cap_lens):
+        """
+            captions: batch x seq_len word indices, cap_lens: batch, both
+            LongTensors or numpy arrays
+            Returns words_embs, sent_emb and the word mask on the device
+        """
+        if not torch.is_tensor(captions):
+            captions, cap_lens = torch.from_numpy(captions), torch.from_numpy(cap_lens)
+        captions = captions.long().to(self.device)
+        cap_lens = cap_lens.long().to(self.device)
+        with torch.no_grad():
+            hidden = self.text_encoder.init_hidden(captions.size(0))
+            # words_embs: batch_size x nef x seq_len
+            # sent_emb: batch_size x nef
+            words_embs, sent_emb = self.text_encoder(captions, cap_lens, hidden)
+        mask = (captions == 0)[:, :words_embs.size(2)]
+        return words_embs, sent_emb, mask
+
+    def generate(self, captions, cap_lens, n_samples=1, seeds=None, truncation=0.,
+                 max_batch=0, return_att=False, stages=None):
+        # see generate_samples, the captions are encoded once
+        words_embs, sent_emb, mask = self.encode(captions, cap_lens)
+        return generate_samples(self.netG, sent_emb, words_embs, mask, n_samples, seeds,
+                                truncation, max_batch, return_att, stages)
+
+    def iter_generate(self, captions, cap_lens, n_samples=1, seeds=None, truncation=0.,
+                      max_batch=0, return_att=False, stages=None):
+        # see iter_samples, the captions are encoded once
+        words_embs, sent_emb, mask = self.encode(captions, cap_lens)
+        return iter_samples(self.netG, sent_emb, words_embs, mask, n_samples, seeds,
+                            truncation, max_batch, return_att, stages)
+
+
+def _replica_main(config, n_words, cores, jobs, results):
+    # a spawned process does not see the parent's cfg_from_file
+    cfg.update(config)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    engine = InferenceEngine(n_words, 'cpu', intra_threads=len(cores), inter_threads=1)
+    results.put((None, os.getpid()))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, captions, cap_lens, kwargs = job
+        try:
+            fake_imgs, _ = engine.generate(captions, cap_lens, stages=[-1], **kwargs)
+            results.put((job_id, to_images(fake_imgs[-1])))
+        except Exception as e:
+            results.put((job_id, e))
+
+
+class ReplicaPool(object):
+    """
+        CPU replicas of InferenceEngine, each in its own process pinned to
+        one of core_sets with one intra-op thread per core, e.g.
+        split_cores(4) for 4 replicas on the cores of this process. A job
+        goes to whichever replica is free.
+    """
+    def __init__(self, n_words, core_sets):
+        context = multiprocessing.get_context('spawn')
+        self.core_sets = [list(cores) for cores in core_sets]
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.workers = []
+        for cores in self.core_sets:
+            worker = context.Process(target=_replica_main,
+                                     args=(cfg, n_words, cores, self.jobs, self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        # every replica has its models loaded
+        for _ in self.workers:
+            self.results.get()
+
+    def generate(self, batches, **kwargs):
+        """
+            batches: [(captions, cap_lens)] numpy arrays, kwargs: the
+            options of InferenceEngine.generate
+            Returns the final stage images of every batch, in the order of
+            batches, as (batch x n_samples) x H x W x 3 uint8 arrays
+        """
+        for job_id, (captions, cap_lens) in enumerate(batches):
+            self.jobs.put((job_id, captions, cap_lens, kwargs))
+        images = [None] * len(batches)
+        for _ in batches:
+            job_id, result = self.results.get()
+            if isinstance(result, Exception):
+                raise RuntimeError('replica failed on batch %d: %r' % (job_id, result))
+            images[job_id] = result
+        return images
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
@@ -1,7 +1,10 @@
 from __future__ import print_function
 
 from miscc.config import cfg, cfg_from_file
-from datasets import TextDataset
+from miscc.text_cache import TextEmbeddingCache
+from miscc.image_cache import ImageCache, load_size_for
+from miscc.caption_store import tokenize
+from datasets import TextDataset, BucketBatchSampler
 from trainer import condGANTrainer as trainer
 
 import os
@@ -35,7 +38,6 @@ def parse_args():
 
 def gen_example(wordtoix, algo):
     '''generate images from example sentences'''
-    from nltk.tokenize import RegexpTokenizer
     filepath = '%s/example_filenames.txt' % (cfg.DATA_DIR)
     data_dic = {}
     with open(filepath, "r") as f:
@@ -54,10 +56,8 @@ def gen_example(wordtoix, algo):
                     if len(sent) == 0:
                         continue
                     sent = sent.replace("\ufffd\ufffd", " ")
-                    #tokenizer = RegexpTokenizer(r'\w+')
-                    # parse whitespace, commas, and periods instead
-                    tokenizer = RegexpTokenizer('\s+|\.$|\.\s+|,$|,\s+', gaps=True)
-                    tokens = tokenizer.tokenize(sent.lower())
+                    # parse whitespace, commas, and periods
+                    tokens = tokenize(sent.lower())
                     if len(tokens) == 0:
                         print('sent', sent)
                         continue
@@ -126,13 +126,33 @@ if __name__ == "__main__":
         transforms.Resize(int(imsize * 76 / 64)),
         transforms.RandomCrop(imsize),
         transforms.RandomHorizontalFlip()])
+    text_cache = None
+    if cfg.TRAIN.FLAG and cfg.TEXT.EMB_CACHE != '':
+        text_cache = TextEmbeddingCache(os.path.join(cfg.TEXT.EMB_CACHE, split_dir),
+                                        {'text': cfg.TRAIN.NET_E})
+    image_cache = None
+    if cfg.TREE.IMG_CACHE != '':
+        image_cache = ImageCache(os.path.join(cfg.TREE.IMG_CACHE, split_dir),
+                                 load_size_for(imsize))
     dataset = TextDataset(cfg.DATA_DIR, split_dir,
                           base_size=cfg.TREE.BASE_SIZE,
-                          transform=image_transform)
+                          transform=image_transform,
+                          text_cache=text_cache,
+                          image_cache=image_cache)
     assert dataset
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=cfg.TRAIN.BATCH_SIZE,
-        drop_last=True, shuffle=bshuffle, num_workers=int(cfg.WORKERS))
+    if cfg.TRAIN.FLAG and cfg.TRAIN.BUCKET_POOL > 0:
+        # batches of similar caption lengths
+        batch_sampler = BucketBatchSampler(dataset.caption_lengths(),
+                                           cfg.TRAIN.BATCH_SIZE,
+                                           cfg.TRAIN.BUCKET_POOL)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=batch_sampler,
+            num_workers=int(cfg.WORKERS), pin_memory=cfg.CUDA)
+    else:
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=cfg.TRAIN.BATCH_SIZE,
+            drop_last=True, shuffle=bshuffle, num_workers=int(cfg.WORKERS),
+            pin_memory=cfg.CUDA)
 
     # Define models and go to train/evaluate
     algo = trainer(output_dir, dataloader, dataset.n_words, dataset.ixtoword)
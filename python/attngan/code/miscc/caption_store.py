@@ -0,0 +1,80 @@
+import io
+import os
+import re
+import numpy as np
+
+from miscc.utils import mkdir_p
+
+
+# Caption tokenizer ################################################
+# RegexpTokenizer('\s+|\.$|\.\s+|,$|,\s+', gaps=True): parse whitespace,
+# commas and periods, compiled once with nltk's default flags
+TOKEN_GAPS = re.compile(r'\s+|\.$|\.\s+|,$|,\s+',
+                        re.UNICODE | re.MULTILINE | re.DOTALL)
+
+
+def tokenize(caption):
+    return [t for t in TOKEN_GAPS.split(caption) if len(t) > 0]
+
+
+# Memory-mapped caption store ######################################
+# <store_dir>/vocab.txt: one word per line, the line number is its index
+# <store_dir>/<split>_tokens.npy: int32 word indices of every caption
+# <store_dir>/<split>_offsets.npy: caption i is tokens[offsets[i]:offsets[i + 1]]
+class CaptionStore(object):
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, sent_ix):
+        return self.tokens[self.offsets[sent_ix]:self.offsets[sent_ix + 1]]
+
+    @classmethod
+    def from_lists(cls, captions):
+        offsets = np.zeros(len(captions) + 1, dtype='int64')
+        np.cumsum([len(cap) for cap in captions], out=offsets[1:])
+        tokens = np.zeros(offsets[-1], dtype='int32')
+        for i, cap in enumerate(captions):
+            tokens[offsets[i]:offsets[i + 1]] = cap
+        return cls(tokens, offsets)
+
+
+def save_caption_store(store_dir, split, captions):
+    if not isinstance(captions, CaptionStore):
+        captions = CaptionStore.from_lists(captions)
+    mkdir_p(store_dir)
+    np.save(os.path.join(store_dir, '%s_tokens.npy' % split),
+            np.asarray(captions.tokens, dtype='int32'))
+    np.save(os.path.join(store_dir, '%s_offsets.npy' % split),
+            np.asarray(captions.offsets, dtype='int64'))
+
+
+def load_caption_store(store_dir, split):
+    tokens = np.load(os.path.join(store_dir, '%s_tokens.npy' % split),
+                     mmap_mode='r')
+    offsets = np.load(os.path.join(store_dir, '%s_offsets.npy' % split),
+                      mmap_mode='r')
+    return CaptionStore(tokens, offsets)
+
+
+def save_vocab(store_dir, ixtoword):
+    mkdir_p(store_dir)
+    with io.open(os.path.join(store_dir, 'vocab.txt'), 'w', encoding='utf8') as f:
+        for ix in range(len(ixtoword)):
+            f.write(u'%s\n' % ixtoword[ix])
+
+
+def load_vocab(store_dir):
+    with io.open(os.path.join(store_dir, 'vocab.txt'), 'r', encoding='utf8') as f:
+        words = f.read().split('\n')[:-1]
+    ixtoword = dict(enumerate(words))
+    wordtoix = dict((w, ix) for ix, w in enumerate(words))
+    return ixtoword, wordtoix
+
+
+def has_caption_store(store_dir):
+    # vocab.txt is written last
+    return os.path.isfile(os.path.join(store_dir, 'vocab.txt'))
@@ -23,6 +23,8 @@ __C.B_VALIDATION = False
 __C.TREE = edict()
 __C.TREE.BRANCH_NUM = 2 # 3
 __C.TREE.BASE_SIZE = 64
+# directory of a cache built by cache_images.py, '' to disable
+__C.TREE.IMG_CACHE = ''
 
 
 # Training options
@@ -38,6 +40,14 @@ __C.TRAIN.FLAG = True
 __C.TRAIN.NET_E = ''
 __C.TRAIN.NET_G = ''
 __C.TRAIN.B_NET_D = True
+__C.TRAIN.BATCHED_WORDS_LOSS = False
+# batches per length-sorted pool of BucketBatchSampler, 0 for random batches
+__C.TRAIN.BUCKET_POOL = 0
+# batches condGANTrainer prepares ahead in a background thread, 0 for none
+__C.TRAIN.PREFETCH = 2
+# per-phase timings of the train loop: a .jsonl, .db or .sqlite path, '' to disable
+__C.TRAIN.METRICS = ''
+__C.TRAIN.METRICS_INTERVAL = 100
 
 __C.TRAIN.SMOOTH = edict()
 __C.TRAIN.SMOOTH.GAMMA1 = 5.0
@@ -46,6 +56,20 @@ __C.TRAIN.SMOOTH.GAMMA2 = 5.0
 __C.TRAIN.SMOOTH.LAMBDA = 1.0
 
 
+# Sampling options, of B_VALIDATION and the example captions
+__C.SAMPLE = edict()
+# images per caption, all drawn from one text encoding
+__C.SAMPLE.N_SAMPLES = 1
+# seed of the noise of the first caption (+1 per caption), -1 for random
+__C.SAMPLE.SEED = -1
+# redraw the z values outside [-TRUNCATION, TRUNCATION], 0 to disable
+__C.SAMPLE.TRUNCATION = 0.0
+# rows per netG forward pass, 0 for all the samples of a batch at once
+__C.SAMPLE.MAX_BATCH = 0
+# torch intra-op / inter-op threads of the inference engine, 0 for the default
+__C.SAMPLE.INTRA_THREADS = 0
+__C.SAMPLE.INTER_THREADS = 0
+
 # Modal options
 __C.GAN = edict()
 __C.GAN.DF_DIM = 64
@@ -55,12 +79,20 @@ __C.GAN.CONDITION_DIM = 100
 __C.GAN.R_NUM = 2
 __C.GAN.B_ATTENTION = True
 __C.GAN.B_DCGAN = False
+# query positions per attention tile in G, 0 attends all at once
+__C.GAN.ATT_CHUNK_SIZE = 0
 
 
 __C.TEXT = edict()
 __C.TEXT.CAPTIONS_PER_IMAGE = 10
 __C.TEXT.EMBEDDING_DIM = 256
 __C.TEXT.WORDS_NUM = 18
+# directory of a cache built by cache_text_embeddings.py, '' to disable
+__C.TEXT.EMB_CACHE = ''
+# word subsets cached for each caption longer than WORDS_NUM; a read picks
+# one at random, where the encoder would see a new subset every epoch, so
+# 1 fixes a single subset per caption for the whole training
+__C.TEXT.EMB_CACHE_DRAWS = 8
 
 
 def _merge_a_into_b(a, b):
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+
+import torch
+
+
+# Exponential moving average of the generator ######################
+class ModelEMA(object):
+    def __init__(self, model, decay=0.999):
+        self.model = model
+        self.decay = decay
+        self.names = [name for name, _ in model.named_parameters()]
+        self.params = [p for _, p in model.named_parameters()]
+        self.shadow = [p.detach().clone() for p in self.params]
+
+    def update(self):
+        # avg_p = decay * avg_p + (1 - decay) * p, over all tensors at once
+        with torch.no_grad():
+            params = [p.detach() for p in self.params]
+            if hasattr(torch, '_foreach_mul_'):
+                torch._foreach_mul_(self.shadow, self.decay)
+                torch._foreach_add_(self.shadow, params, alpha=1. - self.decay)
+            else:
+                for avg_p, p in zip(self.shadow, params):
+                    avg_p.mul_(self.decay).add_(p, alpha=1. - self.decay)
+
+    def swap(self):
+        # exchange the storages of the model and the average, no copies
+        for i, p in enumerate(self.params):
+            p.data, self.shadow[i] = self.shadow[i], p.data
+
+    @contextmanager
+    def average_parameters(self):
+        self.swap()
+        try:
+            yield self.model
+        finally:
+            self.swap()
+
+    def state_dict(self):
+        # model.state_dict() with the averaged parameters
+        state = self.model.state_dict()
+        for name, avg_p in zip(self.names, self.shadow):
+            state[name] = avg_p
+        return state
+
+    def load_state_dict(self, state_dict):
+        with torch.no_grad():
+            for name, avg_p in zip(self.names, self.shadow):
+                avg_p.copy_(state_dict[name])
@@ -0,0 +1,112 @@
+import os
+import json
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from miscc.utils import mkdir_p
+from miscc.image_io import open_image, resize_shorter
+
+
+# Pre-resized images ###############################################
+# The bbox-cropped images, resized so that their shorter side is
+# load_size (imsize * 76 / 64), packed as uint8 HWC into images.bin.
+# index.npy holds (offset, height, width) of every image in the order
+# of the dataset filenames.
+def load_size_for(imsize):
+    return int(imsize * 76 / 64)
+
+
+def build_image_cache(cache_dir, get_path_and_bbox, n_images, load_size):
+    """
+        get_path_and_bbox: index --> (image path, bbox or None)
+    """
+    mkdir_p(cache_dir)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.isfile(meta_path):
+        # an incomplete cache must never look valid
+        os.remove(meta_path)
+
+    index = np.zeros((n_images, 3), dtype='int64')
+    offset = 0
+    with open(os.path.join(cache_dir, 'images.bin'), 'wb') as f:
+        for i in range(n_images):
+            img_path, bbox = get_path_and_bbox(i)
+            img = open_image(img_path, load_size, bbox)
+            img = np.asarray(resize_shorter(img, load_size), dtype='uint8')
+            f.write(np.ascontiguousarray(img).tobytes())
+            index[i] = (offset, img.shape[0], img.shape[1])
+            offset += img.size
+            if i % 1000 == 0:
+                print('cached images: %d/%d' % (i, n_images))
+    np.save(os.path.join(cache_dir, 'index.npy'), index)
+
+    meta = {'n_images': n_images, 'load_size': load_size, 'n_bytes': offset}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('Save images to: ', cache_dir)
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir, load_size):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['load_size'] != load_size:
+            raise ValueError('Image cache %s was built for load size %d, not %d'
+                             % (cache_dir, meta['load_size'], load_size))
+        self.n_images = meta['n_images']
+        self.index = np.load(os.path.join(cache_dir, 'index.npy'))
+        print('Load images from: ', cache_dir)
+        self.shard = None
+
+    def __len__(self):
+        return self.n_images
+
+    def __getstate__(self):
+        # every DataLoader worker maps the shard itself
+        state = self.__dict__.copy()
+        state['shard'] = None
+        return state
+
+    def get(self, index):
+        """
+            returns a 3 x height x width uint8 tensor
+        """
+        if self.shard is None:
+            self.shard = np.memmap(os.path.join(self.cache_dir, 'images.bin'),
+                                   dtype='uint8', mode='r')
+        offset, height, width = self.index[index]
+        img = np.array(self.shard[offset:offset + height * width * 3])
+        img = torch.from_numpy(img).view(height, width, 3)
+        return img.permute(2, 0, 1)
+
+
+def random_crop_flip(img, size):
+    # transforms.RandomCrop(size) + transforms.RandomHorizontalFlip()
+    height, width = img.size(1), img.size(2)
+    y = np.random.randint(0, height - size + 1)
+    x = np.random.randint(0, width - size + 1)
+    img = img[:, y:y + size, x:x + size]
+    if np.random.rand() < 0.5:
+        img = img.flip(2)
+    return img
+
+
+def branch_imgs(img, imsize, single=False):
+    """
+        img: 3 x imsize[-1] x imsize[-1] uint8
+        returns one image in [-1, 1] per branch, or just the
+        largest one if single
+    """
+    img = img.float().div_(127.5).sub_(1.).unsqueeze(0)
+    if single:
+        return [img[0]]
+    ret = []
+    for size in imsize[:-1]:
+        re_img = F.interpolate(img, size=(size, size), mode='bilinear',
+                               align_corners=False, antialias=True)
+        ret.append(re_img[0])
+    ret.append(img[0])
+    return ret
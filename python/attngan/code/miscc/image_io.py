@@ -0,0 +1,58 @@
+import numpy as np
+from PIL import Image
+
+
+# Image loading ####################################################
+def bbox_crop_box(bbox, width, height):
+    # square of side 1.5 * max(bbox w, h) around the bbox center
+    r = int(np.maximum(bbox[2], bbox[3]) * 0.75)
+    center_x = int((2 * bbox[0] + bbox[2]) / 2)
+    center_y = int((2 * bbox[1] + bbox[3]) / 2)
+    y1 = np.maximum(0, center_y - r)
+    y2 = np.minimum(height, center_y + r)
+    x1 = np.maximum(0, center_x - r)
+    x2 = np.minimum(width, center_x + r)
+    return [x1, y1, x2, y2]
+
+
+def crop_to_bbox(img, bbox):
+    width, height = img.size
+    return img.crop(bbox_crop_box(bbox, width, height))
+
+
+def open_image(img_path, size=None, bbox=None):
+    """
+        Opens img_path as RGB, cropped around bbox if given.
+        With size, a JPEG is decoded at the largest of the 1/2, 1/4 and 1/8
+        DCT scales that keeps the shorter side of the (cropped) image at or
+        above size, so that the caller's resize only finishes the job.
+    """
+    img = Image.open(img_path)
+    width, height = img.size
+    if size is not None and img.format == 'JPEG':
+        if bbox is not None:
+            x1, y1, x2, y2 = bbox_crop_box(bbox, width, height)
+            shorter = min(x2 - x1, y2 - y1)
+        else:
+            shorter = min(width, height)
+        factor = shorter / float(size)
+        if factor >= 2:
+            img.draft('RGB', (int(np.ceil(width / factor)),
+                              int(np.ceil(height / factor))))
+    img = img.convert('RGB')
+    if bbox is not None:
+        scale = img.size[0] / float(width)
+        img = crop_to_bbox(img, [v * scale for v in bbox])
+    return img
+
+
+def resize_shorter(img, size):
+    # same output size as transforms.Resize(size)
+    width, height = img.size
+    if width <= height:
+        new_w, new_h = size, int(size * height / width)
+    else:
+        new_w, new_h = int(size * width / height), size
+    if (new_w, new_h) == (width, height):
+        return img
+    return img.resize((new_w, new_h), Image.BILINEAR)
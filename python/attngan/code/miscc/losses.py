@@ -1,10 +1,12 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import numpy as np
 from miscc.config import cfg
 
 from GlobalAttention import func_attention
+from miscc.metrics import phase
 import torchvision.transforms as transforms
 
 
@@ -18,22 +20,30 @@ def cosine_similarity(x1, x2, dim=1, eps=1e-8):
     return (w12 / (w1 * w2).clamp(min=eps)).squeeze()
 
 
-def sent_loss(cnn_code, rnn_code, labels, class_ids,
+def class_masks(class_ids):
+    """Same-class mask shared by sent_loss, words_loss and discriminator_loss.
+        class_ids: batch_size (numpy array or LongTensor)
+        returns masks: batch_size x batch_size bool, masks(i, j) is True
+        when the j-th sample is a mis-match from the same class as the i-th
+    """
+    if class_ids is None:
+        return None
+    if not torch.is_tensor(class_ids):
+        class_ids = torch.from_numpy(np.asarray(class_ids))
+    if cfg.CUDA:
+        class_ids = class_ids.cuda()
+    batch_size = class_ids.size(0)
+    # --> batch_size x batch_size
+    masks = class_ids.view(-1, 1) == class_ids.view(1, -1)
+    eye = torch.eye(batch_size, device=masks.device).bool()
+    return masks & ~eye
+
+
+def sent_loss(cnn_code, rnn_code, labels, masks,
               batch_size, eps=1e-8):
     # ### Mask mis-match samples  ###
     # that come from the same class as the real sample ###
-    masks = []
-    if class_ids is not None:
-        for i in range(batch_size):
-            mask = (class_ids == class_ids[i]).astype(np.bool)
-            mask[i] = 0
-            masks.append(mask.reshape((1, -1)))
-        masks = np.concatenate(masks, 0)
-        # masks: batch_size x batch_size
-        masks = torch.BoolTensor(masks)
-        if cfg.CUDA:
-            masks = masks.cuda()
-
+    # masks: batch_size x batch_size, see class_masks
     # --> seq_len x batch_size x nef
     if cnn_code.dim() == 2:
         cnn_code = cnn_code.unsqueeze(0)
@@ -49,7 +59,7 @@ def sent_loss(cnn_code, rnn_code, labels, class_ids,
 
     # --> batch_size x batch_size
     scores0 = scores0.squeeze()
-    if class_ids is not None:
+    if masks is not None:
         scores0.data.masked_fill_(masks, -float('inf'))
     scores1 = scores0.transpose(0, 1)
     if labels is not None:
@@ -61,20 +71,41 @@ def sent_loss(cnn_code, rnn_code, labels, class_ids,
 
 
 def words_loss(img_features, words_emb, labels,
-               cap_lens, class_ids, batch_size):
+               cap_lens, masks, batch_size):
     """
         words_emb(query): batch x nef x seq_len
         img_features(context): batch x nef x 17 x 17
+        masks: batch_size x batch_size, see class_masks
+    """
+    if cfg.TRAIN.BATCHED_WORDS_LOSS:
+        similarities, att_maps = \
+            batched_words_similarity(img_features, words_emb, cap_lens)
+    else:
+        similarities, att_maps = \
+            words_similarity(img_features, words_emb, cap_lens, batch_size)
+
+    similarities = similarities * cfg.TRAIN.SMOOTH.GAMMA3
+    if masks is not None:
+        similarities.data.masked_fill_(masks, -float('inf'))
+    similarities1 = similarities.transpose(0, 1)
+    if labels is not None:
+        loss0 = nn.CrossEntropyLoss()(similarities, labels)
+        loss1 = nn.CrossEntropyLoss()(similarities1, labels)
+    else:
+        loss0, loss1 = None, None
+    return loss0, loss1, att_maps
+
+
+def words_similarity(img_features, words_emb, cap_lens, batch_size):
+    """Caption-by-caption word-region similarity (Eq. 7 - 10).
+        words_emb(query): batch x nef x seq_len
+        img_features(context): batch x nef x 17 x 17
+        returns similarities: batch(images) x batch(captions)
     """
-    masks = []
     att_maps = []
     similarities = []
     cap_lens = cap_lens.data.tolist()
     for i in range(batch_size):
-        if class_ids is not None:
-            mask = (class_ids == class_ids[i]).astype(np.bool)
-            mask[i] = 0
-            masks.append(mask.reshape((1, -1)))
         # Get the i-th text description
         words_num = cap_lens[i]
         # -> 1 x nef x words_num
@@ -114,28 +145,80 @@ def words_loss(img_features, words_emb, labels,
 
     # batch_size x batch_size
     similarities = torch.cat(similarities, 1)
-    if class_ids is not None:
-        masks = np.concatenate(masks, 0)
-        # masks: batch_size x batch_size
-        masks = torch.BoolTensor(masks)
-        if cfg.CUDA:
-            masks = masks.cuda()
+    return similarities, att_maps
 
-    similarities = similarities * cfg.TRAIN.SMOOTH.GAMMA3
-    if class_ids is not None:
-        similarities.data.masked_fill_(masks, -float('inf'))
-    similarities1 = similarities.transpose(0, 1)
-    if labels is not None:
-        loss0 = nn.CrossEntropyLoss()(similarities, labels)
-        loss1 = nn.CrossEntropyLoss()(similarities1, labels)
-    else:
-        loss0, loss1 = None, None
-    return loss0, loss1, att_maps
+
+def batched_words_similarity(img_features, words_emb, cap_lens, eps=1e-8):
+    """Word-region similarity for every (caption, image) pair at once.
+    Captions stay padded to seq_len and the padded words are masked out
+    of the word softmax (Eq. 8) and the word sum (Eq. 10), which gives
+    the same result as words_similarity without the per-caption loop.
+        words_emb(query): batch x nef x seq_len
+        img_features(context): batch x nef x 17 x 17
+        returns similarities: batch(images) x batch(captions)
+    """
+    batch_size, nef, seq_len = words_emb.size()
+    ih, iw = img_features.size(2), img_features.size(3)
+    sourceL = ih * iw
+
+    # word_mask: batch(captions) x 1 x 1 x seq_len, True for padded words
+    steps = torch.arange(seq_len, device=words_emb.device)
+    word_mask = steps.unsqueeze(0) >= cap_lens.view(-1, 1).to(steps.dtype)
+    word_mask = word_mask.view(batch_size, 1, 1, seq_len)
+
+    # context: batch(images) x nef x sourceL
+    context = img_features.view(batch_size, nef, sourceL)
+    # --> batch(images)*sourceL x nef
+    contextT = context.transpose(1, 2).contiguous().view(-1, nef)
+    # --> nef x batch(captions)*seq_len
+    words = words_emb.transpose(0, 1).contiguous().view(nef, -1)
+
+    # Eq. (7): (batch*sourceL x nef)(nef x batch*seq_len)
+    # --> batch(captions) x batch(images) x sourceL x seq_len
+    attn = torch.mm(contextT, words)
+    attn = attn.view(batch_size, sourceL, batch_size, seq_len).permute(2, 0, 1, 3)
+    # Eq. (8): normalize over the words of each caption
+    attn = attn.masked_fill(word_mask, -float('inf'))
+    attn = F.softmax(attn, dim=3)
+    # Eq. (9): normalize over the image regions
+    # --> batch(captions) x batch(images) x seq_len x sourceL
+    attn = attn.transpose(2, 3)
+    attn = F.softmax(attn * cfg.TRAIN.SMOOTH.GAMMA1, dim=3)
+
+    # --> batch(images) x sourceL x batch(captions)*seq_len
+    attnT = attn.permute(1, 3, 0, 2).contiguous() \
+        .view(batch_size, sourceL, batch_size * seq_len)
+    # (batch x nef x sourceL)(batch x sourceL x batch*seq_len)
+    # --> batch(images) x nef x batch(captions) x seq_len
+    weiContext = torch.bmm(context, attnT).view(batch_size, nef,
+                                                 batch_size, seq_len)
+
+    # cosine similarity along nef --> batch(images) x batch(captions) x seq_len
+    word = words_emb.transpose(0, 1).unsqueeze(0)
+    w12 = torch.sum(word * weiContext, 1)
+    w1 = torch.norm(word, 2, 1)
+    w2 = torch.norm(weiContext, 2, 1)
+    row_sim = w12 / (w1 * w2).clamp(min=eps)
+
+    # Eq. (10)
+    row_sim = torch.exp(row_sim * cfg.TRAIN.SMOOTH.GAMMA2)
+    row_sim = row_sim.masked_fill(word_mask.view(1, batch_size, seq_len), 0)
+    # similarities(i, j): the similarity between the i-th image and the j-th text description
+    similarities = torch.log(row_sim.sum(dim=2))
+
+    att_maps = []
+    cap_lens = cap_lens.data.tolist()
+    for i in range(batch_size):
+        words_num = cap_lens[i]
+        # --> 1 x words_num x 17 x 17
+        att_maps.append(attn[i, i, :words_num].contiguous()
+                        .view(1, words_num, ih, iw))
+    return similarities, att_maps
 
 
 # ##################Loss for G and Ds##############################
 def discriminator_loss(netD, real_imgs, fake_imgs, conditions,
-                       real_labels, fake_labels):
+                       real_labels, fake_labels, masks=None):
     # Forward
     real_features = netD(real_imgs)
     fake_features = netD(fake_imgs.detach())
@@ -148,7 +231,14 @@ def discriminator_loss(netD, real_imgs, fake_imgs, conditions,
     #
     batch_size = real_features.size(0)
     cond_wrong_logits = netD.COND_DNET(real_features[:(batch_size - 1)], conditions[1:batch_size])
-    cond_wrong_errD = nn.BCELoss()(cond_wrong_logits, fake_labels[1:batch_size])
+    wrong_labels = fake_labels[1:batch_size]
+    if masks is not None:
+        # drop the shifted pairs whose caption comes from the image's class
+        keep = ~masks.diagonal(1)
+        if keep.any():
+            cond_wrong_logits = cond_wrong_logits[keep]
+            wrong_labels = wrong_labels[keep]
+    cond_wrong_errD = nn.BCELoss()(cond_wrong_logits, wrong_labels)
 
     if netD.UNCOND_DNET is not None:
         real_logits = netD.UNCOND_DNET(real_features)
@@ -164,7 +254,7 @@ def discriminator_loss(netD, real_imgs, fake_imgs, conditions,
 
 def generator_loss(netsD, image_encoder, fake_imgs, real_labels,
                    words_embs, sent_emb, match_labels,
-                   cap_lens, class_ids):
+                   cap_lens, masks):
     numDs = len(netsD)
     batch_size = real_labels.size(0)
     logs = ''
@@ -186,21 +276,22 @@ def generator_loss(netsD, image_encoder, fake_imgs, real_labels,
 
         # Ranking loss
         if i == (numDs - 1):
-            # words_features: batch_size x nef x 17 x 17
-            # sent_code: batch_size x nef
-            region_features, cnn_code = image_encoder(fake_imgs[i])
-            w_loss0, w_loss1, _ = words_loss(region_features, words_embs,
-                                             match_labels, cap_lens,
-                                             class_ids, batch_size)
-            w_loss = (w_loss0 + w_loss1) * \
-                cfg.TRAIN.SMOOTH.LAMBDA
-            # err_words = err_words + w_loss.data[0]
-
-            s_loss0, s_loss1 = sent_loss(cnn_code, sent_emb,
-                                         match_labels, class_ids, batch_size)
-            s_loss = (s_loss0 + s_loss1) * \
-                cfg.TRAIN.SMOOTH.LAMBDA
-            # err_sent = err_sent + s_loss.data[0]
+            with phase('damsm'):
+                # words_features: batch_size x nef x 17 x 17
+                # sent_code: batch_size x nef
+                region_features, cnn_code = image_encoder(fake_imgs[i])
+                w_loss0, w_loss1, _ = words_loss(region_features, words_embs,
+                                                 match_labels, cap_lens,
+                                                 masks, batch_size)
+                w_loss = (w_loss0 + w_loss1) * \
+                    cfg.TRAIN.SMOOTH.LAMBDA
+                # err_words = err_words + w_loss.data[0]
+
+                s_loss0, s_loss1 = sent_loss(cnn_code, sent_emb,
+                                             match_labels, masks, batch_size)
+                s_loss = (s_loss0 + s_loss1) * \
+                    cfg.TRAIN.SMOOTH.LAMBDA
+                # err_sent = err_sent + s_loss.data[0]
 
             errG_total += w_loss + s_loss
             logs += 'w_loss: %.2f s_loss: %.2f ' % (w_loss.item(), s_loss.item())
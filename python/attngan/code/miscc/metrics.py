@@ -0,0 +1,29 @@
+import os
+import sys
+
+
+# The trainer metrics live in python/utils/metrics.py, shared by the
+# AttnGAN, LeicaGAN, SRGAN and DCGAN trainers. This module loads that
+# file once per process (under one name, so every importer shares the
+# active sink) and re-exports it to this project.
+def _load_shared(name='gan_trainer_metrics'):
+    if name in sys.modules:
+        return sys.modules[name]
+    path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', '..', '..', 'utils', 'metrics.py'))
+    try:
+        import importlib.util
+    except ImportError:  # Python 2
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+_metrics = _load_shared()
+peak_rss_mb = _metrics.peak_rss_mb
+phase = _metrics.phase
+MetricsSink = _metrics.MetricsSink
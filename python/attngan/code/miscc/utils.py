@@ -6,9 +6,9 @@ from torch.nn import init
 import torch
 import torch.nn as nn
 
+import torch.nn.functional as F
+
 from PIL import Image, ImageDraw, ImageFont
-from copy import deepcopy
-import skimage.transform
 
 from miscc.config import cfg
 
@@ -25,14 +25,39 @@ COLOR_DIC = {0:[128,64,128],  1:[244, 35,232],
              16:[0, 80, 100], 17:[0, 0, 230],
              18:[0,  0, 70],  19:[0, 0,  0]}
 FONT_MAX = 50
+_FONT = None
+
+
+def get_font():
+    # loaded from disk once per process
+    global _FONT
+    if _FONT is None:
+        _FONT = ImageFont.truetype('arial.ttf', 36)
+    return _FONT
+
+
+def upsample_attn_maps(attn_maps, att_sze, vis_size):
+    """
+        attn_maps: a list of n_i x att_sze x att_sze maps
+        returns: len(attn_maps) x max(n_i) x vis_size x vis_size numpy,
+        all maps upsampled by a single F.interpolate
+    """
+    num_attns = [attn.size(0) for attn in attn_maps]
+    padded = attn_maps[0].new_zeros(len(attn_maps), max(num_attns),
+                                    att_sze, att_sze)
+    for i, attn in enumerate(attn_maps):
+        padded[i, :num_attns[i]] = attn
+    if vis_size != att_sze:
+        padded = F.interpolate(padded, size=(vis_size, vis_size),
+                               mode='bilinear', align_corners=False)
+    return padded.numpy()
 
 
 def drawCaption(convas, captions, ixtoword, vis_size, off1=2, off2=2):
     num = captions.size(0)
     img_txt = Image.fromarray(convas)
     # get a font
-    # fnt = None  # ImageFont.truetype('Pillow/Tests/fonts/FreeMono.ttf', 50)
-    fnt = ImageFont.truetype('arial.ttf', 36)
+    fnt = get_font()
     # get a drawing context
     d = ImageDraw.Draw(img_txt)
     sentence_list = []
@@ -104,18 +129,18 @@ def build_super_images(real_imgs, captions, ixtoword,
         drawCaption(text_convas, captions, ixtoword, vis_size)
     text_map = np.asarray(text_map).astype(np.uint8)
 
-    bUpdate = 1
+    # --> num x (1 + seq_len) x 17 x 17, the max over the words first
+    maps = []
     for i in range(num):
-        attn = attn_maps[i].cpu().view(1, -1, att_sze, att_sze)
-        # --> 1 x 1 x 17 x 17
+        attn = attn_maps[i].detach().cpu().float().view(1, -1, att_sze, att_sze)
         attn_max = attn.max(dim=1, keepdim=True)
-        attn = torch.cat([attn_max[0], attn], 1)
-        #
-        attn = attn.view(-1, 1, att_sze, att_sze)
-        attn = attn.repeat(1, 3, 1, 1).data.numpy()
-        # n x c x h x w --> n x h x w x c
-        attn = np.transpose(attn, (0, 2, 3, 1))
-        num_attn = attn.shape[0]
+        maps.append(torch.cat([attn_max[0], attn], 1)[0])
+    # --> num x (1 + seq_len) x vis_size x vis_size
+    upsampled = upsample_attn_maps(maps, att_sze, vis_size)
+
+    bUpdate = 1
+    for i in range(num):
+        num_attn = maps[i].size(0)
         #
         img = real_imgs[i]
         if lr_imgs is None:
@@ -124,22 +149,10 @@ def build_super_images(real_imgs, captions, ixtoword,
             lrI = lr_imgs[i]
         row = [lrI, middle_pad]
         row_merge = [img, middle_pad]
-        row_beforeNorm = []
-        minVglobal, maxVglobal = 1, 0
-        for j in range(num_attn):
-            one_map = attn[j]
-            if (vis_size // att_sze) > 1:
-                one_map = \
-                    skimage.transform.pyramid_expand(one_map, sigma=20,
-                                                     upscale=vis_size // att_sze,
-                                                     multichannel=True)
-            row_beforeNorm.append(one_map)
-            minV = one_map.min()
-            maxV = one_map.max()
-            if minVglobal > minV:
-                minVglobal = minV
-            if maxVglobal < maxV:
-                maxVglobal = maxV
+        # n x h x w --> n x h x w x c
+        row_beforeNorm = np.repeat(upsampled[i, :num_attn, :, :, None], 3, 3)
+        minVglobal = min(1, row_beforeNorm.min())
+        maxVglobal = max(0, row_beforeNorm.max())
         for j in range(seq_len + 1):
             if j < num_attn:
                 one_map = row_beforeNorm[j]
@@ -179,6 +192,14 @@ def build_super_images(real_imgs, captions, ixtoword,
         return None
 
 
+def save_super_images(fullpath, *args, **kwargs):
+    # build_super_images(*args, **kwargs) and save it to fullpath
+    img_set, _ = build_super_images(*args, **kwargs)
+    if img_set is not None:
+        im = Image.fromarray(img_set)
+        im.save(fullpath)
+
+
 def build_super_images2(real_imgs, captions, cap_lens, ixtoword,
                         attn_maps, att_sze, vis_size=256, topK=5):
     batch_size = real_imgs.size(0)
@@ -206,34 +227,31 @@ def build_super_images2(real_imgs, captions, cap_lens, ixtoword,
         drawCaption(text_convas, captions, ixtoword, vis_size, off1=0)
     text_map = np.asarray(text_map).astype(np.uint8)
 
+    # keep the confident attention of every word, then upsample all at once
+    maps = []
+    conf_scores = []
+    for i in range(num):
+        attn = attn_maps[i].detach().cpu().float().view(-1, att_sze, att_sze)
+        attn = attn[:cap_lens[i]]
+        thresh = 2. / float(cap_lens[i])
+        conf_scores.append((attn * (attn > 2. * thresh).float())
+                           .sum(2).sum(1).numpy())
+        maps.append(attn * (attn > thresh).float())
+    upsampled = upsample_attn_maps(maps, att_sze, vis_size)
+
     bUpdate = 1
     for i in range(num):
-        attn = attn_maps[i].cpu().view(1, -1, att_sze, att_sze)
-        #
-        attn = attn.view(-1, 1, att_sze, att_sze)
-        attn = attn.repeat(1, 3, 1, 1).data.numpy()
-        # n x c x h x w --> n x h x w x c
-        attn = np.transpose(attn, (0, 2, 3, 1))
         num_attn = cap_lens[i]
-        thresh = 2./float(num_attn)
         #
         img = real_imgs[i]
         row = []
         row_merge = []
         row_txt = []
         row_beforeNorm = []
-        conf_score = []
+        conf_score = conf_scores[i]
         for j in range(num_attn):
-            one_map = attn[j]
-            mask0 = one_map > (2. * thresh)
-            conf_score.append(np.sum(one_map * mask0))
-            mask = one_map > thresh
-            one_map = one_map * mask
-            if (vis_size // att_sze) > 1:
-                one_map = \
-                    skimage.transform.pyramid_expand(one_map, sigma=20,
-                                                     upscale=vis_size // att_sze,
-                                                     multichannel=True)
+            # h x w --> h x w x c
+            one_map = np.repeat(upsampled[i, j, :, :, None], 3, 2)
             minV = one_map.min()
             maxV = one_map.max()
             one_map = (one_map - minV) / (maxV - minV)
@@ -301,16 +319,6 @@ def weights_init(m):
             m.bias.data.fill_(0.0)
 
 
-def load_params(model, new_param):
-    for p, new_p in zip(model.parameters(), new_param):
-        p.data.copy_(new_p)
-
-
-def copy_G_params(model):
-    flatten = deepcopy(list(p.data for p in model.parameters()))
-    return flatten
-
-
 def mkdir_p(path):
     try:
         os.makedirs(path)
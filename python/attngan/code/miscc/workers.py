@@ -0,0 +1,127 @@
+from __future__ import print_function
+
+import sys
+import time
+import threading
+import traceback
+from six.moves import queue
+
+import torch
+
+
+# Work kept off the training loop ##################################
+class BackgroundWorker(object):
+    """
+        Runs fn(*args) calls in a daemon thread, in submission order.
+        submit blocks once max_pending calls are waiting, so a slow
+        consumer cannot pile up tensors in memory.
+    """
+    def __init__(self, max_pending=4, name='background-worker'):
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                print('Error in %s:' % self.thread.name)
+                traceback.print_exc()
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def close(self):
+        # finish the pending calls
+        self.queue.put(None)
+        self.thread.join()
+
+
+def record_stream(batch, stream):
+    # tensors made on the prefetch stream are used on stream from now on
+    if torch.is_tensor(batch):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for item in batch:
+            record_stream(item, stream)
+
+
+class BatchPrefetcher(object):
+    """
+        Iterates prepare(batch) over loader with the next depth batches
+        loaded and prepared in a daemon thread while the current step
+        computes. With cuda the host to device copies run on a side
+        stream (use pin_memory and non_blocking copies in prepare).
+        depth=0 prepares every batch in the loop, for comparison.
+        wait_time is the time the loop spent blocked on the data.
+    """
+    def __init__(self, loader, prepare=None, depth=2, cuda=False):
+        self.iterator = iter(loader)
+        self.prepare = prepare if prepare is not None else (lambda x: x)
+        self.depth = depth
+        self.wait_time = 0.
+        self.last_wait = 0.
+        self.n_batches = 0
+        if depth > 0:
+            self.stream = None
+            if cuda:
+                # the current device is per thread
+                self.device = torch.cuda.current_device()
+                self.stream = torch.cuda.Stream()
+            self.queue = queue.Queue(depth)
+            self.thread = threading.Thread(target=self.run,
+                                           name='batch-prefetcher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        try:
+            if self.stream is not None:
+                torch.cuda.set_device(self.device)
+            for data in self.iterator:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self.prepare(data)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = self.prepare(data)
+                self.queue.put((batch, event, None))
+        except Exception:
+            self.queue.put((None, None, sys.exc_info()))
+        self.queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_t = time.time()
+        if self.depth > 0:
+            item = self.queue.get()
+            if item is None:
+                self.queue.put(None)
+                raise StopIteration
+            batch, event, exc_info = item
+            if exc_info is not None:
+                self.queue.put(None)
+                raise exc_info[1]
+            if event is not None:
+                stream = torch.cuda.current_stream()
+                stream.wait_event(event)
+                record_stream(batch, stream)
+        else:
+            batch = self.prepare(next(self.iterator))
+        self.last_wait = time.time() - start_t
+        self.wait_time += self.last_wait
+        self.n_batches += 1
+        return batch
+
+    next = __next__
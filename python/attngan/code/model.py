@@ -149,7 +149,8 @@ class RNN_ENCODER(nn.Module):
         #
         # Returns: a PackedSequence object
         cap_lens = cap_lens.data.tolist()
-        emb = pack_padded_sequence(emb, cap_lens, batch_first=True)
+        emb = pack_padded_sequence(emb, cap_lens, batch_first=True,
+                                   enforce_sorted=False)
         # #hidden and memory (num_layers * num_directions, batch, hidden_size):
         # tensor containing the initial hidden state for each element in batch.
         # #output (batch, seq_len, hidden_size * num_directions)
@@ -296,18 +297,22 @@ class CA_NET(nn.Module):
         logvar = x[:, self.c_dim:]
         return mu, logvar
 
-    def reparametrize(self, mu, logvar):
+    def reparametrize(self, mu, logvar, eps=None):
         std = logvar.mul(0.5).exp_()
-        if cfg.CUDA:
-            eps = torch.cuda.FloatTensor(std.size()).normal_()
-        else:
-            eps = torch.FloatTensor(std.size()).normal_()
-        eps = Variable(eps)
+        if eps is None:
+            # on the device of the model, whatever cfg.CUDA says
+            eps = Variable(std.new(std.size()).normal_())
         return eps.mul(std).add_(mu)
 
-    def forward(self, text_embedding):
+    def forward(self, text_embedding, n_samples=1, eps=None):
+        # n_samples codes per embedding, encoded once and expanded, the
+        # codes of an embedding next to each other; eps: fixed noise of
+        # every code, drawn here if None
         mu, logvar = self.encode(text_embedding)
-        c_code = self.reparametrize(mu, logvar)
+        if n_samples > 1:
+            mu = mu.repeat_interleave(n_samples, 0)
+            logvar = logvar.repeat_interleave(n_samples, 0)
+        c_code = self.reparametrize(mu, logvar, eps)
         return c_code, mu, logvar
 
 
@@ -370,19 +375,19 @@ class NEXT_STAGE_G(nn.Module):
 
     def define_module(self):
         ngf = self.gf_dim
-        self.att = ATT_NET(ngf, self.ef_dim)
+        self.att = ATT_NET(ngf, self.ef_dim, cfg.GAN.ATT_CHUNK_SIZE)
         self.residual = self._make_layer(ResBlock, ngf * 2)
         self.upsample = upBlock(ngf * 2, ngf)
 
-    def forward(self, h_code, c_code, word_embs, mask):
+    def forward(self, h_code, c_code, word_embs, mask, return_att=True):
         """
             h_code1(query):  batch x idf x ih x iw (queryL=ihxiw)
             word_embs(context): batch x cdf x sourceL (sourceL=seq_len)
             c_code1: batch x idf x queryL
-            att1: batch x sourceL x queryL
+            att1: batch x sourceL x queryL, None if not return_att
         """
         self.att.applyMask(mask)
-        c_code, att = self.att(h_code, word_embs)
+        c_code, att = self.att(h_code, word_embs, return_att)
         h_c_code = torch.cat((h_code, c_code), 1)
         out_code = self.residual(h_c_code)
 
@@ -425,17 +430,27 @@ class G_NET(nn.Module):
             self.h_net3 = NEXT_STAGE_G(ngf, nef, ncf)
             self.img_net3 = GET_IMAGE_G(ngf)
 
-    def forward(self, z_code, sent_emb, word_embs, mask):
+    def forward(self, z_code, sent_emb, word_embs, mask, return_att=True,
+                n_samples=1, eps=None):
         """
-            :param z_code: batch x cfg.GAN.Z_DIM
+            :param z_code: (batch x n_samples) x cfg.GAN.Z_DIM
             :param sent_emb: batch x cfg.TEXT.EMBEDDING_DIM
             :param word_embs: batch x cdf x seq_len
             :param mask: batch x seq_len
+            :param return_att: False for inference without the attention
+                maps, att_maps is then empty
+            :param n_samples: images per caption, the caption inputs are
+                expanded to the rows of z_code that follow each other
+            :param eps: (batch x n_samples) x cfg.GAN.CONDITION_DIM, the
+                noise of CA_NET, drawn there if None
             :return:
         """
         fake_imgs = []
         att_maps = []
-        c_code, mu, logvar = self.ca_net(sent_emb)
+        c_code, mu, logvar = self.ca_net(sent_emb, n_samples, eps)
+        if n_samples > 1:
+            word_embs = word_embs.repeat_interleave(n_samples, 0)
+            mask = mask.repeat_interleave(n_samples, 0)
 
         if cfg.TREE.BRANCH_NUM > 0:
             h_code1 = self.h_net1(z_code, c_code)
@@ -443,14 +458,14 @@ class G_NET(nn.Module):
             fake_imgs.append(fake_img1)
         if cfg.TREE.BRANCH_NUM > 1:
             h_code2, att1 = \
-                self.h_net2(h_code1, c_code, word_embs, mask)
+                self.h_net2(h_code1, c_code, word_embs, mask, return_att)
             fake_img2 = self.img_net2(h_code2)
             fake_imgs.append(fake_img2)
             if att1 is not None:
                 att_maps.append(att1)
         if cfg.TREE.BRANCH_NUM > 2:
             h_code3, att2 = \
-                self.h_net3(h_code2, c_code, word_embs, mask)
+                self.h_net3(h_code2, c_code, word_embs, mask, return_att)
             fake_img3 = self.img_net3(h_code3)
             fake_imgs.append(fake_img3)
             if att2 is not None:
@@ -478,24 +493,29 @@ class G_DCGAN(nn.Module):
             self.h_net3 = NEXT_STAGE_G(ngf, nef, ncf)
         self.img_net = GET_IMAGE_G(ngf)
 
-    def forward(self, z_code, sent_emb, word_embs, mask):
+    def forward(self, z_code, sent_emb, word_embs, mask, return_att=True,
+                n_samples=1, eps=None):
         """
-            :param z_code: batch x cfg.GAN.Z_DIM
+            :param z_code: (batch x n_samples) x cfg.GAN.Z_DIM
             :param sent_emb: batch x cfg.TEXT.EMBEDDING_DIM
             :param word_embs: batch x cdf x seq_len
             :param mask: batch x seq_len
+            :param return_att, n_samples, eps: as in G_NET
             :return:
         """
         att_maps = []
-        c_code, mu, logvar = self.ca_net(sent_emb)
+        c_code, mu, logvar = self.ca_net(sent_emb, n_samples, eps)
+        if n_samples > 1:
+            word_embs = word_embs.repeat_interleave(n_samples, 0)
+            mask = mask.repeat_interleave(n_samples, 0)
         if cfg.TREE.BRANCH_NUM > 0:
             h_code = self.h_net1(z_code, c_code)
         if cfg.TREE.BRANCH_NUM > 1:
-            h_code, att1 = self.h_net2(h_code, c_code, word_embs, mask)
+            h_code, att1 = self.h_net2(h_code, c_code, word_embs, mask, return_att)
             if att1 is not None:
                 att_maps.append(att1)
         if cfg.TREE.BRANCH_NUM > 2:
-            h_code, att2 = self.h_net3(h_code, c_code, word_embs, mask)
+            h_code, att2 = self.h_net3(h_code, c_code, word_embs, mask, return_att)
             if att2 is not None:
                 att_maps.append(att2)
 
@@ -2,10 +2,11 @@ from __future__ import print_function
 
 from miscc.utils import mkdir_p
 from miscc.utils import build_super_images
-from miscc.losses import sent_loss, words_loss
+from miscc.losses import sent_loss, words_loss, class_masks
 from miscc.config import cfg, cfg_from_file
+from miscc.image_cache import ImageCache, load_size_for
 
-from datasets import TextDataset
+from datasets import TextDataset, BucketBatchSampler
 from datasets import prepare_data
 
 from model import RNN_ENCODER, CNN_ENCODER
@@ -46,6 +47,19 @@ def parse_args():
     return args
 
 
+def make_dataloader(dataset, batch_size):
+    if cfg.TRAIN.BUCKET_POOL > 0:
+        # batches of similar caption lengths
+        batch_sampler = BucketBatchSampler(dataset.caption_lengths(),
+                                           batch_size, cfg.TRAIN.BUCKET_POOL)
+        return torch.utils.data.DataLoader(
+            dataset, batch_sampler=batch_sampler,
+            num_workers=int(cfg.WORKERS))
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, drop_last=True,
+        shuffle=True, num_workers=int(cfg.WORKERS))
+
+
 def train(dataloader, cnn_model, rnn_model, batch_size,
           labels, optimizer, epoch, ixtoword, image_dir):
     cnn_model.train()
@@ -55,15 +69,20 @@ def train(dataloader, cnn_model, rnn_model, batch_size,
     w_total_loss0 = 0
     w_total_loss1 = 0
     count = (epoch + 1) * len(dataloader)
+    n_tokens = 0
+    n_padded = 0
     start_time = time.time()
     for step, data in enumerate(dataloader, 0):
         # print('step', step)
         rnn_model.zero_grad()
         cnn_model.zero_grad()
+        # words the LSTM reads, and words it runs over with the padding
+        n_tokens += int(data[2].sum())
+        n_padded += int(data[2].max()) * len(data[2])
 
         imgs, captions, cap_lens, \
             class_ids, keys = prepare_data(data)
-
+        masks = class_masks(class_ids)
 
         # words_features: batch_size x nef x 17 x 17
         # sent_code: batch_size x nef
@@ -78,13 +97,13 @@ def train(dataloader, cnn_model, rnn_model, batch_size,
         words_emb, sent_emb = rnn_model(captions, cap_lens, hidden)
 
         w_loss0, w_loss1, attn_maps = words_loss(words_features, words_emb, labels,
-                                                 cap_lens, class_ids, batch_size)
+                                                 cap_lens, masks, batch_size)
         w_total_loss0 += w_loss0.data
         w_total_loss1 += w_loss1.data
         loss = w_loss0 + w_loss1
 
         s_loss0, s_loss1 = \
-            sent_loss(sent_code, sent_emb, labels, class_ids, batch_size)
+            sent_loss(sent_code, sent_emb, labels, masks, batch_size)
         loss += s_loss0 + s_loss1
         s_total_loss0 += s_loss0.data
         s_total_loss1 += s_loss1.data
@@ -108,12 +127,17 @@ def train(dataloader, cnn_model, rnn_model, batch_size,
 
             elapsed = time.time() - start_time
             print('| epoch {:3d} | {:5d}/{:5d} batches | ms/batch {:5.2f} | '
+                  'tokens/s {:7.0f} | padding {:4.1f}% | '
                   's_loss {:5.2f} {:5.2f} | '
                   'w_loss {:5.2f} {:5.2f}'
                   .format(epoch, step, len(dataloader),
                           elapsed * 1000. / UPDATE_INTERVAL,
+                          n_tokens / elapsed,
+                          100. * (1 - n_tokens / float(n_padded)),
                           s_cur_loss0, s_cur_loss1,
                           w_cur_loss0, w_cur_loss1))
+            n_tokens = 0
+            n_padded = 0
             s_total_loss0 = 0
             s_total_loss1 = 0
             w_total_loss0 = 0
@@ -138,6 +162,7 @@ def evaluate(dataloader, cnn_model, rnn_model, batch_size):
     for step, data in enumerate(dataloader, 0):
         real_imgs, captions, cap_lens, \
                 class_ids, keys = prepare_data(data)
+        masks = class_masks(class_ids)
 
         words_features, sent_code = cnn_model(real_imgs[-1])
         # nef = words_features.size(1)
@@ -147,11 +172,11 @@ def evaluate(dataloader, cnn_model, rnn_model, batch_size):
         words_emb, sent_emb = rnn_model(captions, cap_lens, hidden)
 
         w_loss0, w_loss1, attn = words_loss(words_features, words_emb, labels,
-                                            cap_lens, class_ids, batch_size)
+                                            cap_lens, masks, batch_size)
         w_total_loss += (w_loss0 + w_loss1).data
 
         s_loss0, s_loss1 = \
-            sent_loss(sent_code, sent_emb, labels, class_ids, batch_size)
+            sent_loss(sent_code, sent_emb, labels, masks, batch_size)
         s_total_loss += (s_loss0 + s_loss1).data
 
         if step == 50:
@@ -239,23 +264,26 @@ if __name__ == "__main__":
         transforms.RandomCrop(imsize),
         transforms.RandomHorizontalFlip()])
     print(cfg.DATA_DIR)
+    image_caches = {'train': None, 'test': None}
+    if cfg.TREE.IMG_CACHE != '':
+        for split in image_caches:
+            image_caches[split] = ImageCache(os.path.join(cfg.TREE.IMG_CACHE, split),
+                                             load_size_for(imsize))
     dataset = TextDataset(cfg.DATA_DIR, 'train',
                           base_size=cfg.TREE.BASE_SIZE,
-                          transform=image_transform)
+                          transform=image_transform,
+                          image_cache=image_caches['train'])
 
     print(dataset.n_words, dataset.embeddings_num)
     assert dataset
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, drop_last=True,
-        shuffle=True, num_workers=int(cfg.WORKERS))
+    dataloader = make_dataloader(dataset, batch_size)
 
     # # validation data #
     dataset_val = TextDataset(cfg.DATA_DIR, 'test',
                               base_size=cfg.TREE.BASE_SIZE,
-                              transform=image_transform)
-    dataloader_val = torch.utils.data.DataLoader(
-        dataset_val, batch_size=batch_size, drop_last=True,
-        shuffle=True, num_workers=int(cfg.WORKERS))
+                              transform=image_transform,
+                              image_cache=image_caches['test'])
+    dataloader_val = make_dataloader(dataset_val, batch_size)
 
     # Train ##############################################################
     text_encoder, image_encoder, labels, start_epoch = build_models()
@@ -11,19 +11,30 @@ from PIL import Image
 
 from miscc.config import cfg
 from miscc.utils import mkdir_p
-from miscc.utils import build_super_images, build_super_images2
-from miscc.utils import weights_init, load_params, copy_G_params
+from miscc.utils import build_super_images2, save_super_images
+from miscc.workers import BackgroundWorker, BatchPrefetcher
+from miscc.utils import weights_init
+from miscc.ema import ModelEMA
+from miscc.metrics import MetricsSink
+from inference import InferenceEngine, default_device
 from model import G_DCGAN, G_NET
 from datasets import prepare_data
 from model import RNN_ENCODER, CNN_ENCODER
 
-from miscc.losses import words_loss
+from miscc.losses import words_loss, class_masks
 from miscc.losses import discriminator_loss, generator_loss, KL_loss
 import os
 import time
 import numpy as np
 import sys
 
+def prepare_batch(data):
+    # words the text encoder reads, and words it runs over
+    cap_lens = data[2]
+    return prepare_data(data), \
+        int(cap_lens.sum()), int(cap_lens.max()) * len(cap_lens)
+
+
 # ################# Text to image task############################ #
 class condGANTrainer(object):
     def __init__(self, output_dir, data_loader, n_words, ixtoword):
@@ -33,8 +44,9 @@ class condGANTrainer(object):
             mkdir_p(self.model_dir)
             mkdir_p(self.image_dir)
 
-        torch.cuda.set_device(cfg.GPU_ID)
-        cudnn.benchmark = True
+        if cfg.CUDA:
+            torch.cuda.set_device(cfg.GPU_ID)
+            cudnn.benchmark = True
 
         self.batch_size = cfg.TRAIN.BATCH_SIZE
         self.max_epoch = cfg.TRAIN.MAX_EPOCH
@@ -156,12 +168,10 @@ class condGANTrainer(object):
 
         return real_labels, fake_labels, match_labels
 
-    def save_model(self, netG, avg_param_G, netsD, epoch):
-        backup_para = copy_G_params(netG)
-        load_params(netG, avg_param_G)
-        torch.save(netG.state_dict(),
+    def save_model(self, ema_G, netsD, epoch):
+        # the generator is saved with its averaged parameters
+        torch.save(ema_G.state_dict(),
             '%s/netG_epoch_%d.pth' % (self.model_dir, epoch))
-        load_params(netG, backup_para)
         #
         for i in range(len(netsD)):
             netD = netsD[i]
@@ -177,8 +187,9 @@ class condGANTrainer(object):
     def save_img_results(self, netG, noise, sent_emb, words_embs, mask,
                          image_encoder, captions, cap_lens,
                          gen_iterations, name='current'):
-        # Save images
+        # Save images, rendered by self.vis_worker off the training loop
         fake_imgs, attention_maps, _, _ = netG(noise, sent_emb, words_embs, mask)
+        captions = captions.cpu()
         for i in range(len(attention_maps)):
             if len(fake_imgs) > 1:
                 img = fake_imgs[i + 1].detach().cpu()
@@ -186,16 +197,13 @@ class condGANTrainer(object):
             else:
                 img = fake_imgs[0].detach().cpu()
                 lr_img = None
-            attn_maps = attention_maps[i]
+            attn_maps = attention_maps[i].detach().cpu()
             att_sze = attn_maps.size(2)
-            img_set, _ = \
-                build_super_images(img, captions, self.ixtoword,
-                                   attn_maps, att_sze, lr_imgs=lr_img)
-            if img_set is not None:
-                im = Image.fromarray(img_set)
-                fullpath = '%s/G_%s_%d_%d.png'\
-                    % (self.image_dir, name, gen_iterations, i)
-                im.save(fullpath)
+            fullpath = '%s/G_%s_%d_%d.png'\
+                % (self.image_dir, name, gen_iterations, i)
+            self.vis_worker.submit(save_super_images, fullpath,
+                                   img, captions, self.ixtoword,
+                                   attn_maps, att_sze, lr_img)
 
         # for i in range(len(netsD)):
         i = -1
@@ -206,18 +214,18 @@ class condGANTrainer(object):
                                     words_embs.detach(),
                                     None, cap_lens,
                                     None, self.batch_size)
-        img_set, _ = \
-            build_super_images(fake_imgs[i].detach().cpu(),
-                               captions, self.ixtoword, att_maps, att_sze)
-        if img_set is not None:
-            im = Image.fromarray(img_set)
-            fullpath = '%s/D_%s_%d.png'\
-                % (self.image_dir, name, gen_iterations)
-            im.save(fullpath)
+        att_maps = [attn.detach().cpu() for attn in att_maps]
+        fullpath = '%s/D_%s_%d.png'\
+            % (self.image_dir, name, gen_iterations)
+        self.vis_worker.submit(save_super_images, fullpath,
+                               img.cpu(), captions, self.ixtoword,
+                               att_maps, att_sze)
 
     def train(self):
         text_encoder, image_encoder, netG, netsD, start_epoch = self.build_models()
-        avg_param_G = copy_G_params(netG)
+        ema_G = ModelEMA(netG, decay=0.999)
+        # renders the attention visualizations of save_img_results
+        self.vis_worker = BackgroundWorker()
         optimizerG, optimizersD = self.define_optimizers(netG, netsD)
         real_labels, fake_labels, match_labels = self.prepare_labels()
 
@@ -228,12 +236,21 @@ class condGANTrainer(object):
         if cfg.CUDA:
             noise, fixed_noise = noise.cuda(), fixed_noise.cuda()
 
+        # per-phase timings, a no-op unless cfg.TRAIN.METRICS is set
+        metrics = MetricsSink(cfg.TRAIN.METRICS, run=cfg.CONFIG_NAME,
+                              interval=cfg.TRAIN.METRICS_INTERVAL,
+                              sync=cfg.CUDA).activate()
+
         gen_iterations = 0
         # gen_iterations = start_epoch * self.num_batches
         for epoch in range(start_epoch, self.max_epoch + 1):
             start_t = time.time()
+            n_tokens = 0
+            n_padded = 0
 
-            data_iter = iter(self.data_loader)
+            # batch k + 1 is loaded and copied while step k computes
+            data_iter = BatchPrefetcher(self.data_loader, prepare_batch,
+                                        cfg.TRAIN.PREFETCH, cfg.CUDA)
             step = 0
             while step < self.num_batches:
                 # reset requires_grad to be trainable for all Ds
@@ -242,14 +259,24 @@ class condGANTrainer(object):
                 ######################################################
                 # (1) Prepare training data and Compute text embeddings
                 ######################################################
-                data = data_iter.next()
-                imgs, captions, cap_lens, class_ids, keys = prepare_data(data)
-
-                hidden = text_encoder.init_hidden(batch_size)
-                # words_embs: batch_size x nef x seq_len
-                # sent_emb: batch_size x nef
-                words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
-                words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
+                with metrics.phase('data'):
+                    data, tokens, padded = data_iter.next()
+                n_tokens += tokens
+                n_padded += padded
+                imgs, captions, cap_lens, class_ids, keys = data[:5]
+                # same-class mis-match pairs: batch_size x batch_size
+                masks = class_masks(class_ids)
+
+                if len(data) > 5:
+                    # precomputed by the frozen text encoder
+                    words_embs, sent_emb = data[5], data[6]
+                else:
+                    with metrics.phase('text_encode'):
+                        hidden = text_encoder.init_hidden(batch_size)
+                        # words_embs: batch_size x nef x seq_len
+                        # sent_emb: batch_size x nef
+                        words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
+                        words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
                 mask = (captions == 0)
                 num_words = words_embs.size(2)
                 if mask.size(1) > num_words:
@@ -258,23 +285,26 @@ class condGANTrainer(object):
                 #######################################################
                 # (2) Generate fake images
                 ######################################################
-                noise.data.normal_(0, 1)
-                fake_imgs, _, mu, logvar = netG(noise, sent_emb, words_embs, mask)
+                with metrics.phase('g_forward'):
+                    noise.data.normal_(0, 1)
+                    fake_imgs, _, mu, logvar = netG(noise, sent_emb, words_embs, mask)
 
                 #######################################################
                 # (3) Update D network
                 ######################################################
                 errD_total = 0
                 D_logs = ''
-                for i in range(len(netsD)):
-                    netsD[i].zero_grad()
-                    errD = discriminator_loss(netsD[i], imgs[i], fake_imgs[i],
-                                              sent_emb, real_labels, fake_labels)
-                    # backward and update parameters
-                    errD.backward()
-                    optimizersD[i].step()
-                    errD_total += errD
-                    D_logs += 'errD%d: %.2f ' % (i, errD.item())
+                with metrics.phase('d_step'):
+                    for i in range(len(netsD)):
+                        netsD[i].zero_grad()
+                        errD = discriminator_loss(netsD[i], imgs[i], fake_imgs[i],
+                                                  sent_emb, real_labels, fake_labels,
+                                                  masks)
+                        # backward and update parameters
+                        errD.backward()
+                        optimizersD[i].step()
+                        errD_total += errD
+                        D_logs += 'errD%d: %.2f ' % (i, errD.item())
 
                 #######################################################
                 # (4) Update G network: maximize log(D(G(z)))
@@ -285,29 +315,31 @@ class condGANTrainer(object):
 
                 # do not need to compute gradient for Ds
                 # self.set_requires_grad_value(netsD, False)
-                netG.zero_grad()
-                errG_total, G_logs = \
-                    generator_loss(netsD, image_encoder, fake_imgs, real_labels,
-                                   words_embs, sent_emb, match_labels, cap_lens, class_ids)
-                kl_loss = KL_loss(mu, logvar)
-                errG_total += kl_loss
-                G_logs += 'kl_loss: %.2f ' % kl_loss.item()
-                # backward and update parameters
-                errG_total.backward()
-                optimizerG.step()
-                for p, avg_p in zip(netG.parameters(), avg_param_G):
-                    avg_p.mul_(0.999).add_(0.001, p.data)
-
-                if gen_iterations % 100 == 0:
-                    print(D_logs + '\n' + G_logs)
-                # save images
-                if gen_iterations % 1000 == 0:
-                    backup_para = copy_G_params(netG)
-                    load_params(netG, avg_param_G)
-                    self.save_img_results(netG, fixed_noise, sent_emb,
-                                          words_embs, mask, image_encoder,
-                                          captions, cap_lens, epoch, name='average')
-                    load_params(netG, backup_para)
+                with metrics.phase('g_step'):
+                    netG.zero_grad()
+                    # the DAMSM part is timed as 'damsm' inside generator_loss
+                    errG_total, G_logs = \
+                        generator_loss(netsD, image_encoder, fake_imgs, real_labels,
+                                       words_embs, sent_emb, match_labels, cap_lens, masks)
+                    kl_loss = KL_loss(mu, logvar)
+                    errG_total += kl_loss
+                    G_logs += 'kl_loss: %.2f ' % kl_loss.item()
+                    # backward and update parameters
+                    errG_total.backward()
+                    optimizerG.step()
+                    ema_G.update()
+
+                with metrics.phase('logging'):
+                    if gen_iterations % 100 == 0:
+                        G_logs += 'data_wait: %.2fms ' % (data_iter.last_wait * 1000.)
+                        print(D_logs + '\n' + G_logs)
+                    # save images
+                    if gen_iterations % 1000 == 0:
+                        with ema_G.average_parameters():
+                            self.save_img_results(netG, fixed_noise, sent_emb,
+                                                  words_embs, mask, image_encoder,
+                                                  captions, cap_lens, epoch, name='average')
+                metrics.step(batch_size)
                     #
                     # self.save_img_results(netG, fixed_noise, sent_emb,
                     #                       words_embs, mask, image_encoder,
@@ -316,18 +348,25 @@ class condGANTrainer(object):
             end_t = time.time()
 
             print('''[%d/%d][%d]
-                  Loss_D: %.2f Loss_G: %.2f Time: %.2fs'''
+                  Loss_D: %.2f Loss_G: %.2f Time: %.2fs
+                  Tokens/s: %.0f Padding: %.1f%%
+                  Data wait: %.2fms/step (%.1f%%)'''
                   % (epoch, self.max_epoch, self.num_batches,
                      errD_total.item(), errG_total.item(),
-                     end_t - start_t))
+                     end_t - start_t, n_tokens / (end_t - start_t),
+                     100. * (1 - n_tokens / float(n_padded)),
+                     data_iter.wait_time * 1000. / max(data_iter.n_batches, 1),
+                     100. * data_iter.wait_time / (end_t - start_t)))
             f_out = open('gen_train.csv', 'a')
             f_out.write('{:d}, {:.5f}, {:.5f}\n'.format( epoch, errD_total.item(), errG_total.item() ))
             f_out.close()
 
             if epoch % cfg.TRAIN.SNAPSHOT_INTERVAL == 0:  # and epoch != 0:
-                self.save_model(netG, avg_param_G, netsD, epoch)
+                self.save_model(ema_G, netsD, epoch)
 
-        self.save_model(netG, avg_param_G, netsD, self.max_epoch)
+        self.save_model(ema_G, netsD, self.max_epoch)
+        self.vis_worker.close()
+        metrics.close()
 
     def save_singleimages(self, images, filenames, save_dir,
                           split_dir, sentenceID=0):
@@ -354,36 +393,13 @@ class condGANTrainer(object):
         else:
             if split_dir == 'test':
                 split_dir = 'valid'
-            # Build and load the generator
-            if cfg.GAN.B_DCGAN:
-                netG = G_DCGAN()
-            else:
-                netG = G_NET()
-            netG.apply(weights_init)
-            netG.cuda()
-            netG.eval()
-            #
-            text_encoder = RNN_ENCODER(self.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
-            state_dict = \
-                torch.load(cfg.TRAIN.NET_E, map_location=lambda storage, loc: storage)
-            text_encoder.load_state_dict(state_dict)
-            print('Load text encoder from:', cfg.TRAIN.NET_E)
-            text_encoder = text_encoder.cuda()
-            text_encoder.eval()
+            # Build and load the text encoder and the generator
+            engine = InferenceEngine(self.n_words, default_device(),
+                                     cfg.SAMPLE.INTRA_THREADS, cfg.SAMPLE.INTER_THREADS)
 
             batch_size = self.batch_size
-            nz = cfg.GAN.Z_DIM
-
-            with torch.no_grad():
-                noise = Variable(torch.FloatTensor(batch_size, nz))
-                noise = noise.cuda()
-
+            n_samples = cfg.SAMPLE.N_SAMPLES
             model_dir = cfg.TRAIN.NET_G
-            state_dict = \
-                torch.load(model_dir, map_location=lambda storage, loc: storage)
-            # state_dict = torch.load(cfg.TRAIN.NET_G)
-            netG.load_state_dict(state_dict)
-            print('Load G from: ', model_dir)
 
             # the path to save generated images
             s_tmp = model_dir[:model_dir.rfind('.pth')]
@@ -402,103 +418,79 @@ class condGANTrainer(object):
 
                     imgs, captions, cap_lens, class_ids, keys = prepare_data(data)
 
-                    hidden = text_encoder.init_hidden(batch_size)
-                    # words_embs: batch_size x nef x seq_len
-                    # sent_emb: batch_size x nef
-                    words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
-                    words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
-                    mask = (captions == 0)
-                    num_words = words_embs.size(2)
-                    if mask.size(1) > num_words:
-                        mask = mask[:, :num_words]
-
                     #######################################################
-                    # (2) Generate fake images
+                    # (1) Encode the captions and generate fake images
                     ######################################################
-                    noise.data.normal_(0, 1)
-                    fake_imgs, _, _, _ = netG(noise, sent_emb, words_embs, mask)
+                    # only the images are saved, no graph and no attention
+                    # maps keep the intermediate tensors alive
+                    seeds = None
+                    if cfg.SAMPLE.SEED >= 0:
+                        seeds = range(cfg.SAMPLE.SEED + cnt - batch_size,
+                                      cfg.SAMPLE.SEED + cnt)
                     for j in range(batch_size):
                         s_tmp = '%s/single/%s' % (save_dir, keys[j])
                         folder = s_tmp[:s_tmp.rfind('/')]
                         if not os.path.isdir(folder):
                             print('Make a new folder: ', folder)
                             mkdir_p(folder)
-                        k = -1
-                        # for k in range(len(fake_imgs)):
-                        im = fake_imgs[k][j].data.cpu().numpy()
-                        # [-1, 1] --> [0, 255]
-                        im = (im + 1.0) * 127.5
-                        im = im.astype(np.uint8)
-                        im = np.transpose(im, (1, 2, 0))
-                        im = Image.fromarray(im)
-                        fullpath = '%s_s%d.png' % (s_tmp, k)
-                        im.save(fullpath)
+                    k = -1
+                    # saved per netG pass, only the last stage is kept
+                    for rows, fake_imgs, _ in \
+                            engine.iter_generate(captions, cap_lens, n_samples, seeds,
+                                                 cfg.SAMPLE.TRUNCATION, cfg.SAMPLE.MAX_BATCH,
+                                                 stages=[k]):
+                        for r, row in enumerate(rows.tolist()):
+                            j, n = row // n_samples, row % n_samples
+                            s_tmp = '%s/single/%s' % (save_dir, keys[j])
+                            im = fake_imgs[0][r].numpy()
+                            # [-1, 1] --> [0, 255]
+                            im = (im + 1.0) * 127.5
+                            im = im.astype(np.uint8)
+                            im = np.transpose(im, (1, 2, 0))
+                            im = Image.fromarray(im)
+                            if n_samples == 1:
+                                fullpath = '%s_s%d.png' % (s_tmp, k)
+                            else:
+                                fullpath = '%s_s%d_%d.png' % (s_tmp, k, n)
+                            im.save(fullpath)
 
     def gen_example(self, data_dic):
         if cfg.TRAIN.NET_G == '':
             print('Error: the path for morels is not found!')
         else:
-            # Build and load the generator
-            text_encoder = \
-                RNN_ENCODER(self.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
-            state_dict = \
-                torch.load(cfg.TRAIN.NET_E, map_location=lambda storage, loc: storage)
-            text_encoder.load_state_dict(state_dict)
-            print('Load text encoder from:', cfg.TRAIN.NET_E)
-            text_encoder = text_encoder.cuda()
-            text_encoder.eval()
-
+            # Build and load the text encoder and the generator
+            engine = InferenceEngine(self.n_words, default_device(),
+                                     cfg.SAMPLE.INTRA_THREADS, cfg.SAMPLE.INTER_THREADS)
             # the path to save generated images
-            if cfg.GAN.B_DCGAN:
-                netG = G_DCGAN()
-            else:
-                netG = G_NET()
             s_tmp = cfg.TRAIN.NET_G[:cfg.TRAIN.NET_G.rfind('.pth')]
-            model_dir = cfg.TRAIN.NET_G
-            state_dict = \
-                torch.load(model_dir, map_location=lambda storage, loc: storage)
-            netG.load_state_dict(state_dict)
-            print('Load G from: ', model_dir)
-            netG.cuda()
-            netG.eval()
             for key in data_dic:
                 save_dir = '%s/%s' % (s_tmp, key)
                 mkdir_p(save_dir)
                 captions, cap_lens, sorted_indices = data_dic[key]
 
                 batch_size = captions.shape[0]
-                nz = cfg.GAN.Z_DIM
+                n_samples = cfg.SAMPLE.N_SAMPLES
+                captions = torch.from_numpy(captions)
+                cap_lens = torch.from_numpy(cap_lens)
 
-                with torch.no_grad():
-                    captions = Variable(torch.from_numpy(captions))
-                    cap_lens = Variable(torch.from_numpy(cap_lens))
-
-                    captions = captions.cuda()
-                    cap_lens = cap_lens.cuda()
-
-                for i in range(1):  # 16
-                    with torch.no_grad():
-                        noise = Variable(torch.FloatTensor(batch_size, nz))
-                        noise = noise.cuda()
-                    #######################################################
-                    # (1) Extract text embeddings
-                    ######################################################
-                    hidden = text_encoder.init_hidden(batch_size)
-                    # words_embs: batch_size x nef x seq_len
-                    # sent_emb: batch_size x nef
-                    words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
-                    mask = (captions == 0)
-                    #######################################################
-                    # (2) Generate fake images
-                    ######################################################
-                    noise.data.normal_(0, 1)
-                    fake_imgs, attention_maps, _, _ = netG(noise, sent_emb, words_embs, mask)
-                    # G attention
-                    cap_lens_np = cap_lens.cpu().data.numpy()
-                    for j in range(batch_size):
+                #######################################################
+                # (1) Encode the captions and generate fake images,
+                # n_samples per caption
+                ######################################################
+                seeds = None
+                if cfg.SAMPLE.SEED >= 0:
+                    seeds = [cfg.SAMPLE.SEED + int(ix) for ix in sorted_indices]
+                # G attention, saved per netG pass
+                cap_lens_np = cap_lens.numpy()
+                for rows, fake_imgs, attention_maps in \
+                        engine.iter_generate(captions, cap_lens, n_samples, seeds,
+                                             cfg.SAMPLE.TRUNCATION, cfg.SAMPLE.MAX_BATCH,
+                                             return_att=True):
+                    for r, row in enumerate(rows.tolist()):
+                        j, i = row // n_samples, row % n_samples
                         save_name = '%s/%d_s_%d' % (save_dir, i, sorted_indices[j])
                         for k in range(len(fake_imgs)):
-                            im = fake_imgs[k][j].data.cpu().numpy()
+                            im = fake_imgs[k][r].numpy()
                             im = (im + 1.0) * 127.5
                             im = im.astype(np.uint8)
                             # print('im', im.shape)
@@ -510,16 +502,16 @@ class condGANTrainer(object):
 
                         for k in range(len(attention_maps)):
                             if len(fake_imgs) > 1:
-                                im = fake_imgs[k + 1].detach().cpu()
+                                im = fake_imgs[k + 1]
                             else:
-                                im = fake_imgs[0].detach().cpu()
+                                im = fake_imgs[0]
                             attn_maps = attention_maps[k]
                             att_sze = attn_maps.size(2)
                             img_set, sentences = \
-                                build_super_images2(im[j].unsqueeze(0),
+                                build_super_images2(im[r].unsqueeze(0),
                                                     captions[j].unsqueeze(0),
                                                     [cap_lens_np[j]], self.ixtoword,
-                                                    [attn_maps[j]], att_sze)
+                                                    [attn_maps[r]], att_sze)
                             if img_set is not None:
                                 im = Image.fromarray(img_set)
                                 fullpath = '%s_a%d.png' % (save_name, k)
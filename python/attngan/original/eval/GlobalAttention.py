@@ -74,15 +74,15 @@ class GlobalAttentionGeneral(nn.Module):
         super(GlobalAttentionGeneral, self).__init__()
         self.conv_context = conv1x1(cdf, idf)
         self.sm = nn.Softmax()
-        self.mask = None
 
-    def applyMask(self, mask):
-        self.mask = mask  # batch x sourceL
-
-    def forward(self, input, context):
+    def forward(self, input, context, return_att=True, mask=None):
         """
             input: batch x idf x ih x iw (queryL=ihxiw)
             context: batch x cdf x sourceL
+            mask: batch x sourceL, True at the padding words. An argument
+                and not module state, concurrent passes share the module
+            return_att: False returns None for the attention map, which
+                is then freed as soon as the context is computed
         """
         ih, iw = input.size(2), input.size(3)
         queryL = ih * iw
@@ -102,10 +102,14 @@ class GlobalAttentionGeneral(nn.Module):
         attn = torch.bmm(targetT, sourceT)
         # --> batch*queryL x sourceL
         attn = attn.view(batch_size*queryL, sourceL)
-        if self.mask is not None:
-            # batch_size x sourceL --> batch_size*queryL x sourceL
-            mask = self.mask.repeat(queryL, 1)
-            attn.data.masked_fill_(mask.data, -float('inf'))
+        if mask is not None:
+            # batch_size x sourceL --> batch_size*queryL x sourceL, row
+            # b*queryL + q is masked by caption b (repeat() would take
+            # caption (b*queryL + q) % batch_size)
+            mask = mask.unsqueeze(1).expand(batch_size, queryL, sourceL)
+            mask = mask.contiguous().view(batch_size * queryL, sourceL)
+            # out of place, so that the mask is part of a traced graph
+            attn = attn.masked_fill(mask, -float('inf'))
         attn = self.sm(attn)  # Eq. (2)
         # --> batch x queryL x sourceL
         attn = attn.view(batch_size, queryL, sourceL)
@@ -116,6 +120,8 @@ class GlobalAttentionGeneral(nn.Module):
         # --> batch x idf x queryL
         weightedContext = torch.bmm(sourceT, attn)
         weightedContext = weightedContext.view(batch_size, -1, ih, iw)
+        if not return_att:
+            return weightedContext, None
         attn = attn.view(batch_size, -1, ih, iw)
 
         return weightedContext, attn
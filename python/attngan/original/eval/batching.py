@@ -0,0 +1,131 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import threading
+from collections import deque
+
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+class _Request(object):
+    def __init__(self, item, size):
+        self.item = item
+        self.size = size
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchScheduler(object):
+    """
+        Coalesces the items submitted by concurrent callers into batches
+        for run_batch(items) --> [result per item], which is called from a
+        single worker thread. A batch is closed once it holds max_batch
+        rows (an item counts as size rows) or max_wait seconds after its
+        first item arrived, whichever comes first.
+        validate(item), if given, runs in the caller's thread and raises
+        for items that would fail, before they join a batch. A batch
+        that raises anyway is run again item by item, so that only the
+        failing items get the error.
+    """
+    def __init__(self, run_batch, max_batch=16, max_wait=0.01, window=1000,
+                 validate=None):
+        self.run_batch = run_batch
+        self.validate = validate
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        # latencies of the last window requests
+        self.latencies = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_rows = 0
+        self.start_t = time.time()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item, size=1):
+        # blocks until the batch holding item has run
+        if self.validate is not None:
+            self.validate(item)
+        request = _Request(item, size)
+        self.pending.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        batch = [self.pending.get()]
+        rows = batch[0].size
+        deadline = time.time() + self.max_wait
+        while rows < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += request.size
+        return batch, rows
+
+    def _loop(self):
+        while True:
+            batch, rows = self._collect()
+            try:
+                results = self.run_batch([request.item for request in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    # one bad item must not fail the others
+                    for request in batch:
+                        self._run_one(request)
+            end_t = time.time()
+            with self.lock:
+                self.n_batches += 1
+                self.n_rows += rows
+                self.n_requests += len(batch)
+                for request in batch:
+                    self.latencies.append(end_t - request.submitted)
+            for request in batch:
+                request.done.set()
+
+    def _run_one(self, request):
+        try:
+            request.result = self.run_batch([request.item])[0]
+        except Exception as e:
+            request.error = e
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            n_requests, n_batches, n_rows = \
+                self.n_requests, self.n_batches, self.n_rows
+        elapsed = time.time() - self.start_t
+        stats = {'requests': n_requests,
+                 'batches': n_batches,
+                 'mean_batch_rows': n_rows / max(n_batches, 1),
+                 'requests_per_sec': n_requests / elapsed}
+        if latencies:
+            stats['p50_ms'] = percentile(latencies, 50) * 1000.
+            stats['p99_ms'] = percentile(latencies, 99) * 1000.
+        return stats
+
+
+def percentile(sorted_values, q):
+    # nearest-rank percentile of an ascending list
+    index = int(round(q / 100. * (len(sorted_values) - 1)))
+    return sorted_values[index]
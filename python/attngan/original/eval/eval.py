@@ -7,21 +7,29 @@ import io
 import time
 import numpy as np
 from PIL import Image
-import torch.onnx
 from datetime import datetime
 from torch.autograd import Variable
 from miscc.config import cfg
 from miscc.utils import build_super_images2
 from model import RNN_ENCODER, G_NET
-from azure.storage.blob import BlockBlobService
+from functools import partial
+from contextlib import contextmanager
+from storage import AsyncUploader, AzureBlobStorage
+from result_cache import normalize_caption
 
 if sys.version_info[0] == 2:
     import cPickle as pickle
 else:
     import pickle
 
-from werkzeug.contrib.cache import SimpleCache
-cache = SimpleCache()
+@contextmanager
+def _volatile():
+    # before torch 0.4, Variable(volatile=True) already builds no graph
+    yield
+
+def no_grad():
+    # torch.no_grad() from torch 0.4 on, where volatile does nothing
+    return torch.no_grad() if hasattr(torch, 'no_grad') else _volatile()
 
 def vectorize_caption(wordtoix, caption, copies=2):
     # create caption vector
@@ -45,155 +53,279 @@ def vectorize_caption(wordtoix, caption, copies=2):
 
     return captions.astype(int), cap_lens.astype(int)
 
-def generate(caption, wordtoix, ixtoword, text_encoder, netG, blob_service, copies=2):
-    # load word vector
-    captions, cap_lens  = vectorize_caption(wordtoix, caption, copies)
-    n_words = len(wordtoix)
+def check_request(request, wordtoix):
+    # raises for a (caption, copies, ...) request netG cannot run
+    if request[1] < 1:
+        raise ValueError('copies has to be at least 1')
+    _, cap_lens = vectorize_caption(wordtoix, request[0], 1)
+    if cap_lens[0] == 0:
+        raise ValueError('caption has no known words: %r' % request[0])
+
+def prepare_inputs(requests, wordtoix, text_encoder, emb_cache=None, model='',
+                   config=None):
+    # requests: [(caption, copies, seed, ...)], the seed is optional
+    # and makes the noise, and so the images, reproducible.
+    # config: the options of the model (ModelEntry.config), cfg if None;
+    # a registry serves models of different configs from one process.
+    # Returns the netG inputs of all the copies of all the captions, the
+    # rows of request i start at offsets[i].
+    config = cfg if config is None else config
+    vectors = [vectorize_caption(wordtoix, request[0], request[1])
+               for request in requests]
+    # pack_padded_sequence wants the rows in a decreasing length order,
+    # the copies of a caption stay next to each other
+    order = sorted(range(len(requests)), key=lambda i: -vectors[i][1][0])
+    batch_size = sum(len(cap_lens) for _, cap_lens in vectors)
+    max_len = vectors[order[0]][1][0]
+
+    captions = np.zeros((batch_size, max_len), dtype=int)
+    cap_lens = np.zeros(batch_size, dtype=int)
+    offsets = {}
+    row = 0
+    for i in order:
+        caps, lens = vectors[i]
+        captions[row:row + len(lens), :caps.shape[1]] = caps
+        cap_lens[row:row + len(lens)] = lens
+        offsets[i] = row
+        row += len(lens)
+
+    # z and the conditioning augmentation noise of G_NET
+    nz = config.GAN.Z_DIM
+    ncf = config.GAN.CONDITION_DIM
+    noise = torch.FloatTensor(batch_size, nz).normal_(0, 1)
+    eps = torch.FloatTensor(batch_size, ncf).normal_(0, 1)
+    for i, request in enumerate(requests):
+        if len(request) > 2 and request[2] is not None:
+            copies = len(vectors[i][1])
+            rng = np.random.RandomState(request[2])
+            noise[offsets[i]:offsets[i] + copies] = \
+                torch.from_numpy(rng.randn(copies, nz).astype('float32'))
+            eps[offsets[i]:offsets[i] + copies] = \
+                torch.from_numpy(rng.randn(copies, ncf).astype('float32'))
 
-    # only one to generate
-    batch_size = captions.shape[0]
+    #######################################################
+    # (1) Extract text embeddings
+    #######################################################
+    # once per distinct caption, and not at all if emb_cache holds it
+    keys = [(model, normalize_caption(request[0])) for request in requests]
+    first = {}
+    for i in order:
+        first.setdefault(keys[i], i)
+    embs = {}
+    if emb_cache is not None:
+        for key in first:
+            value = emb_cache.get(key)
+            if value is not None:
+                embs[key] = value
+    missing = [key for key in sorted(first, key=lambda key: -vectors[first[key]][1][0])
+               if key not in embs]
+    if missing:
+        enc_lens = [vectors[first[key]][1][0] for key in missing]
+        enc_caps = np.zeros((len(missing), enc_lens[0]), dtype=int)
+        for n, key in enumerate(missing):
+            enc_caps[n, :enc_lens[n]] = vectors[first[key]][0][0]
+        enc_caps = Variable(torch.from_numpy(enc_caps), volatile=True)
+        enc_lens = Variable(torch.from_numpy(np.array(enc_lens, dtype=int)), volatile=True)
+        if config.CUDA:
+            enc_caps = enc_caps.cuda()
+            enc_lens = enc_lens.cuda()
+        hidden = text_encoder.init_hidden(len(missing))
+        words_embs, sent_emb = text_encoder(enc_caps, enc_lens, hidden)
+        for n, key in enumerate(missing):
+            cap_len = vectors[first[key]][1][0]
+            embs[key] = (words_embs[n, :, :cap_len].data.cpu(),
+                         sent_emb[n].data.cpu())
+            if emb_cache is not None:
+                emb_cache.put(key, embs[key])
+
+    nef = config.TEXT.EMBEDDING_DIM
+    words_embs = torch.zeros(batch_size, nef, max_len)
+    sent_emb = torch.zeros(batch_size, nef)
+    for i in order:
+        start, copies = offsets[i], len(vectors[i][1])
+        words_emb, sent = embs[keys[i]]
+        words_embs[start:start + copies, :, :words_emb.size(1)] = \
+            words_emb.unsqueeze(0).expand(copies, nef, words_emb.size(1))
+        sent_emb[start:start + copies] = sent.unsqueeze(0).expand(copies, nef)
 
-    nz = cfg.GAN.Z_DIM
     captions = Variable(torch.from_numpy(captions), volatile=True)
     cap_lens = Variable(torch.from_numpy(cap_lens), volatile=True)
-    noise = Variable(torch.FloatTensor(batch_size, nz), volatile=True)
+    noise = Variable(noise, volatile=True)
+    eps = Variable(eps, volatile=True)
+    words_embs = Variable(words_embs, volatile=True)
+    sent_emb = Variable(sent_emb, volatile=True)
 
-    if cfg.CUDA:
+    if config.CUDA:
         captions = captions.cuda()
         cap_lens = cap_lens.cuda()
         noise = noise.cuda()
-
-    
-
-    #######################################################
-    # (1) Extract text embeddings
-    #######################################################
-    hidden = text_encoder.init_hidden(batch_size)
-    words_embs, sent_emb = text_encoder(captions, cap_lens, hidden)
+        eps = eps.cuda()
+        words_embs = words_embs.cuda()
+        sent_emb = sent_emb.cuda()
     mask = (captions == 0)
-        
+
+    copies = [len(cap_lens) for _, cap_lens in vectors]
+    return noise, eps, sent_emb, words_embs, mask, captions, cap_lens, offsets, copies
+
+def generate_batch(requests, wordtoix, text_encoder, netG, emb_cache=None, model='',
+                   return_att=True, config=None):
+    # requests: [(caption, copies)], [(caption, copies, seed)] or
+    # [(caption, copies, seed, max_stage)], all the copies of all the
+    # captions run through netG in one forward pass
+    with no_grad():
+        return _generate_batch(requests, wordtoix, text_encoder, netG, emb_cache, model,
+                               return_att, config)
+
+def _generate_batch(requests, wordtoix, text_encoder, netG, emb_cache, model, return_att,
+                    config):
+    noise, eps, sent_emb, words_embs, mask, captions, cap_lens, offsets, copies = \
+        prepare_inputs(requests, wordtoix, text_encoder, emb_cache, model, config)
+    max_stages = [request[3] if len(request) > 3 else None for request in requests]
+    max_stage = None if None in max_stages else max(max_stages)
 
     #######################################################
     # (2) Generate fake images
     #######################################################
-    noise.data.normal_(0, 1)
-    fake_imgs, attention_maps, _, _ = netG(noise, sent_emb, words_embs, mask)
-
-    # ONNX EXPORT
-    #export = os.environ["EXPORT_MODEL"].lower() == 'true'
-    if False:
-        print("saving text_encoder.onnx")
-        text_encoder_out = torch.onnx._export(text_encoder, (captions, cap_lens, hidden), "text_encoder.onnx", export_params=True)
-        print("uploading text_encoder.onnx")
-        blob_service.create_blob_from_path('models', "text_encoder.onnx", os.path.abspath("text_encoder.onnx"))
-        print("done")
-
-        print("saving netg.onnx")
-        netg_out = torch.onnx._export(netG, (noise, sent_emb, words_embs, mask), "netg.onnx", export_params=True)
-        print("uploading netg.onnx")
-        blob_service.create_blob_from_path('models', "netg.onnx", os.path.abspath("netg.onnx"))
-        print("done")
-        return
-
-    # G attention
+    # save_results only draws the attention maps of 2 copies requests
+    return_att = return_att and any(request[1] == 2 for request in requests)
+    fake_imgs, attention_maps, _, _ = \
+        netG(noise, sent_emb, words_embs, mask, eps, max_stage=max_stage,
+             return_att=return_att)
+
+    # scatter the rows back to the requests, on the CPU
+    fake_imgs = [im.cpu() for im in fake_imgs]
+    attention_maps = [attn.cpu() for attn in attention_maps]
+    captions = captions.cpu()
     cap_lens_np = cap_lens.cpu().data.numpy()
+    results = []
+    for i in range(len(requests)):
+        start, end = offsets[i], offsets[i] + copies[i]
+        # stage k + 1 has the attention map k
+        n_stages = len(fake_imgs) if max_stages[i] is None else max_stages[i]
+        results.append(([im[start:end] for im in fake_imgs[:n_stages]],
+                        [attn[start:end] for attn in attention_maps[:n_stages - 1]],
+                        captions[start:end], cap_lens_np[start:end]))
+    return results
+
+def generate_stages(request, wordtoix, text_encoder, netG, emb_cache=None, model='',
+                    config=None):
+    # like generate_batch for a single request, but yields the CPU images
+    # (copies x 3 x H x W) of every stage as soon as netG produced them,
+    # the stages after max_stage never run. no_grad never spans a yield,
+    # the grad mode belongs to the thread that consumes the stages
+    max_stage = request[3] if len(request) > 3 else None
+    with no_grad():
+        noise, eps, sent_emb, words_embs, mask, _, _, _, _ = \
+            prepare_inputs([request], wordtoix, text_encoder, emb_cache, model, config)
+        if not hasattr(netG, 'stages'):
+            # ONNX Runtime runs all the stages in one call
+            fake_imgs, _, _, _ = netG(noise, sent_emb, words_embs, mask, eps,
+                                      max_stage=max_stage, return_att=False)
+            fake_imgs = [fake_img.cpu() for fake_img in fake_imgs]
+        else:
+            c_code, _, _ = netG.ca_net(sent_emb, eps)
+            stages = netG.stages(noise, c_code, words_embs, mask, max_stage,
+                                 return_att=False)
+            fake_imgs = None
+    if fake_imgs is not None:
+        for fake_img in fake_imgs:
+            yield fake_img
+        return
+    while True:
+        with no_grad():
+            stage = next(stages, None)
+            fake_img = None if stage is None else stage[0].cpu()
+        if fake_img is None:
+            return
+        yield fake_img
+
+def png_bytes(im):
+    stream = io.BytesIO()
+    im.save(stream, format="png")
+    return stream.getvalue()
+
+def submit_image(fake_img, blob_name, uploader):
+    # fake_img: 3 x H x W in [-1, 1]
+    im = fake_img.data.cpu().numpy()
+    im = (im + 1.0) * 127.5
+    im = im.astype(np.uint8)
+    im = np.transpose(im, (1, 2, 0))
+    im = Image.fromarray(im)
+    return uploader.submit(blob_name, partial(png_bytes, im))
+
+def save_results(result, ixtoword, uploader, copies=2):
+    # the urls are returned right away, the PNGs are encoded and
+    # stored by the upload pool
+    fake_imgs, attention_maps, captions, cap_lens_np = result
+    batch_size = captions.size(0)
 
-    # storing to blob storage
-    container_name = "images"
-    full_path = "https://attgan.blob.core.windows.net/images/%s"
     prefix = datetime.now().strftime('%Y/%B/%d/%H_%M_%S_%f')
     urls = []
     # only look at first one
     #j = 0
     for j in range(batch_size):
         for k in range(len(fake_imgs)):
-            im = fake_imgs[k][j].data.cpu().numpy()
-            im = (im + 1.0) * 127.5
-            im = im.astype(np.uint8)
-            im = np.transpose(im, (1, 2, 0))
-            im = Image.fromarray(im)
-
-            # save image to stream
-            stream = io.BytesIO()
-            im.save(stream, format="png")
-            stream.seek(0)
             if copies > 2:
                 blob_name = '%s/%d/%s_g%d.png' % (prefix, j, "bird", k)
             else:
                 blob_name = '%s/%s_g%d.png' % (prefix, "bird", k)
-            blob_service.create_blob_from_stream(container_name, blob_name, stream)
-            urls.append(full_path % blob_name)
-
-            if copies == 2:
-                for k in range(len(attention_maps)):
-                #if False:
-                    if len(fake_imgs) > 1:
-                        im = fake_imgs[k + 1].detach().cpu()
-                    else:
-                        im = fake_imgs[0].detach().cpu()
-                            
-                    attn_maps = attention_maps[k]
-                    att_sze = attn_maps.size(2)
-
-                    img_set, sentences = \
-                        build_super_images2(im[j].unsqueeze(0),
-                                            captions[j].unsqueeze(0),
-                                            [cap_lens_np[j]], ixtoword,
-                                            [attn_maps[j]], att_sze)
-
-                    if img_set is not None:
-                        im = Image.fromarray(img_set)
-                        stream = io.BytesIO()
-                        im.save(stream, format="png")
-                        stream.seek(0)
-
-                        blob_name = '%s/%s_a%d.png' % (prefix, "attmaps", k)
-                        blob_service.create_blob_from_stream(container_name, blob_name, stream)
-                        urls.append(full_path % blob_name)
+            urls.append(submit_image(fake_imgs[k][j], blob_name, uploader))
+
+        if copies == 2:
+            for k in range(len(attention_maps)):
+            #if False:
+                if len(fake_imgs) > 1:
+                    im = fake_imgs[k + 1].detach().cpu()
+                else:
+                    im = fake_imgs[0].detach().cpu()
+                        
+                attn_maps = attention_maps[k]
+                att_sze = attn_maps.size(2)
+
+                img_set, sentences = \
+                    build_super_images2(im[j].unsqueeze(0),
+                                        captions[j].unsqueeze(0),
+                                        [cap_lens_np[j]], ixtoword,
+                                        [attn_maps[j]], att_sze)
+
+                if img_set is not None:
+                    im = Image.fromarray(img_set)
+                    blob_name = '%s/%s_a%d.png' % (prefix, "attmaps", k)
+                    urls.append(uploader.submit(blob_name, partial(png_bytes, im)))
         if copies == 2:
             break
     
     #print(len(urls), urls)
     return urls
 
-def word_index():
-    ixtoword = cache.get('ixtoword')
-    wordtoix = cache.get('wordtoix')
-    if ixtoword is None or wordtoix is None:
-        #print("ix and word not cached")
-        # load word to index dictionary
-        x = pickle.load(open('data/captions.pickle', 'rb'))
-        ixtoword = x[2]
-        wordtoix = x[3]
-        del x
-        cache.set('ixtoword', ixtoword, timeout=60 * 60 * 24)
-        cache.set('wordtoix', wordtoix, timeout=60 * 60 * 24)
+def generate(caption, wordtoix, ixtoword, text_encoder, netG, uploader, copies=2):
+    result = generate_batch([(caption, copies)], wordtoix, text_encoder, netG)[0]
+    return save_results(result, ixtoword, uploader, copies)
+
+def word_index(captions_path='data/captions.pickle'):
+    # load word to index dictionary
+    with open(captions_path, 'rb') as f:
+        x = pickle.load(f)
+    ixtoword = x[2]
+    wordtoix = x[3]
+    del x
 
     return wordtoix, ixtoword
 
 def models(word_len):
-    #print(word_len)
-    text_encoder = cache.get('text_encoder')
-    if text_encoder is None:
-        #print("text_encoder not cached")
-        text_encoder = RNN_ENCODER(word_len, nhidden=cfg.TEXT.EMBEDDING_DIM)
-        state_dict = torch.load(cfg.TRAIN.NET_E, map_location=lambda storage, loc: storage)
-        text_encoder.load_state_dict(state_dict)
-        if cfg.CUDA:
-            text_encoder.cuda()
-        text_encoder.eval()
-        cache.set('text_encoder', text_encoder, timeout=60 * 60 * 24)
-
-    netG = cache.get('netG')
-    if netG is None:
-        #print("netG not cached")
-        netG = G_NET()
-        state_dict = torch.load(cfg.TRAIN.NET_G, map_location=lambda storage, loc: storage)
-        netG.load_state_dict(state_dict)
-        if cfg.CUDA:
-            netG.cuda()
-        netG.eval()
-        cache.set('netG', netG, timeout=60 * 60 * 24)
+    text_encoder = RNN_ENCODER(word_len, nhidden=cfg.TEXT.EMBEDDING_DIM)
+    state_dict = torch.load(cfg.TRAIN.NET_E, map_location=lambda storage, loc: storage)
+    text_encoder.load_state_dict(state_dict)
+    if cfg.CUDA:
+        text_encoder.cuda()
+    text_encoder.eval()
+
+    netG = G_NET()
+    state_dict = torch.load(cfg.TRAIN.NET_G, map_location=lambda storage, loc: storage)
+    netG.load_state_dict(state_dict)
+    if cfg.CUDA:
+        netG.cuda()
+    netG.eval()
 
     return text_encoder, netG
 
@@ -203,11 +335,12 @@ def eval(caption):
     # lead models
     text_encoder, netG = models(len(wordtoix))
     # load blob service
-    blob_service = BlockBlobService(account_name='attgan', account_key=os.environ["BLOB_KEY"])
+    uploader = AsyncUploader(AzureBlobStorage('attgan', os.environ["BLOB_KEY"]))
 
     t0 = time.time()
-    urls = generate(caption, wordtoix, ixtoword, text_encoder, netG, blob_service)
+    urls = generate(caption, wordtoix, ixtoword, text_encoder, netG, uploader)
     t1 = time.time()
+    uploader.close()
 
     response = {
         'small': urls[0],
@@ -231,10 +364,11 @@ if __name__ == "__main__":
     # lead models
     text_encoder, netG = models(len(wordtoix))
     # load blob service
-    blob_service = BlockBlobService(account_name='attgan', account_key='[REDACTED]')
+    uploader = AsyncUploader(AzureBlobStorage('attgan', '[REDACTED]'))
     
     t0 = time.time()
-    urls = generate(caption, wordtoix, ixtoword, text_encoder, netG, blob_service)
+    urls = generate(caption, wordtoix, ixtoword, text_encoder, netG, uploader)
     t1 = time.time()
+    uploader.close()
     print(t1-t0)
     print(urls)
\ No newline at end of file
@@ -0,0 +1,124 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+import threading
+
+if sys.version_info[0] == 2:
+    from urllib2 import Request, urlopen
+else:
+    from urllib.request import Request, urlopen
+
+from batching import percentile
+
+
+CAPTIONS = ["the bird has a yellow crown and a black eyering that is round",
+            "this bird is red with white and has a very short beak",
+            "a small bird with a white breast and a brown crown",
+            "this bird has wings that are black and has a blue belly"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load generator for the AttnGAN eval API')
+    parser.add_argument('--url', type=str, default='http://localhost:8080')
+    parser.add_argument('--endpoint', type=str, default='bird', help='bird or birds')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--inproc', action='store_true',
+                        help='drive generate_batch through a BatchScheduler in this process '
+                             '(no Flask, no blob uploads)')
+    parser.add_argument('--model', type=str, default='bird', help='model name of cfg/eval_<name>.yml')
+    parser.add_argument('--max_batch', type=int, default=16)
+    parser.add_argument('--max_wait_ms', type=float, default=10)
+    args = parser.parse_args()
+    return args
+
+
+def http_sender(args):
+    url = '%s/api/v1.0/%s' % (args.url, args.endpoint)
+
+    def send(caption):
+        body = json.dumps({'caption': caption, 'model': args.model}).encode('utf8')
+        request = Request(url, body, {'Content-Type': 'application/json'})
+        urlopen(request).read()
+    return send
+
+
+def inproc_sender(args):
+    from registry import ModelRegistry
+    from batching import BatchScheduler
+
+    registry = ModelRegistry([args.model])
+    registry.warm_up(background=False)
+    scheduler = BatchScheduler(
+        lambda requests: registry.generate_batch(args.model, requests),
+        max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000.)
+    copies = 6 if args.endpoint == 'birds' else 2
+
+    def send(caption):
+        scheduler.submit((caption, copies), size=copies)
+    return send, scheduler
+
+
+def run(send, n_requests, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = [0]
+
+    def client():
+        while True:
+            with lock:
+                i = counter[0]
+                counter[0] += 1
+            if i >= n_requests:
+                return
+            start_t = time.time()
+            try:
+                send(CAPTIONS[i % len(CAPTIONS)])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.time() - start_t)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start_t = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies), errors, time.time() - start_t
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    scheduler = None
+    if args.inproc:
+        send, scheduler = inproc_sender(args)
+    else:
+        send = http_sender(args)
+
+    latencies, errors, elapsed = run(send, args.requests, args.concurrency)
+    print('requests: %d  errors: %d  concurrency: %d' %
+          (len(latencies), len(errors), args.concurrency))
+    if errors:
+        print('first error: %r' % errors[0])
+    if latencies:
+        print('throughput: %.2f requests/s' % (len(latencies) / elapsed))
+        print('latency p50: %.1fms  p99: %.1fms' %
+              (percentile(latencies, 50) * 1000., percentile(latencies, 99) * 1000.))
+
+    # batch sizes the server formed
+    if scheduler is not None:
+        print('scheduler: %s' % json.dumps(scheduler.stats(), sort_keys=True))
+    else:
+        try:
+            stats = urlopen('%s/api/v1.0/stats' % args.url).read()
+            print('server: %s' % stats.decode('utf8').strip())
+        except Exception as e:
+            print('no server stats: %r' % e)
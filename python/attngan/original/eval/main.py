@@ -1,8 +1,15 @@
 import os
+import json
 import time
+import atexit
 import random
+import threading
 from eval import *
-from flask import Flask, jsonify, request, abort
+from batching import BatchScheduler
+from registry import ModelRegistry
+from result_cache import LRUCache, normalize_caption
+from storage import AsyncUploader, make_storage
+from flask import Flask, Response, jsonify, request, abort, send_from_directory
 from applicationinsights import TelemetryClient
 from applicationinsights.requests import WSGIApplication
 from applicationinsights.exceptions import enable
@@ -13,26 +20,69 @@ enable(os.environ["TELEMETRY"])
 app = Flask(__name__)
 app.wsgi_app = WSGIApplication(os.environ["TELEMETRY"], app.wsgi_app)
 
+# image size of every stage
+SIZES = ['small', 'medium', 'large']
+
+def request_options():
+    # optional "seed" and "max_stage" (number of stages to run) of a request
+    seed = request.json.get('seed')
+    max_stage = request.json.get('max_stage')
+    return (None if seed is None else int(seed),
+            None if max_stage is None else int(max_stage))
+
+def generate_urls(name, caption, copies):
+    # returns the urls and the number of stages of the images. A request
+    # with a seed always gets the same images, so the urls of its first
+    # upload are cached and a hit neither generates nor stores anything
+    seed, max_stage = request_options()
+    key = (name, normalize_caption(caption), seed, copies, max_stage)
+    if seed is not None:
+        cached = image_cache.get(key)
+        if cached is not None:
+            return cached
+    result = schedulers[name].submit((caption, copies, seed, max_stage), size=copies)
+    urls = save_results(result, registry.get(name).ixtoword, uploader, copies=copies)
+    cached = (urls, len(result[0]))
+    if seed is not None:
+        image_cache.put(key, cached)
+    return cached
+
+def save_caches():
+    if cache_dir:
+        emb_cache.save(os.path.join(cache_dir, 'embeddings.pth'))
+        image_cache.save(os.path.join(cache_dir, 'image_urls.pth'))
+
+def save_caches_every(interval):
+    while True:
+        time.sleep(interval)
+        save_caches()
+
+def get_model():
+    name = request.json.get('model', default_model)
+    if name not in schedulers:
+        abort(404)
+    # no traffic before the model is warm
+    if not registry.is_ready(name):
+        abort(503)
+    return name
+
 @app.route('/api/v1.0/bird', methods=['POST'])
 def create_bird():
     if not request.json or not 'caption' in request.json:
         abort(400)
 
     caption = request.json['caption']
+    name = get_model()
 
     t0 = time.time()
-    urls = generate(caption, wordtoix, ixtoword, text_encoder, netG, blob_service)
+    urls, n_stages = generate_urls(name, caption, 2)
     t1 = time.time()
 
-    response = {
-        'small': urls[0],
-        'medium': urls[1],
-        'large': urls[2],
-        'map1': urls[3],
-        'map2': urls[4],
-        'caption': caption,
-        'elapsed': t1 - t0
-    }
+    response = dict(zip(SIZES, urls[:n_stages]))
+    for k in range(len(urls) - n_stages):
+        response['map%d' % (k + 1)] = urls[n_stages + k]
+    response['caption'] = caption
+    response['elapsed'] = t1 - t0
     return jsonify({'bird': response}), 201
 
 @app.route('/api/v1.0/birds', methods=['POST'])
@@ -41,23 +91,72 @@ def create_birds():
         abort(400)
 
     caption = request.json['caption']
+    name = get_model()
 
     t0 = time.time()
-    urls = generate(caption, wordtoix, ixtoword, text_encoder, netG, blob_service, copies=6)
+    urls, n_stages = generate_urls(name, caption, 6)
     t1 = time.time()
 
-    response = {
-        'bird1' : { 'small': urls[0], 'medium': urls[1], 'large': urls[2] },
-        'bird2' : { 'small': urls[3], 'medium': urls[4], 'large': urls[5] },
-        'bird3' : { 'small': urls[6], 'medium': urls[7], 'large': urls[8] },
-        'bird4' : { 'small': urls[9], 'medium': urls[10], 'large': urls[11] },
-        'bird5' : { 'small': urls[12], 'medium': urls[13], 'large': urls[14] },
-        'bird6' : { 'small': urls[15], 'medium': urls[16], 'large': urls[17] },
-        'caption': caption,
-        'elapsed': t1 - t0
-    }
+    response = {}
+    for j in range(6):
+        response['bird%d' % (j + 1)] = dict(zip(SIZES, urls[j * n_stages:(j + 1) * n_stages]))
+    response['caption'] = caption
+    response['elapsed'] = t1 - t0
     return jsonify({'bird': response}), 201
 
+@app.route('/api/v1.0/bird/stream', methods=['POST'])
+def stream_bird():
+    # one JSON line per stage, sent as soon as the stage is generated
+    if not request.json or not 'caption' in request.json:
+        abort(400)
+
+    caption = request.json['caption']
+    name = get_model()
+    seed, max_stage = request_options()
+    entry = registry.get(name)
+
+    def events():
+        t0 = time.time()
+        prefix = datetime.now().strftime('%Y/%B/%d/%H_%M_%S_%f')
+        stages = generate_stages((caption, 1, seed, max_stage), entry.wordtoix,
+                                 entry.text_encoder, entry.netG,
+                                 emb_cache=registry.emb_cache, model=name,
+                                 config=entry.config)
+        for k, fake_img in enumerate(stages):
+            blob_name = '%s/%s_g%d.png' % (prefix, "bird", k)
+            url = submit_image(fake_img[0], blob_name, uploader)
+            yield json.dumps({'stage': k, 'size': SIZES[k], 'url': url,
+                              'elapsed': time.time() - t0}) + '\n'
+        yield json.dumps({'caption': caption, 'elapsed': time.time() - t0}) + '\n'
+
+    return Response(events(), mimetype='application/x-ndjson')
+
+@app.route('/api/v1.0/stats', methods=['GET'])
+def get_stats():
+    stats = dict((name, schedulers[name].stats()) for name in schedulers)
+    stats['uploads'] = uploader.stats()
+    stats['embedding_cache'] = emb_cache.stats()
+    stats['image_cache'] = image_cache.stats()
+    return jsonify(stats)
+
+@app.route('/images/<path:name>', methods=['GET'])
+def get_image(name):
+    # only with STORAGE=local, the other backends serve their own urls
+    if storage_kind != 'local':
+        abort(404)
+    return send_from_directory(os.path.abspath(storage_dir), name)
+
+@app.route('/api/v1.0/models', methods=['GET'])
+def get_models():
+    return jsonify(registry.describe())
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    # readiness probe: 503 until every model is loaded and warm
+    if registry.ready():
+        return jsonify(registry.describe()), 200
+    return jsonify(registry.describe()), 503
+
 @app.route('/', methods=['GET'])
 def get_bird():
     return 'Version 1'
@@ -65,17 +164,50 @@ def get_bird():
 if __name__ == '__main__':
     t0 = time.time()
     tc = TelemetryClient(os.environ["TELEMETRY"])
-    
+
     # gpu based
     cfg.CUDA = os.environ["GPU"].lower() == 'true'
     tc.track_event('container initializing', {"CUDA": str(cfg.CUDA)})
 
-    # load word dictionaries
-    wordtoix, ixtoword = word_index()
-    # lead models
-    text_encoder, netG = models(len(wordtoix))
-    # load blob service
-    blob_service = BlockBlobService(account_name='attgan', account_key=os.environ["BLOB_KEY"])
+    # models are loaded once, from cfg/eval_<name>.yml, and never evicted
+    names = os.environ.get("MODELS", "bird").split(',')
+    default_model = names[0]
+    # caption embeddings and the urls of seeded results, CACHE_DIR keeps
+    # them between runs
+    emb_cache = LRUCache(int(float(os.environ.get("EMB_CACHE_MB", 64)) * 2 ** 20))
+    image_cache = LRUCache(int(float(os.environ.get("IMAGE_CACHE_MB", 16)) * 2 ** 20))
+    cache_dir = os.environ.get("CACHE_DIR", "")
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        emb_cache.load(os.path.join(cache_dir, 'embeddings.pth'))
+        image_cache.load(os.path.join(cache_dir, 'image_urls.pth'))
+        atexit.register(save_caches)
+        saver = threading.Thread(target=save_caches_every,
+                                 args=(float(os.environ.get("CACHE_SAVE_INTERVAL", 300)),))
+        saver.daemon = True
+        saver.start()
+    # BACKEND=onnx runs the models on ONNX Runtime, ORT_THREADS threads,
+    # ATTENTION_MAPS=false skips the attention maps of /bird
+    registry = ModelRegistry(names, emb_cache=emb_cache,
+                             backend=os.environ.get("BACKEND", "torch"),
+                             threads=int(os.environ.get("ORT_THREADS", 0)),
+                             attention=os.environ.get("ATTENTION_MAPS", "true").lower() == 'true')
+    # generated images are stored on a background pool, STORAGE=local keeps
+    # them in STORAGE_DIR and serves them itself, without any Azure account
+    storage_kind = os.environ.get("STORAGE", "azure")
+    storage_dir = os.environ.get("STORAGE_DIR", "images")
+    uploader = AsyncUploader(make_storage(storage_kind, storage_dir),
+                             workers=int(os.environ.get("UPLOAD_WORKERS", 4)))
+    # captions of concurrent requests share one text_encoder / netG pass,
+    # the uploads still run in the request threads
+    schedulers = {}
+    for name in names:
+        schedulers[name] = BatchScheduler(
+            lambda requests, name=name: registry.generate_batch(name, requests),
+            max_batch=int(os.environ.get("MAX_BATCH", 16)),
+            max_wait=float(os.environ.get("MAX_WAIT_MS", 10)) / 1000.,
+            validate=lambda request, name=name: check_request(request, registry.get(name).wordtoix))
 
     seed = 100
     random.seed(seed)
@@ -84,10 +216,14 @@ if __name__ == '__main__':
     if cfg.CUDA:
         torch.cuda.manual_seed_all(seed)
 
+    # WARMUP=background serves /ready (503) while the models load,
+    # WARMUP=startup loads them before the server starts listening
+    registry.warm_up(background=os.environ.get("WARMUP", "background") == "background")
+
     #app.config['PROFILE'] = True
     #app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[30])
     #app.run(host='0.0.0.0', port=8080, debug = True)
 
     t1 = time.time()
     tc.track_event('container start', {"starttime": str(t1-t0)})
-    app.run(host='0.0.0.0', port=8080)
+    app.run(host='0.0.0.0', port=8080, threaded=True)
@@ -12,7 +12,7 @@ cfg = __C
 # Dataset name: flowers, birds
 __C.DATASET_NAME = 'birds'
 __C.CONFIG_NAME = 'attn2'
-__C.DATA_DIR = ''
+__C.DATA_DIR = 'data'
 __C.GPU_ID = 0
 __C.CUDA = False
 __C.WORKERS = 1
@@ -62,3 +62,57 @@ __C.TEXT.CAPTIONS_PER_IMAGE = 10
 __C.TEXT.EMBEDDING_DIM = 256
 __C.TEXT.WORDS_NUM = 25
 
+
+def _merge_a_into_b(a, b):
+    """Merge config dictionary a into config dictionary b, clobbering the
+    options in b whenever they are also specified in a.
+    """
+    if type(a) is not edict:
+        return
+
+    for k, v in a.items():
+        # a must specify keys that are in b
+        if k not in b:
+            raise KeyError('{} is not a valid config key'.format(k))
+
+        # the types must match, too
+        old_type = type(b[k])
+        if old_type is not type(v):
+            if isinstance(b[k], np.ndarray):
+                v = np.array(v, dtype=b[k].dtype)
+            else:
+                raise ValueError(('Type mismatch ({} vs. {}) '
+                                  'for config key: {}').format(type(b[k]),
+                                                               type(v), k))
+
+        # recursively merge dicts
+        if type(v) is edict:
+            try:
+                _merge_a_into_b(a[k], b[k])
+            except:
+                print('Error under config key: {}'.format(k))
+                raise
+        else:
+            b[k] = v
+
+
+def cfg_from_file(filename):
+    """Load a config file and merge it into the default options."""
+    import yaml
+    with open(filename, 'r') as f:
+        yaml_cfg = edict(yaml.safe_load(f))
+
+    _merge_a_into_b(yaml_cfg, __C)
+
+
+def config_from_file(filename):
+    """Return a copy of the current options with a config file merged in,
+    cfg itself is left untouched."""
+    import copy
+    import yaml
+    with open(filename, 'r') as f:
+        yaml_cfg = edict(yaml.safe_load(f))
+
+    config = copy.deepcopy(__C)
+    _merge_a_into_b(yaml_cfg, config)
+    return config
@@ -112,8 +112,9 @@ class G_NET(nn.Module):
         ngf = cfg.GAN.GF_DIM
         nef = cfg.TEXT.EMBEDDING_DIM
         ncf = cfg.GAN.CONDITION_DIM
+        # fixed at construction, models of different configs can coexist
+        self.branch_num = cfg.TREE.BRANCH_NUM
 
-        
         self.ca_net = CA_NET()
 
         if cfg.TREE.BRANCH_NUM > 0:
@@ -127,38 +128,57 @@ class G_NET(nn.Module):
             self.h_net3 = NEXT_STAGE_G(ngf, nef, ncf)
             self.img_net3 = GET_IMAGE_G(ngf)
 
-    def forward(self, z_code, sent_emb, word_embs, mask):
+    def forward(self, z_code, sent_emb, word_embs, mask, eps=None, max_stage=None,
+                return_att=True):
         """
             :param z_code: batch x cfg.GAN.Z_DIM
             :param sent_emb: batch x cfg.TEXT.EMBEDDING_DIM
             :param word_embs: batch x cdf x seq_len
             :param mask: batch x seq_len
+            :param eps: batch x cfg.GAN.CONDITION_DIM, the noise of the
+                conditioning augmentation, drawn here if None
+            :param max_stage: number of stages to run, all if None
+            :param return_att: False for inference without the attention
+                maps, att_maps is then empty
             :return:
         """
         fake_imgs = []
         att_maps = []
-        c_code, mu, logvar = self.ca_net(sent_emb)
+        c_code, mu, logvar = self.ca_net(sent_emb, eps)
 
-        if cfg.TREE.BRANCH_NUM > 0:
+        for fake_img, att in self.stages(z_code, c_code, word_embs, mask, max_stage,
+                                         return_att):
+            fake_imgs.append(fake_img)
+            if att is not None:
+                att_maps.append(att)
+
+        return fake_imgs, att_maps, mu, logvar
+
+    def stages(self, z_code, c_code, word_embs, mask, max_stage=None, return_att=True):
+        """
+            Yields (fake_img, attention map or None) of every stage as
+            soon as it is computed, a stage only runs once the previous
+            one has been consumed.
+            :param c_code: batch x cfg.GAN.CONDITION_DIM, from self.ca_net
+        """
+        num_stages = self.branch_num
+        if max_stage is not None:
+            num_stages = min(num_stages, max_stage)
+
+        if num_stages > 0:
             h_code1 = self.h_net1(z_code, c_code)
             fake_img1 = self.img_net1(h_code1)
-            fake_imgs.append(fake_img1)
-        if cfg.TREE.BRANCH_NUM > 1:
+            yield fake_img1, None
+        if num_stages > 1:
             h_code2, att1 = \
-                self.h_net2(h_code1, c_code, word_embs, mask)
+                self.h_net2(h_code1, c_code, word_embs, mask, return_att)
             fake_img2 = self.img_net2(h_code2)
-            fake_imgs.append(fake_img2)
-            if att1 is not None:
-                att_maps.append(att1)
-        if cfg.TREE.BRANCH_NUM > 2:
+            yield fake_img2, att1
+        if num_stages > 2:
             h_code3, att2 = \
-                self.h_net3(h_code2, c_code, word_embs, mask)
+                self.h_net3(h_code2, c_code, word_embs, mask, return_att)
             fake_img3 = self.img_net3(h_code3)
-            fake_imgs.append(fake_img3)
-            if att2 is not None:
-                att_maps.append(att2)
-
-        return fake_imgs, att_maps, mu, logvar
+            yield fake_img3, att2
 
 
 # ############## G networks ###################
@@ -180,18 +200,16 @@ class CA_NET(nn.Module):
         logvar = x[:, self.c_dim:]
         return mu, logvar
 
-    def reparametrize(self, mu, logvar):
+    def reparametrize(self, mu, logvar, eps=None):
         std = logvar.mul(0.5).exp_()
-        if cfg.CUDA:
-            eps = torch.cuda.FloatTensor(std.size()).normal_()
-        else:
-            eps = torch.FloatTensor(std.size()).normal_()
-        eps = Variable(eps)
+        if eps is None:
+            # on the device of mu, not the one of the global cfg.CUDA
+            eps = Variable(std.data.new(std.size()).normal_())
         return eps.mul(std).add_(mu)
 
-    def forward(self, text_embedding):
+    def forward(self, text_embedding, eps=None):
         mu, logvar = self.encode(text_embedding)
-        c_code = self.reparametrize(mu, logvar)
+        c_code = self.reparametrize(mu, logvar, eps)
         return c_code, mu, logvar
 
 
@@ -428,15 +446,14 @@ class NEXT_STAGE_G(nn.Module):
         self.residual = self._make_layer(ResBlock, ngf * 2)
         self.upsample = upBlock(ngf * 2, ngf)
 
-    def forward(self, h_code, c_code, word_embs, mask):
+    def forward(self, h_code, c_code, word_embs, mask, return_att=True):
         """
             h_code1(query):  batch x idf x ih x iw (queryL=ihxiw)
             word_embs(context): batch x cdf x sourceL (sourceL=seq_len)
             c_code1: batch x idf x queryL
-            att1: batch x sourceL x queryL
+            att1: batch x sourceL x queryL, None if not return_att
         """
-        self.att.applyMask(mask)
-        c_code, att = self.att(h_code, word_embs)
+        c_code, att = self.att(h_code, word_embs, return_att, mask)
         h_c_code = torch.cat((h_code, c_code), 1)
         out_code = self.residual(h_c_code)
 
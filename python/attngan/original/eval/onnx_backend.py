@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import os
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+# numpy type of the ONNX input types the exported models use
+_NUMPY_TYPES = {'tensor(float)': np.float32,
+                'tensor(int64)': np.int64,
+                'tensor(bool)': np.bool_}
+
+
+def inference_session(path, threads=0):
+    # threads: intra op threads of ONNX Runtime, 0 lets it pick
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+class OnnxModel(object):
+    # runs an exported model on Variables / tensors and returns Variables
+    def __init__(self, path, threads=0):
+        self.path = path
+        self.session = inference_session(path, threads)
+        self.inputs = [(i.name, _NUMPY_TYPES[i.type]) for i in self.session.get_inputs()]
+        self.outputs = [o.name for o in self.session.get_outputs()]
+
+    def run(self, *args):
+        feed = {}
+        for (name, dtype), x in zip(self.inputs, args):
+            if hasattr(x, 'data'):
+                x = x.data.cpu().numpy()
+            feed[name] = np.ascontiguousarray(x, dtype=dtype)
+        return [Variable(torch.from_numpy(y)) for y in self.session.run(None, feed)]
+
+
+class OnnxTextEncoder(OnnxModel):
+    # stands in for RNN_ENCODER in prepare_inputs
+    def init_hidden(self, bsz):
+        # the exported graph starts from the zero state
+        return None
+
+    def __call__(self, captions, cap_lens, hidden=None, mask=None):
+        words_emb, sent_emb = self.run(captions, cap_lens)
+        return words_emb, sent_emb
+
+
+class OnnxGenerator(OnnxModel):
+    """
+        Stands in for G_NET in generate_batch. Every stage runs in the one
+        session call, max_stage only drops the later outputs, and the
+        attention maps are empty if netG was exported without them.
+    """
+    def __init__(self, path, threads=0):
+        super(OnnxGenerator, self).__init__(path, threads)
+        self.branch_num = len([name for name in self.outputs if name.startswith('fake_img')])
+        self.eps_dim = self.session.get_inputs()[4].shape[1]
+
+    def __call__(self, z_code, sent_emb, word_embs, mask, eps=None, max_stage=None,
+                 return_att=True):
+        if eps is None:
+            eps = torch.FloatTensor(z_code.size(0), self.eps_dim).normal_()
+        outputs = self.run(z_code, sent_emb, word_embs, mask, eps)
+        fake_imgs = outputs[:self.branch_num]
+        att_maps = outputs[self.branch_num:] if return_att else []
+        if max_stage is not None:
+            fake_imgs = fake_imgs[:max_stage]
+            att_maps = att_maps[:max_stage - 1]
+        return fake_imgs, att_maps, None, None
+
+
+def onnx_models(word_len, onnx_dir, threads=0):
+    # exports the models of the current cfg to onnx_dir the first time
+    from onnx_export import TEXT_ENCODER_FILE, GENERATOR_FILE, export_models
+    te_path = os.path.join(onnx_dir, TEXT_ENCODER_FILE)
+    g_path = os.path.join(onnx_dir, GENERATOR_FILE)
+    if not (os.path.isfile(te_path) and os.path.isfile(g_path)):
+        from eval import models
+        text_encoder, netG = models(word_len)
+        export_models(text_encoder, netG, onnx_dir)
+        print('Export ONNX models to: %s' % onnx_dir)
+    return OnnxTextEncoder(te_path, threads), OnnxGenerator(g_path, threads)
@@ -0,0 +1,96 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+from batching import percentile
+
+CAPTION = "the bird has a yellow crown and a black eyering that is round"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Latency and memory of eager PyTorch vs ONNX Runtime')
+    parser.add_argument('--model', type=str, default='bird', help='model name of cfg/eval_<name>.yml')
+    parser.add_argument('--backends', type=str, default='torch,onnx')
+    parser.add_argument('--batch_sizes', type=str, default='1,8,32')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='threads of both backends, 0 keeps their defaults')
+    parser.add_argument('--worker', type=str, default='',
+                        help='internal: benchmark this one backend and print JSON lines')
+    args = parser.parse_args()
+    return args
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_worker(args):
+    import torch
+    from registry import ModelRegistry
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    registry = ModelRegistry([args.model], backend=args.worker, threads=args.threads)
+    registry.warm_up(background=False)
+    registry.get(args.model)
+    print(json.dumps({'loaded_rss_mb': peak_rss_mb()}))
+    sys.stdout.flush()
+
+    with torch.no_grad():
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            requests = [(CAPTION, batch_size)]
+            # the first pass allocates the buffers of this batch size
+            registry.generate_batch(args.model, requests)
+            latencies = []
+            for _ in range(args.repeats):
+                start_t = time.time()
+                registry.generate_batch(args.model, requests)
+                latencies.append(time.time() - start_t)
+            latencies.sort()
+            print(json.dumps({'batch_size': batch_size,
+                              'p50_ms': percentile(latencies, 50) * 1000.,
+                              'p90_ms': percentile(latencies, 90) * 1000.,
+                              'images_per_s': batch_size / percentile(latencies, 50),
+                              'peak_rss_mb': peak_rss_mb()}))
+            sys.stdout.flush()
+
+
+def run_backend(args, backend):
+    # one process per backend, so that the peak RSS is its own
+    command = [sys.executable, __file__, '--worker', backend,
+               '--model', args.model, '--batch_sizes', args.batch_sizes,
+               '--repeats', str(args.repeats), '--threads', str(args.threads)]
+    output = subprocess.check_output(command).decode('utf8')
+    rows = [json.loads(line) for line in output.splitlines() if line.startswith('{')]
+    return rows[0]['loaded_rss_mb'], rows[1:]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+        sys.exit(0)
+
+    results = {}
+    for backend in args.backends.split(','):
+        results[backend] = run_backend(args, backend)
+        print('%s: %.0f MB after loading %s' % (backend, results[backend][0], args.model))
+
+    print('%-6s %6s %10s %10s %10s %14s %8s' %
+          ('', 'batch', 'p50 ms', 'p90 ms', 'images/s', 'peak RSS MB', 'speedup'))
+    eager = dict((row['batch_size'], row) for row in results.get('torch', (0, []))[1])
+    for backend in args.backends.split(','):
+        for row in results[backend][1]:
+            base = eager.get(row['batch_size'])
+            speedup = '%.2fx' % (base['p50_ms'] / row['p50_ms']) if base else '-'
+            print('%-6s %6d %10.1f %10.1f %10.1f %14.0f %8s' %
+                  (backend, row['batch_size'], row['p50_ms'], row['p90_ms'],
+                   row['images_per_s'], row['peak_rss_mb'], speedup))
@@ -0,0 +1,192 @@
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from miscc.config import cfg, config_from_file
+from registry import use_config
+from eval import word_index, models
+
+# files of an exported model, next to its .pth files in cfg.DATA_DIR
+TEXT_ENCODER_FILE = 'text_encoder.onnx'
+GENERATOR_FILE = 'netG.onnx'
+OPSET = 17
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export the AttnGAN eval models to ONNX')
+    parser.add_argument('--model', type=str, default='bird', help='model name of cfg/eval_<name>.yml')
+    parser.add_argument('--cfg_dir', type=str, default='cfg')
+    parser.add_argument('--out_dir', type=str, default='',
+                        help='where the .onnx files go, DATA_DIR of the model if empty')
+    parser.add_argument('--no_attention', action='store_true',
+                        help='netG only outputs the images, not the attention maps')
+    parser.add_argument('--opset', type=int, default=OPSET)
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='largest difference to the PyTorch outputs the parity check accepts')
+    args = parser.parse_args()
+    return args
+
+
+class TextEncoderExport(nn.Module):
+    """
+        RNN_ENCODER.forward without the cap_lens.tolist(), which a trace
+        would freeze to the lengths of the example captions. The hidden
+        state starts at zero, as with RNN_ENCODER.init_hidden.
+    """
+    def __init__(self, text_encoder):
+        super(TextEncoderExport, self).__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, captions, cap_lens):
+        encoder = self.text_encoder
+        emb = encoder.drop(encoder.encoder(captions))
+        emb = pack_padded_sequence(emb, cap_lens, batch_first=True)
+        output, hidden = encoder.rnn(emb)
+        output = pad_packed_sequence(output, batch_first=True)[0]
+        words_emb = output.transpose(1, 2)
+        if encoder.rnn_type == 'LSTM':
+            hidden = hidden[0]
+        sent_emb = hidden.transpose(0, 1).contiguous()
+        sent_emb = sent_emb.view(-1, encoder.nhidden * encoder.num_directions)
+        return words_emb, sent_emb
+
+
+class GeneratorExport(nn.Module):
+    # G_NET with the eps of CA_NET as an input and the stages as outputs
+    def __init__(self, netG, attention=True):
+        super(GeneratorExport, self).__init__()
+        self.netG = netG
+        self.attention = attention
+
+    def forward(self, noise, sent_emb, words_embs, mask, eps):
+        fake_imgs, att_maps, _, _ = self.netG(noise, sent_emb, words_embs, mask, eps,
+                                              return_att=self.attention)
+        return tuple(fake_imgs) + tuple(att_maps)
+
+
+def export_text_encoder(text_encoder, path, opset=OPSET):
+    # batch and caption length are dynamic, the rows go in a
+    # decreasing length order, as for pack_padded_sequence
+    captions = torch.LongTensor([[1, 1, 1], [1, 1, 0]])
+    cap_lens = torch.LongTensor([3, 2])
+    torch.onnx.export(TextEncoderExport(text_encoder).eval(), (captions, cap_lens), path,
+                      opset_version=opset, dynamo=False,
+                      input_names=['captions', 'cap_lens'],
+                      output_names=['words_emb', 'sent_emb'],
+                      dynamic_axes={'captions': {0: 'batch', 1: 'seq_len'},
+                                    'cap_lens': {0: 'batch'},
+                                    'words_emb': {0: 'batch', 2: 'seq_len'},
+                                    'sent_emb': {0: 'batch'}})
+
+
+def export_generator(netG, path, attention=True, opset=OPSET):
+    batch_size, seq_len = 2, 3
+    noise = torch.FloatTensor(batch_size, cfg.GAN.Z_DIM).normal_(0, 1)
+    sent_emb = torch.FloatTensor(batch_size, cfg.TEXT.EMBEDDING_DIM).normal_(0, 1)
+    words_embs = torch.FloatTensor(batch_size, cfg.TEXT.EMBEDDING_DIM, seq_len).normal_(0, 1)
+    mask = torch.zeros(batch_size, seq_len) > 0
+    mask[1, 2] = True
+    eps = torch.FloatTensor(batch_size, cfg.GAN.CONDITION_DIM).normal_(0, 1)
+
+    output_names = ['fake_img%d' % k for k in range(netG.branch_num)]
+    if attention:
+        output_names += ['att%d' % (k + 1) for k in range(netG.branch_num - 1)]
+    dynamic_axes = dict((name, {0: 'batch'}) for name in
+                        ['noise', 'sent_emb', 'eps'] + output_names)
+    dynamic_axes['words_embs'] = {0: 'batch', 2: 'seq_len'}
+    dynamic_axes['mask'] = {0: 'batch', 1: 'seq_len'}
+    # batch x seq_len x H x W
+    for name in output_names[netG.branch_num:]:
+        dynamic_axes[name] = {0: 'batch', 1: 'seq_len'}
+
+    torch.onnx.export(GeneratorExport(netG, attention).eval(),
+                      (noise, sent_emb, words_embs, mask, eps), path,
+                      opset_version=opset, dynamo=False,
+                      input_names=['noise', 'sent_emb', 'words_embs', 'mask', 'eps'],
+                      output_names=output_names, dynamic_axes=dynamic_axes)
+
+
+def export_models(text_encoder, netG, out_dir, attention=True, opset=OPSET):
+    # reads cfg, call it with the config of the model in place
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    te_path = os.path.join(out_dir, TEXT_ENCODER_FILE)
+    g_path = os.path.join(out_dir, GENERATOR_FILE)
+    export_text_encoder(text_encoder, te_path, opset)
+    export_generator(netG, g_path, attention, opset)
+    return te_path, g_path
+
+
+def check_parity(text_encoder, netG, onnx_text_encoder, onnx_netG,
+                 batch_sizes=(1, 3), seed=0):
+    """
+        Largest absolute difference between the PyTorch and the ONNX
+        Runtime outputs, on random captions of random lengths.
+        Returns {output name: difference}.
+    """
+    rng = np.random.RandomState(seed)
+    diffs = {}
+
+    def compare(name, expected, actual):
+        diff = float(np.abs(expected.data.cpu().numpy() - actual.data.numpy()).max())
+        diffs[name] = max(diffs.get(name, 0.), diff)
+
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            cap_lens = np.sort(rng.randint(1, cfg.TEXT.WORDS_NUM + 1, batch_size))[::-1]
+            captions = np.zeros((batch_size, cap_lens[0]), dtype=int)
+            for i, cap_len in enumerate(cap_lens):
+                captions[i, :cap_len] = rng.randint(1, text_encoder.ntoken, cap_len)
+            captions = torch.from_numpy(captions)
+            cap_lens = torch.from_numpy(cap_lens.copy())
+
+            words_embs, sent_emb = text_encoder(captions, cap_lens,
+                                                text_encoder.init_hidden(batch_size))
+            onnx_words_embs, onnx_sent_emb = onnx_text_encoder(captions, cap_lens)
+            compare('words_emb', words_embs, onnx_words_embs)
+            compare('sent_emb', sent_emb, onnx_sent_emb)
+
+            noise = torch.from_numpy(rng.randn(batch_size, cfg.GAN.Z_DIM).astype('float32'))
+            eps = torch.from_numpy(rng.randn(batch_size, cfg.GAN.CONDITION_DIM).astype('float32'))
+            mask = (captions == 0)
+            fake_imgs, att_maps, _, _ = netG(noise, sent_emb, words_embs, mask, eps)
+            onnx_fake_imgs, onnx_att_maps, _, _ = \
+                onnx_netG(noise, sent_emb, words_embs, mask, eps)
+            for k in range(len(onnx_fake_imgs)):
+                compare('fake_img%d' % k, fake_imgs[k], onnx_fake_imgs[k])
+            for k in range(len(onnx_att_maps)):
+                compare('att%d' % (k + 1), att_maps[k], onnx_att_maps[k])
+    return diffs
+
+
+if __name__ == "__main__":
+    from onnx_backend import OnnxTextEncoder, OnnxGenerator
+
+    args = parse_args()
+    config = config_from_file(os.path.join(args.cfg_dir, 'eval_%s.yml' % args.model))
+    # the export and the check run on the CPU
+    config.CUDA = False
+    out_dir = args.out_dir or config.DATA_DIR
+    with use_config(config):
+        wordtoix, ixtoword = word_index(os.path.join(config.DATA_DIR, 'captions.pickle'))
+        text_encoder, netG = models(len(wordtoix))
+        te_path, g_path = export_models(text_encoder, netG, out_dir,
+                                        not args.no_attention, args.opset)
+        print('Export text_encoder to: %s' % te_path)
+        print('Export netG to: %s' % g_path)
+
+        diffs = check_parity(text_encoder, netG, OnnxTextEncoder(te_path), OnnxGenerator(g_path))
+    failed = False
+    for name in sorted(diffs):
+        ok = diffs[name] <= args.atol
+        failed = failed or not ok
+        print('%-10s max abs diff %.3g %s' % (name, diffs[name], 'ok' if ok else 'FAILED'))
+    if failed:
+        print('ONNX Runtime outputs differ from PyTorch by more than %g' % args.atol)
+        sys.exit(1)
@@ -0,0 +1,140 @@
+from __future__ import print_function
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from miscc.config import cfg, config_from_file
+from eval import word_index, models, generate_batch
+from onnx_backend import onnx_models
+
+
+# the model modules read cfg while they are built. At request time the
+# inference code takes the config of the model (ModelEntry.config) as an
+# argument instead, so the models run concurrently, never under this lock
+_CONFIG_LOCK = threading.Lock()
+
+
+@contextmanager
+def use_config(config):
+    with _CONFIG_LOCK:
+        saved = dict(cfg)
+        cfg.update(config)
+        try:
+            yield
+        finally:
+            cfg.update(saved)
+
+
+class ModelEntry(object):
+    def __init__(self, name, config, wordtoix, ixtoword, text_encoder, netG):
+        self.name = name
+        self.config = config
+        self.wordtoix = wordtoix
+        self.ixtoword = ixtoword
+        self.text_encoder = text_encoder
+        self.netG = netG
+
+
+class ModelRegistry(object):
+    """
+        Loads the word dictionary, text_encoder and netG of every
+        configured model once and keeps them for the life of the process.
+        names: model names, each one configured by <cfg_dir>/eval_<name>.yml
+        emb_cache: LRUCache of the text embeddings, shared by the models
+        backend: 'torch', or 'onnx' to run the models exported to
+            DATA_DIR on ONNX Runtime (exported there on the first load)
+        threads: intra op threads of ONNX Runtime, 0 lets it pick
+        attention: False never computes the attention maps (no map urls)
+    """
+    def __init__(self, names, cfg_dir='cfg', emb_cache=None, backend='torch', threads=0,
+                 attention=True):
+        if backend not in ('torch', 'onnx'):
+            raise ValueError('Unknown inference backend: %s' % backend)
+        self.names = list(names)
+        self.cfg_dir = cfg_dir
+        self.emb_cache = emb_cache
+        self.backend = backend
+        self.threads = threads
+        self.attention = attention
+        self.entries = {}
+        self.status = dict((name, 'pending') for name in self.names)
+        self.load_time = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = None
+
+    def load(self, name):
+        start_t = time.time()
+        config = config_from_file(os.path.join(self.cfg_dir, 'eval_%s.yml' % name))
+        with use_config(config):
+            wordtoix, ixtoword = word_index(os.path.join(config.DATA_DIR,
+                                                         'captions.pickle'))
+            if self.backend == 'onnx':
+                text_encoder, netG = onnx_models(len(wordtoix), config.DATA_DIR,
+                                                 self.threads)
+            else:
+                text_encoder, netG = models(len(wordtoix))
+            # the first forward pass allocates the buffers, pay for it here
+            words = [ixtoword[ix] for ix in sorted(ixtoword)[1:6]]
+            generate_batch([(' '.join(words), 2)], wordtoix, text_encoder, netG,
+                           return_att=self.attention, config=config)
+        entry = ModelEntry(name, config, wordtoix, ixtoword, text_encoder, netG)
+        return entry, time.time() - start_t
+
+    def warm_up(self, background=True):
+        if background:
+            self.thread = threading.Thread(target=self._warm_up)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self._warm_up()
+
+    def _warm_up(self):
+        for name in self.names:
+            with self.lock:
+                self.status[name] = 'loading'
+            try:
+                entry, elapsed = self.load(name)
+            except Exception as e:
+                print('Failed to load model %s: %r' % (name, e))
+                with self.lock:
+                    self.status[name] = 'failed: %s' % e
+                continue
+            print('Loaded model %s in %.2fs' % (name, elapsed))
+            with self.lock:
+                self.entries[name] = entry
+                self.load_time[name] = elapsed
+                self.status[name] = 'ready'
+        self.done.set()
+
+    def is_ready(self, name):
+        with self.lock:
+            return name in self.entries
+
+    def ready(self):
+        # every configured model is loaded
+        with self.lock:
+            return len(self.entries) == len(self.names)
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.entries:
+                raise KeyError('model %s is %s' % (name, self.status.get(name, 'unknown')))
+            return self.entries[name]
+
+    def generate_batch(self, name, requests):
+        entry = self.get(name)
+        return generate_batch(requests, entry.wordtoix,
+                              entry.text_encoder, entry.netG,
+                              emb_cache=self.emb_cache, model=name,
+                              return_att=self.attention, config=entry.config)
+
+    def describe(self):
+        with self.lock:
+            return {'ready': len(self.entries) == len(self.names),
+                    'backend': self.backend,
+                    'models': dict((name, {'status': self.status[name],
+                                           'load_time': self.load_time.get(name)})
+                                   for name in self.names)}
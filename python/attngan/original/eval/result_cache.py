@@ -0,0 +1,97 @@
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def normalize_caption(caption):
+    # the tokens vectorize_caption looks up, so captions that only differ
+    # in spacing share their cache entries
+    tokens = [t.strip().encode('ascii', 'ignore').decode('ascii')
+              for t in caption.split(' ')]
+    return ' '.join(t for t in tokens if len(t) > 0)
+
+
+def nbytes(value):
+    # memory held by the tensors / arrays / strings in value
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    if isinstance(value, (bytes, type(u''))):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, 'data') and torch.is_tensor(value.data):
+        value = value.data
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    return 0
+
+
+class LRUCache(object):
+    """
+        Least recently used entries are evicted once the values hold more
+        than max_bytes. Thread safe.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.n_bytes -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'bytes': self.n_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else None}
+
+    def save(self, path):
+        # least recently used first, so load() restores the order
+        with self.lock:
+            items = [(key, value) for key, (value, _) in self.entries.items()]
+        tmp_path = path + '.tmp'
+        torch.save(items, tmp_path)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return
+        for key, value in torch.load(path, map_location=lambda storage, loc: storage):
+            self.put(key, value)
+        print('Load %d cache entries from: %s' % (len(self.entries), path))
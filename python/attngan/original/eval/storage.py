@@ -0,0 +1,217 @@
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import heapq
+import threading
+from collections import deque
+
+from batching import percentile
+
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+
+
+# Storage backends #################################################
+# put(name, data) stores the bytes data under name, url(name) is where
+# clients fetch them from.
+class AzureBlobStorage(object):
+    def __init__(self, account_name, account_key, container='images'):
+        from azure.storage.blob import BlockBlobService
+        self.service = BlockBlobService(account_name=account_name,
+                                        account_key=account_key)
+        self.container = container
+        self.base_url = 'https://%s.blob.core.windows.net/%s/' % (account_name, container)
+
+    def put(self, name, data):
+        self.service.create_blob_from_bytes(self.container, name, data)
+
+    def url(self, name):
+        return self.base_url + name
+
+
+class LocalStorage(object):
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url
+
+    def put(self, name, data):
+        path = os.path.join(self.root, name)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by another upload thread
+                if not os.path.isdir(folder):
+                    raise
+        # readers never see a partial file
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def url(self, name):
+        return self.base_url + name
+
+
+class MemoryStorage(object):
+    # in-process stand-in for tests, fail_first makes the first puts fail
+    def __init__(self, base_url='memory://', fail_first=0):
+        self.base_url = base_url
+        self.fail_first = fail_first
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def put(self, name, data):
+        with self.lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                raise IOError('failing put of %s' % name)
+            self.blobs[name] = data
+
+    def url(self, name):
+        return self.base_url + name
+
+
+# Asynchronous uploads #############################################
+class AsyncUploader(object):
+    """
+        submit(name, data) returns the url of name right away and stores
+        data on a pool of workers threads. data is bytes or a function
+        returning bytes, so that encoding runs on the pool too.
+        A failed put is retried after backoff * 2 ** attempt seconds, up
+        to max_retries times; at most max_retry_pending uploads wait for
+        a retry, beyond that they are dropped and counted as failed.
+    """
+    def __init__(self, storage, workers=4, max_retries=3, backoff=0.5,
+                 max_retry_pending=100, window=1000):
+        self.storage = storage
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_pending = max_retry_pending
+        self.tasks = queue.Queue()
+        self.retries = []
+        self.cond = threading.Condition()
+        self.n_pending = 0
+        self.n_uploaded = 0
+        self.n_retried = 0
+        self.n_failed = 0
+        self.last_error = None
+        # seconds between submit and the successful put
+        self.lags = deque(maxlen=window)
+        self.closed = False
+        self.threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        self.threads.append(threading.Thread(target=self._requeue))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, name, data):
+        with self.cond:
+            self.n_pending += 1
+        self.tasks.put((name, data, time.time(), 0))
+        return self.storage.url(name)
+
+    def _done(self, failed=False):
+        with self.cond:
+            self.n_pending -= 1
+            if failed:
+                self.n_failed += 1
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            name, data, submitted, attempt = task
+            try:
+                if callable(data):
+                    data = data()
+                self.storage.put(name, data)
+            except Exception as e:
+                with self.cond:
+                    self.last_error = '%s: %r' % (name, e)
+                    retry = attempt < self.max_retries and \
+                        len(self.retries) < self.max_retry_pending
+                    if retry:
+                        self.n_retried += 1
+                        due = time.time() + self.backoff * 2 ** attempt
+                        heapq.heappush(self.retries,
+                                       (due, name, data, submitted, attempt + 1))
+                        self.cond.notify_all()
+                if not retry:
+                    print('Upload of %s failed: %r' % (name, e))
+                    self._done(failed=True)
+                continue
+            with self.cond:
+                self.n_uploaded += 1
+                self.lags.append(time.time() - submitted)
+            self._done()
+
+    def _requeue(self):
+        # moves the retries back to the workers once they are due
+        with self.cond:
+            while not self.closed:
+                if not self.retries:
+                    self.cond.wait()
+                    continue
+                wait = self.retries[0][0] - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                task = heapq.heappop(self.retries)
+                self.tasks.put(task[1:])
+
+    def flush(self, timeout=None):
+        # waits for every submitted upload to be stored or dropped
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.n_pending > 0:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for _ in self.threads[:-1]:
+            self.tasks.put(None)
+
+    def stats(self):
+        with self.cond:
+            lags = sorted(self.lags)
+            stats = {'pending': self.n_pending,
+                     'retry_pending': len(self.retries),
+                     'uploaded': self.n_uploaded,
+                     'retried': self.n_retried,
+                     'failed': self.n_failed,
+                     'last_error': self.last_error}
+        if lags:
+            stats['lag_p50_ms'] = percentile(lags, 50) * 1000.
+            stats['lag_p99_ms'] = percentile(lags, 99) * 1000.
+            stats['lag_max_ms'] = lags[-1] * 1000.
+        return stats
+
+
+def make_storage(kind, root='images', base_url='/images/'):
+    # STORAGE environment variable of the server: azure, local or memory
+    if kind == 'azure':
+        return AzureBlobStorage('attgan', os.environ["BLOB_KEY"])
+    if kind == 'local':
+        return LocalStorage(root, base_url)
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError('Unknown storage backend: %s' % kind)
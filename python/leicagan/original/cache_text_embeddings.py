@@ -0,0 +1,65 @@
+from cfg.config import cfg, cfg_from_file
+from datasets import TextDataset
+from model import RNN_ENCODER
+from trainer import get_encoder_path
+from miscc.text_cache import build_text_cache
+
+import os
+import sys
+import pprint
+import argparse
+import numpy as np
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Cache the frozen text embeddings')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/Bird/Main/EarlyGLAM/train.yml', type=str)
+    parser.add_argument('--split', dest='split', type=str, default='train')
+    parser.add_argument('--batch_size', type=int, default=100)
+    args = parser.parse_args()
+    return args
+
+
+def load_text_encoder(encoder, n_words):
+    text_encoder = RNN_ENCODER(n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
+    encoder_path = get_encoder_path(encoder)
+    state_dict = torch.load(encoder_path, map_location=lambda storage, loc: storage)
+    text_encoder.load_state_dict(state_dict)
+    print('Load text encoder from:', encoder_path)
+    if cfg.CUDA:
+        text_encoder.cuda()
+    return text_encoder, encoder_path
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+
+    print('Using config:')
+    pprint.pprint(cfg)
+    assert cfg.TEXT.EMB_CACHE != '', 'TEXT.EMB_CACHE is not set'
+
+    # captions longer than WORDS_NUM keep a random subset of their words,
+    # TEXT.EMB_CACHE_DRAWS of them are cached; seeded so the cache is
+    # reproducible
+    np.random.seed(100)
+
+    dataset = TextDataset(os.path.join(cfg.DATA_DIR, cfg.DATASET_NAME), args.split,
+                          base_size=cfg.TREE.BASE_SIZE)
+    n_captions = len(dataset) * dataset.embeddings_num
+
+    # the trainer conditions ENCODER2 on the embeddings of ENCODER1 too
+    encoders = {'text': load_text_encoder(cfg.ENCODER1, dataset.n_words)}
+
+    build_text_cache(os.path.join(cfg.TEXT.EMB_CACHE, args.split),
+                     dataset.get_caption_by_ix, n_captions, encoders,
+                     batch_size=args.batch_size,
+                     caption_length=dataset.caption_length,
+                     draws=cfg.TEXT.EMB_CACHE_DRAWS)
@@ -38,6 +38,9 @@ __C.TRAIN.FLAG = True
 __C.TRAIN.B_NET_D = True
 __C.TRAIN.NET_G = ''
 __C.TRAIN.NET_E = ''
+# per-phase timings of the train loop: a .jsonl, .db or .sqlite path, '' to disable
+__C.TRAIN.METRICS = ''
+__C.TRAIN.METRICS_INTERVAL = 100
 
 # weights for the pretrained image-text matching models:
 __C.TRAIN.WEIGHT = edict()
@@ -70,6 +73,12 @@ __C.TEXT = edict()
 __C.TEXT.CAPTIONS_PER_IMAGE = 10
 __C.TEXT.EMBEDDING_DIM = 256
 __C.TEXT.WORDS_NUM = 18
+# directory of a cache built by cache_text_embeddings.py, '' to disable
+__C.TEXT.EMB_CACHE = ''
+# word subsets cached for each caption longer than WORDS_NUM; a read picks
+# one at random, where the encoder would see a new subset every epoch, so
+# 1 fixes a single subset per caption for the whole training
+__C.TEXT.EMB_CACHE_DRAWS = 8
 
 #Layout options - LO
 __C.LO = edict()
@@ -86,6 +95,16 @@ __C.LO.LEARNING_RATE = 0.002 # learning rate
 
 __C.RP = edict()
 __C.RP.EPOCH = 400
+# the R-precision is reported as mean +- std over this many splits
+__C.RP.N_SPLITS = 10
+# seed of the mismatched captions, saved per seed next to the test set
+__C.RP.MISMATCH_SEED = 100
+
+# int8 DAMSM encoders for CPU-only evaluation, see rp_quantize.py
+__C.QUANT = edict()
+__C.QUANT.FLAG = False
+# calibrated image encoder, image_encoder200_int8.pt next to the fp32 one if ''
+__C.QUANT.IMAGE_ENCODER = ''
 
 __C.ATT = edict()
 __C.ATT.VISUALIZATION = False
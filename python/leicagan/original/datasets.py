@@ -11,9 +11,10 @@ import numpy.random as random
 import pickle
 
 from miscc.utils import load_pickle
+from miscc.image_io import open_image
 
 def prepare_data(data):
-    imgs, captions, captions_lens, class_ids, keys = data
+    imgs, captions, captions_lens, class_ids, keys = data[:5]
 
     # sort data by the length in a decreasing order
     sorted_cap_lens, sorted_cap_indices = \
@@ -37,8 +38,15 @@ def prepare_data(data):
         captions = Variable(captions)
         sorted_cap_lens = Variable(sorted_cap_lens)
 
-    return [real_imgs, captions, sorted_cap_lens,
-            class_ids, keys]
+    ret = [real_imgs, captions, sorted_cap_lens,
+           class_ids, keys]
+    # words_embs / sent_emb pairs from a TextEmbeddingCache
+    for emb in data[5:]:
+        emb = emb[sorted_cap_indices]
+        if cfg.CUDA:
+            emb = emb.cuda()
+        ret.append(Variable(emb))
+    return ret
 
 def prepare_tii_data(data):
     A1_imgs, A2_imgs, B1_imgs, captions, captions_lens, A1_cls_id, B1_cls_id, A1_keys = data
@@ -81,18 +89,10 @@ def prepare_tii_data(data):
             A1_cls_id, B1_cls_id, A1_keys]
 
 
-def load_imgs(img_path, imsize, bbox=None, transform=None, normalize=None):
-    img = Image.open(img_path).convert('RGB')
-    width, height = img.size
-    if bbox is not None:
-        r = int(np.maximum(bbox[2], bbox[3]) * 0.75)
-        center_x = int((2 * bbox[0] + bbox[2]) / 2)
-        center_y = int((2 * bbox[1] + bbox[3]) / 2)
-        y1 = np.maximum(0, center_y - r)
-        y2 = np.minimum(height, center_y + r)
-        x1 = np.maximum(0, center_x - r)
-        x2 = np.minimum(width, center_x + r)
-        img = img.crop([x1, y1, x2, y2])
+def load_imgs(img_path, imsize, bbox=None, transform=None, normalize=None,
+              load_size=None):
+    # load_size: the size transform resizes to, if it does
+    img = open_image(img_path, load_size, bbox)
 
     if transform is not None:
         img = transform(img)
@@ -125,7 +125,8 @@ def get_similar_cls_image(current_img_idx, idx_opts):
 class TextDataset(data.Dataset):
     def __init__(self, data_dir, split='train',
                  base_size=64,
-                 transform=None, target_transform=None):
+                 transform=None, target_transform=None,
+                 text_cache=None):
         self.transform = transform
         self.norm = transforms.Compose([
             transforms.ToTensor(),
@@ -137,6 +138,10 @@ class TextDataset(data.Dataset):
         for i in range(cfg.TREE.BRANCH_NUM):
             self.imsize.append(base_size)
             base_size = base_size * 2
+        # the image transforms start with Resize(imsize * 72 / 64)
+        self.load_size = None
+        if transform is not None:
+            self.load_size = int(self.imsize[-1] * 72 / 64)
         self.data = []
         self.data_dir = data_dir
         if cfg.CONFIG_NAME == 'Layout':
@@ -162,12 +167,24 @@ class TextDataset(data.Dataset):
             print('len of datatset:', len(self.dataset))
             del dataset
             print('Load dataset from:', dataset_path)
+        # precomputed text embeddings, see cache_text_embeddings.py
+        self.text_cache = text_cache
 
     def load_dictionary(self, dict_path):
         with open(dict_path, 'rb') as f:
             ixtoword, wordtoix, n_words = pickle.load(f, encoding='iso-8859-1')
             return [ixtoword, wordtoix, n_words]
 
+    def caption_length(self, sent_ix):
+        # the number of words, before get_caption keeps WORDS_NUM of them
+        current_data = self.dataset[sent_ix // self.embeddings_num]
+        return len(current_data['text'][sent_ix % self.embeddings_num])
+
+    def get_caption_by_ix(self, sent_ix):
+        # sent_ix = index * embeddings_num + caption index
+        current_data = self.dataset[sent_ix // self.embeddings_num]
+        return self.get_caption(current_data['text'][sent_ix % self.embeddings_num])
+
     def get_caption(self, caption):
         # a list of indices for a sentence
         sent_caption = np.asarray(caption).astype('int64')
@@ -202,23 +219,31 @@ class TextDataset(data.Dataset):
             if cfg.DATASET_NAME == 'bird':
                 img_name = ('%s/segmentation/%s/%s' % (self.data_dir, current_data['img_class'], key)).replace('jpg', 'png')
                 imgs = load_imgs(img_name, self.imsize,
-                            bbox, self.transform, normalize=self.norm)
+                            bbox, self.transform, normalize=self.norm,
+                            load_size=self.load_size)
             elif cfg.DATASET_NAME == 'flower':
                 img_name = ('%s/segmentation/%s.jpg' % (self.data_dir, key.replace('image', 'segmim')))
                 imgs = load_imgs(img_name, self.imsize,
-                            bbox, self.transform, normalize=self.norm)
+                            bbox, self.transform, normalize=self.norm,
+                            load_size=self.load_size)
         elif cfg.DATASET_NAME == 'flower':
             img_name = '%s/images/%s.jpg' % (self.data_dir, key)
             imgs = load_imgs(img_name, self.imsize,
-                             bbox, self.transform, normalize=self.norm)
+                             bbox, self.transform, normalize=self.norm,
+                             load_size=self.load_size)
             key = key+'.jpg'
         else:
             img_name = '%s/images/%s/%s' % (self.data_dir, current_data['img_class'], key)
             imgs = load_imgs(img_name, self.imsize,
-                            bbox, self.transform, normalize=self.norm)
+                            bbox, self.transform, normalize=self.norm,
+                            load_size=self.load_size)
 
         # random select a sentence
         random_ix = random.randint(0, self.embeddings_num)
+        if self.text_cache is not None:
+            cached = self.text_cache.get(index * self.embeddings_num + random_ix)
+            caps, cap_len, embs = cached[0], cached[1], cached[2:]
+            return [imgs, caps, cap_len, cls_id, key[0:-4]] + embs
         current_captions = current_data['text'][random_ix]
         caps, cap_len = self.get_caption(current_captions)
         return imgs, caps, cap_len, cls_id, key[0:-4]
@@ -240,6 +265,10 @@ class TIIDataset(data.Dataset):
         for i in range(cfg.TREE.BRANCH_NUM):
             self.imsize.append(base_size)
             base_size = base_size * 2
+        # the image transforms start with Resize(imsize * 72 / 64)
+        self.load_size = None
+        if transform is not None:
+            self.load_size = int(self.imsize[-1] * 72 / 64)
         self.data = []
         self.data_dir = data_dir
         self.ixtoword, self.wordtoix, self.n_words = self.load_dictionary(data_dir+'/dictionary.pickle')
@@ -301,7 +330,8 @@ class TIIDataset(data.Dataset):
             img_name = '%s/images/%s.jpg' % (self.data_dir, key)
         else:
             img_name = '%s/images/%s/%s' % (self.data_dir, img_data['img_class'], key)
-        imgs = load_imgs(img_name, self.imsize, bbox, self.transform, normalize=self.norm)
+        imgs = load_imgs(img_name, self.imsize, bbox, self.transform, normalize=self.norm,
+                            load_size=self.load_size)
         return key, cls_id, bbox, img_name, imgs
 
     def __getitem__(self, A1_index):
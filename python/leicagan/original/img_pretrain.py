@@ -17,6 +17,7 @@ import pickle
 from PIL import Image
 from torch.autograd import Variable
 from miscc.utils import load_pickle
+from miscc.image_io import open_image
 
 dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
 sys.path.append(dir_path)
@@ -24,17 +25,7 @@ sys.path.append(dir_path)
 UPDATE_INTERVAL = 20
 
 def load_imgs(img_path, bbox=None):
-    img = Image.open(img_path).convert('RGB')
-    width, height = img.size
-    if bbox is not None:
-        r = int(np.maximum(bbox[2], bbox[3]) * 0.75)
-        center_x = int((2 * bbox[0] + bbox[2]) / 2)
-        center_y = int((2 * bbox[1] + bbox[3]) / 2)
-        y1 = np.maximum(0, center_y - r)
-        y2 = np.minimum(height, center_y + r)
-        x1 = np.maximum(0, center_x - r)
-        x2 = np.minimum(width, center_x + r)
-        img = img.crop([x1, y1, x2, y2])
+    img = open_image(img_path, int(256 * 72 / 64), bbox)
 
     normalize = transforms.Compose([
                 transforms.Resize((int(256 * 72 / 64), int(256 * 72 / 64))),
@@ -1,6 +1,8 @@
 from cfg.config import cfg, cfg_from_file
 from datasets import TextDataset
 from trainer import condGANTrainer as trainer
+from trainer import get_encoder_path
+from miscc.text_cache import TextEmbeddingCache
 
 import os
 import sys
@@ -121,9 +123,15 @@ if __name__ == "__main__":
         transforms.RandomCrop(imsize),
         transforms.RandomHorizontalFlip()])
 
+    text_cache = None
+    if cfg.TRAIN.FLAG and cfg.TEXT.EMB_CACHE != '':
+        checkpoints = {'text': get_encoder_path(cfg.ENCODER1)}
+        text_cache = TextEmbeddingCache(os.path.join(cfg.TEXT.EMB_CACHE, split_dir),
+                                        checkpoints)
     dataset = TextDataset(os.path.join(cfg.DATA_DIR, cfg.DATASET_NAME), split_dir,
                           base_size=cfg.TREE.BASE_SIZE,
-                          transform=image_transform)
+                          transform=image_transform,
+                          text_cache=text_cache)
     assert dataset
     dataloader = torch.utils.data.DataLoader(
         dataset, batch_size=cfg.TRAIN.BATCH_SIZE,
@@ -0,0 +1,96 @@
+import os
+import json
+
+import numpy as np
+
+
+# Dense feature store ##############################################
+# The features of a dataset as contiguous float16 .npy arrays in one
+# directory, <name>.npy is rows x dim. index.json holds the keys of the
+# rows and how many rows of every array are written, so an extraction
+# resumes where it stopped and readers memory-map the arrays.
+def feature_store_path(model_dir, split='test'):
+    # the features of split, next to the DAMSM encoders they come from
+    return os.path.join(model_dir, '%s_features' % split)
+
+
+class FeatureStore(object):
+    INDEX = 'index.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+        index_path = os.path.join(path, self.INDEX)
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'keys': [], 'arrays': {}}
+
+    def array_path(self, name):
+        return os.path.join(self.path, '%s.npy' % name)
+
+    def save_index(self):
+        # written aside and renamed, a crash never leaves half an index
+        tmp_path = os.path.join(self.path, self.INDEX + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.path, self.INDEX))
+
+    def set_keys(self, keys, **meta):
+        # keys: one per row of the image level arrays, meta: anything
+        # the readers need to map rows (e.g. captions_per_image)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        keys = [str(key) for key in keys]
+        if self.index['keys'] != keys:
+            # another dataset, nothing written so far is valid
+            self.index = {'keys': keys, 'arrays': {}}
+        self.index.update(meta)
+        self.save_index()
+
+    @property
+    def keys(self):
+        return self.index['keys']
+
+    def create(self, name, rows, dim):
+        """
+            Opens <name>.npy for writing, returns the number of rows
+            already written (0 unless an extraction of the same shape
+            is resumed).
+        """
+        info = self.index['arrays'].get(name)
+        path = self.array_path(name)
+        if info is not None and info['rows'] == rows and info['dim'] == dim \
+                and os.path.isfile(path):
+            self.arrays[name] = np.lib.format.open_memmap(path, mode='r+')
+        else:
+            self.arrays[name] = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                                          shape=(rows, dim))
+            info = {'rows': rows, 'dim': dim, 'done': 0}
+            self.index['arrays'][name] = info
+            self.save_index()
+        return info['done']
+
+    def write(self, name, rows, features):
+        # rows: the row of every feature, features: len(rows) x dim
+        self.arrays[name][np.asarray(rows)] = np.asarray(features, dtype=np.float16)
+
+    def commit(self, name, done):
+        # rows [0, done) of name are written and survive a restart
+        self.arrays[name].flush()
+        self.index['arrays'][name]['done'] = int(done)
+        self.save_index()
+
+    def done(self, name):
+        info = self.index['arrays'].get(name)
+        return 0 if info is None else info['done']
+
+    def complete(self, name):
+        info = self.index['arrays'].get(name)
+        return info is not None and info['done'] == info['rows']
+
+    def load(self, name, mmap_mode='r'):
+        # the whole array, memory-mapped by default
+        assert self.complete(name), '%s of %s is not fully extracted' % (name, self.path)
+        return np.load(self.array_path(name), mmap_mode=mmap_mode)
@@ -5,6 +5,7 @@ import numpy as np
 from cfg.config import cfg
 from GlobalAttention import func_attention
 from miscc.utils import l1norm, l2norm
+from miscc.metrics import phase
 
 
 def triplet_loss(featureA1, featureA2, featureB, margin=1.0, p=2):
@@ -204,21 +205,22 @@ def generator_loss(netsD, image_encoder, fake_imgs, real_labels,
 
         # Ranking loss
         if i == (numDs - 1):
-            # words_features: batch_size x nef x 17 x 17
-            # sent_code: batch_size x nef
-            region_features, image_feature = image_encoder(fake_imgs[i])
-            w_loss0, w_loss1, _ = words_loss(region_features, words_embs,
-                                             match_labels, cap_lens,
-                                             class_ids, batch_size)
-            w_loss = (w_loss0 + w_loss1) * \
-                cfg.TRAIN.SMOOTH.LAMBDA
-            # err_words = err_words + w_loss.item()
-
-            s_loss0, s_loss1 = sent_loss(image_feature, sent_emb,
-                                         match_labels, class_ids, batch_size)
-            s_loss = (s_loss0 + s_loss1) * \
-                cfg.TRAIN.SMOOTH.LAMBDA
-            # err_sent = err_sent + s_loss.item()
+            with phase('damsm'):
+                # words_features: batch_size x nef x 17 x 17
+                # sent_code: batch_size x nef
+                region_features, image_feature = image_encoder(fake_imgs[i])
+                w_loss0, w_loss1, _ = words_loss(region_features, words_embs,
+                                                 match_labels, cap_lens,
+                                                 class_ids, batch_size)
+                w_loss = (w_loss0 + w_loss1) * \
+                    cfg.TRAIN.SMOOTH.LAMBDA
+                # err_words = err_words + w_loss.item()
+
+                s_loss0, s_loss1 = sent_loss(image_feature, sent_emb,
+                                             match_labels, class_ids, batch_size)
+                s_loss = (s_loss0 + s_loss1) * \
+                    cfg.TRAIN.SMOOTH.LAMBDA
+                # err_sent = err_sent + s_loss.item()
 
             errG_total += w_loss + s_loss
             logs += 'w_loss: %.2f s_loss: %.2f ' % (w_loss.item(), s_loss.item())
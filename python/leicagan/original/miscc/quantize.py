@@ -0,0 +1,77 @@
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from cfg.config import cfg
+
+
+# int8 DAMSM encoders for CPU-only evaluation ######################
+# RNN_ENCODER: dynamic quantization, int8 weights of the LSTM/GRU and
+# Linear layers, the activations are quantized on the fly.
+# CNN_ENCODER: static quantization of the whole Inception stack, the
+# activation ranges come from a calibration pass (rp_quantize.py), the
+# result is saved as TorchScript.
+QUANT_ENGINE = 'x86'
+
+
+def quantize_text_encoder(text_encoder):
+    text_encoder = copy.deepcopy(text_encoder).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(
+        text_encoder, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def prepare_image_encoder(image_encoder, example_imgs):
+    # returns a copy of image_encoder with observers, run the calibration
+    # images through it, then convert_image_encoder
+    torch.backends.quantized.engine = QUANT_ENGINE
+    image_encoder = copy.deepcopy(image_encoder).cpu().eval()
+    return prepare_fx(image_encoder, get_default_qconfig_mapping(QUANT_ENGINE),
+                      (example_imgs,))
+
+
+def calibrate(prepared, batches):
+    count = 0
+    with torch.no_grad():
+        for imgs in batches:
+            prepared(imgs)
+            count += imgs.size(0)
+    return count
+
+
+def convert_image_encoder(prepared):
+    return convert_fx(prepared)
+
+
+def save_image_encoder(quantized, path, example_imgs):
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example_imgs)
+    torch.jit.save(traced, path)
+
+
+def quantized_image_encoder_path(fp32_path):
+    return cfg.QUANT.IMAGE_ENCODER or fp32_path.replace('.pth', '_int8.pt')
+
+
+def load_image_encoder(path):
+    # same (features, cnn_code) outputs as CNN_ENCODER, on the CPU
+    torch.backends.quantized.engine = QUANT_ENGINE
+    image_encoder = torch.jit.load(path, map_location='cpu')
+    image_encoder.eval()
+    return image_encoder
+
+
+def time_forward(forward, batches, warmup=1):
+    # seconds per batch, median over the batches after warmup
+    times = []
+    with torch.no_grad():
+        for i, batch in enumerate(batches):
+            start_t = time.time()
+            forward(batch)
+            if i >= warmup:
+                times.append(time.time() - start_t)
+    return float(np.median(times)) if times else None
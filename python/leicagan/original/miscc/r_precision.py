@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+# R-precision ######################################################
+# An image is ranked against its own caption and M mismatched ones by
+# cosine similarity; the features are L2-normalized once, so a batch of
+# B images is scored with one B x M (batched) matrix product. The
+# features can be tensors on any device or numpy / memory-mapped
+# arrays, so the scoring runs offline on the CPU as well.
+def as_tensor(features, device=None):
+    if not torch.is_tensor(features):
+        # a copy, memory-mapped (float16) features are read-only
+        features = torch.from_numpy(np.array(features, dtype=np.float32))
+    return features.to(device=device, dtype=torch.float32)
+
+
+def candidate_ranks(img_features, sent_features, mismatch_features):
+    """
+        img_features, sent_features: B x D, image i matches caption i
+        mismatch_features: B x M x D, the mismatched captions of every image
+        Returns B LongTensor ranks of the matching caption, 0 when no
+        mismatched caption scores as high (a top-1 hit).
+    """
+    img_features = F.normalize(as_tensor(img_features), dim=1)
+    device = img_features.device
+    sent_features = F.normalize(as_tensor(sent_features, device), dim=1)
+    mismatch_features = F.normalize(as_tensor(mismatch_features, device), dim=2)
+    match = (img_features * sent_features).sum(1, keepdim=True)
+    # --> B x M
+    mismatch = torch.bmm(mismatch_features, img_features.unsqueeze(2)).squeeze(2)
+    return (mismatch >= match).sum(1)
+
+
+def ranks_from_bank(img_features, sent_features, bank, mismatch_ids,
+                    batch_size=1000, device=None):
+    """
+        img_features, sent_features: N x D
+        bank: T x D caption features, mismatch_ids: N x M rows of bank
+        Scores batch_size images at a time on device (the CPU if None),
+        returns the N ranks as a numpy array.
+    """
+    ranks = []
+    with torch.no_grad():
+        for start in range(0, len(img_features), batch_size):
+            end = min(start + batch_size, len(img_features))
+            ids = np.asarray(mismatch_ids[start:end])
+            # sorted unique rows read a memory-mapped bank in one pass
+            rows, inverse = np.unique(ids, return_inverse=True)
+            mismatch = as_tensor(bank[rows], device)[torch.from_numpy(inverse.reshape(ids.shape))
+                                                     .to(device)]
+            ranks.append(candidate_ranks(as_tensor(img_features[start:end], device),
+                                         sent_features[start:end], mismatch).cpu())
+    return torch.cat(ranks).numpy()
+
+
+def split_scores(ranks, k=5, n_splits=10):
+    """
+        Top-1 .. top-k R-precision of ranks over n_splits consecutive
+        splits. Returns the k means and standard deviations.
+    """
+    splits = np.array_split(np.asarray(ranks), n_splits)
+    scores = np.array([[np.mean(split < top) for top in range(1, k + 1)]
+                       for split in splits])
+    return scores.mean(0), scores.std(0)
+
+
+def format_scores(mean, std):
+    return ', '.join('top%d %.4f +- %.4f' % (i + 1, m, s)
+                     for i, (m, s) in enumerate(zip(mean, std)))
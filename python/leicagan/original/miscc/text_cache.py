@@ -0,0 +1,190 @@
+import os
+import json
+import hashlib
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import torch
+
+from cfg.config import cfg
+from miscc.utils import mkdir_p
+
+
+# Embeddings of frozen text encoders ###############################
+# One row per (image, caption index), i.e. index * CAPTIONS_PER_IMAGE + sent_ix.
+# captions.npy / cap_lens.npy hold the word indices the encoders saw,
+# <name>_words_embs.npy (R x nef x WORDS_NUM) and <name>_sent_emb.npy
+# (R x nef) hold the float16 outputs of the encoder called <name>.
+# get_caption keeps a random subset of the words of a caption longer
+# than WORDS_NUM, a new one every epoch. Such a caption gets `draws`
+# rows, its own and draws - 1 from draw_start.npy on (draw_count.npy),
+# and every read picks one of them, so the subsampling survives the cache.
+def file_checksum(path, block_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def build_text_cache(cache_dir, get_caption, n_captions, encoders,
+                     batch_size=100, caption_length=None, draws=1):
+    """
+        get_caption: sent_ix --> (WORDS_NUM x 1 word indices, length)
+        encoders: {name: (RNN_ENCODER, checkpoint path)}
+        caption_length: sent_ix --> number of words before subsampling,
+            captions longer than WORDS_NUM get draws word subsets
+    """
+    mkdir_p(cache_dir)
+    words_num = cfg.TEXT.WORDS_NUM
+    nef = cfg.TEXT.EMBEDDING_DIM
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.isfile(meta_path):
+        # an incomplete cache must never look valid
+        os.remove(meta_path)
+
+    # the caption of every row, the extra draws after the n_captions rows
+    draw_count = np.ones(n_captions, dtype='int64')
+    if caption_length is not None and draws > 1:
+        for sent_ix in range(n_captions):
+            if caption_length(sent_ix) > words_num:
+                draw_count[sent_ix] = draws
+    draw_start = n_captions + np.cumsum(draw_count - 1) - (draw_count - 1)
+    row_captions = np.concatenate([np.arange(n_captions, dtype='int64'),
+                                   np.repeat(np.arange(n_captions), draw_count - 1)])
+    n_rows = len(row_captions)
+    np.save(os.path.join(cache_dir, 'draw_start.npy'), draw_start)
+    np.save(os.path.join(cache_dir, 'draw_count.npy'), draw_count)
+
+    captions = open_memmap(os.path.join(cache_dir, 'captions.npy'), mode='w+',
+                           dtype='int64', shape=(n_rows, words_num))
+    cap_lens = open_memmap(os.path.join(cache_dir, 'cap_lens.npy'), mode='w+',
+                           dtype='int64', shape=(n_rows,))
+    outputs = {}
+    for name in encoders:
+        words_embs = open_memmap(os.path.join(cache_dir, '%s_words_embs.npy' % name),
+                                 mode='w+', dtype='float16',
+                                 shape=(n_rows, nef, words_num))
+        sent_emb = open_memmap(os.path.join(cache_dir, '%s_sent_emb.npy' % name),
+                               mode='w+', dtype='float16',
+                               shape=(n_rows, nef))
+        outputs[name] = (words_embs, sent_emb)
+        encoders[name][0].eval()
+
+    with torch.no_grad():
+        for start in range(0, n_rows, batch_size):
+            end = min(start + batch_size, n_rows)
+            caps, lens = [], []
+            for sent_ix in row_captions[start:end]:
+                cap, cap_len = get_caption(int(sent_ix))
+                caps.append(cap[:, 0])
+                lens.append(cap_len)
+            caps = np.stack(caps, 0)
+            lens = np.asarray(lens, dtype='int64')
+            captions[start:end] = caps
+            cap_lens[start:end] = lens
+
+            # pack_padded_sequence wants a decreasing length order
+            order = np.argsort(-lens, kind='mergesort')
+            rows = start + order
+            sorted_caps = torch.from_numpy(caps[order])
+            sorted_lens = torch.from_numpy(lens[order])
+            if cfg.CUDA:
+                sorted_caps = sorted_caps.cuda()
+                sorted_lens = sorted_lens.cuda()
+            for name in encoders:
+                text_encoder = encoders[name][0]
+                hidden = text_encoder.init_hidden(end - start)
+                words_emb, sent_emb = \
+                    text_encoder(sorted_caps, sorted_lens, hidden)
+                words_emb = words_emb.cpu().numpy().astype('float16')
+                outputs[name][0][rows, :, :words_emb.shape[2]] = words_emb
+                outputs[name][1][rows] = sent_emb.cpu().numpy().astype('float16')
+            if start // batch_size % 100 == 0:
+                print('cached captions: %d/%d' % (end, n_rows))
+
+    captions.flush()
+    cap_lens.flush()
+    for name in outputs:
+        outputs[name][0].flush()
+        outputs[name][1].flush()
+    meta = {'n_captions': n_captions,
+            'n_rows': n_rows,
+            'draws': draws,
+            'words_num': words_num,
+            'embedding_dim': nef,
+            'checksums': dict((name, file_checksum(encoders[name][1]))
+                              for name in encoders),
+            'checkpoints': dict((name, encoders[name][1])
+                                for name in encoders)}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('Save text embeddings to: ', cache_dir)
+
+
+class TextEmbeddingCache(object):
+    def __init__(self, cache_dir, checkpoints):
+        """
+            checkpoints: {name: checkpoint path}, each has to be the
+            encoder checkpoint the cache was built from
+        """
+        self.cache_dir = cache_dir
+        self.names = list(checkpoints)
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['words_num'] != cfg.TEXT.WORDS_NUM or \
+                meta['embedding_dim'] != cfg.TEXT.EMBEDDING_DIM:
+            raise ValueError('Text cache %s was built for WORDS_NUM %d and '
+                             'EMBEDDING_DIM %d' % (cache_dir, meta['words_num'],
+                                                   meta['embedding_dim']))
+        for name in self.names:
+            if name not in meta['checksums'] or \
+                    meta['checksums'][name] != file_checksum(checkpoints[name]):
+                raise ValueError('Text cache %s does not match the %s encoder %s'
+                                 % (cache_dir, name, checkpoints[name]))
+        self.n_captions = meta['n_captions']
+        print('Load text embeddings from: ', cache_dir)
+        self.arrays = None
+
+    def __getstate__(self):
+        # every DataLoader worker maps the files itself
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def load(self):
+        if self.arrays is None:
+            def load_array(filename):
+                return np.load(os.path.join(self.cache_dir, filename),
+                               mmap_mode='r')
+            self.arrays = {'captions': load_array('captions.npy'),
+                           'cap_lens': load_array('cap_lens.npy')}
+            if os.path.isfile(os.path.join(self.cache_dir, 'draw_count.npy')):
+                self.arrays['draw_start'] = np.load(os.path.join(self.cache_dir,
+                                                                 'draw_start.npy'))
+                self.arrays['draw_count'] = np.load(os.path.join(self.cache_dir,
+                                                                 'draw_count.npy'))
+            for name in self.names:
+                self.arrays[name] = (load_array('%s_words_embs.npy' % name),
+                                     load_array('%s_sent_emb.npy' % name))
+        return self.arrays
+
+    def get(self, sent_ix):
+        """
+            returns caption (WORDS_NUM x 1), cap_len and, for each encoder
+            name, words_emb (nef x WORDS_NUM) and sent_emb (nef) in float32
+        """
+        arrays = self.load()
+        row = sent_ix
+        if 'draw_count' in arrays and arrays['draw_count'][sent_ix] > 1:
+            # one of the word subsets, as get_caption draws a new one
+            draw = np.random.randint(arrays['draw_count'][sent_ix])
+            if draw > 0:
+                row = int(arrays['draw_start'][sent_ix]) + draw - 1
+        cap = np.array(arrays['captions'][row]).reshape(-1, 1)
+        cap_len = int(arrays['cap_lens'][row])
+        embs = []
+        for name in self.names:
+            embs.append(np.asarray(arrays[name][0][row], dtype='float32'))
+            embs.append(np.asarray(arrays[name][1][row], dtype='float32'))
+        return [cap, cap_len] + embs
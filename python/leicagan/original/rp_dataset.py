@@ -11,13 +11,15 @@ import pickle
 from miscc.utils import load_pickle
 
 def prepare_RP_data(data):
-    caps, cap_len, A_keys, A_cls_id = data
+    caps, cap_len, A_keys, A_cls_id, A_index = data
 
     sorted_cap_lens, sorted_cap_indices = \
         torch.sort(cap_len, 0, True)
 
     captions = caps[sorted_cap_indices].squeeze()
-    # A_cls_id = A_cls_id[sorted_cap_indices].numpy()
+    # the class ids and dataset indices follow the captions
+    A_cls_id = A_cls_id[sorted_cap_indices]
+    A_index = A_index[sorted_cap_indices]
     A_keys = [A_keys[i] for i in sorted_cap_indices.numpy()]
     if cfg.CUDA:
         captions = Variable(captions).cuda()
@@ -26,28 +28,46 @@ def prepare_RP_data(data):
         captions = Variable(captions)
         sorted_cap_lens = Variable(sorted_cap_lens)
 
-    return [captions, sorted_cap_lens, A_keys, A_cls_id]
-
-def get_mis_99(current_cls_id, cls2imgid, img2textfeature):
-    # print('current_cls_id:', current_cls_id)
-    all_cls = list(cls2imgid.keys())
-    # print('all_cls:', all_cls)
-    cls_p = (np.array(all_cls) != current_cls_id) / (len(all_cls) - 1)
-    # print('cls_p:', cls_p)
-    diff_cls_idx = np.random.choice(all_cls, 99, p=cls_p)
-    # print('diff_cls_idx:', diff_cls_idx)
-    texts = []
-    for idx in diff_cls_idx:
-        # print('idx:', idx)
-        img_idx = np.random.choice(cls2imgid[idx], 1)
-        img_idx = img_idx[0]
-        print('img_idx:', img_idx)
-        random_text_id = np.random.randint(0, 10)
-        print('random_text_id:', random_text_id)
-        text_feature = img2textfeature[img_idx][random_text_id]
-        texts.append(text_feature)
-    assert len(texts) == 99
-    return texts
+    return [captions, sorted_cap_lens, A_keys, A_cls_id, A_index]
+
+
+def build_mismatch_bank(cls_ids, cls2imgid, captions_per_image, seed, n=99):
+    """
+        n mismatched captions for every item, as rows of the sentence
+        features of rp_pre_extraction (image * captions_per_image + text),
+        drawn all at once: a class other than the item's, uniformly, an
+        image of it, and one of its captions.
+        cls_ids: the class id of each of the N items
+        Returns an N x n int64 array.
+    """
+    classes = np.array(sorted(cls2imgid))
+    counts = np.array([len(cls2imgid[c]) for c in classes])
+    starts = np.cumsum(counts) - counts
+    img_ids = np.concatenate([np.asarray(cls2imgid[c]) for c in classes]).astype('int64')
+    own = np.searchsorted(classes, np.asarray(cls_ids))
+
+    rng = np.random.RandomState(seed)
+    shape = (len(own), n)
+    # uniform over the other classes: skip the item's own one
+    pick = rng.randint(0, len(classes) - 1, shape)
+    pick += pick >= own[:, None]
+    imgs = img_ids[starts[pick] + (rng.random_sample(shape) * counts[pick]).astype('int64')]
+    return imgs * captions_per_image + rng.randint(0, captions_per_image, shape)
+
+
+def load_mismatch_bank(data_dir, cls_ids, cls2imgid, captions_per_image, seed, n=99):
+    # built once per seed and saved next to the dataset, so that every
+    # evaluation run ranks against the same captions
+    path = os.path.join(data_dir, 'test_mismatch%d_seed%d.npy' % (n, seed))
+    if os.path.isfile(path):
+        bank = np.load(path)
+        if bank.shape == (len(cls_ids), n):
+            print('Load mismatched captions from:', path)
+            return bank
+    bank = build_mismatch_bank(cls_ids, cls2imgid, captions_per_image, seed, n)
+    np.save(path, bank)
+    print('Save mismatched captions to:', path)
+    return bank
 
 
 def load_imgs(img_path):
@@ -74,8 +94,6 @@ class RPDataset(data.Dataset):
         self.ixtoword, self.wordtoix, self.n_words = self.load_dictionary(data_dir+'/dictionary.pickle')
         dataset_path = self.data_dir + '/test_dataset.pickle'
         self.cls2imgid = load_pickle(data_dir + '/test_cls2imgid.pickle')
-        encoder_dir = '%s/%s_%s/Model' % (cfg.OUTPUT_DIR, cfg.DATASET_NAME, cfg.ENCODER1)
-        self.img2textfeature = load_pickle(os.path.join(encoder_dir, 'testimg2textfeature.pickle'))
         with open(dataset_path, 'rb') as f:
             dataset = pickle.load(f)
             self.dataset = dataset
@@ -129,7 +147,11 @@ class RPDataset(data.Dataset):
         random_ix = np.random.randint(0, self.embeddings_num)
         current_captions = self.dataset[A_index]['text'][random_ix]
         caps, cap_len = self.get_caption(current_captions)
-        return caps, cap_len, A_key[0:-4], A_cls_id
+        return caps, cap_len, A_key[0:-4], A_cls_id, A_index
+
+    def class_ids(self):
+        # the class id of every item, in the dataset order
+        return [int(str(img_data['cls_index'])) for img_data in self.dataset]
 
     def __len__(self):
         return len(self.dataset)
@@ -1,6 +1,7 @@
 from cfg.config import cfg, cfg_from_file
 from rp_dataset import RPDataset
 from rp_trainer import condGANTrainer as Trainer
+from miscc.feature_store import FeatureStore, feature_store_path
 import os
 import sys
 import time
@@ -24,12 +25,21 @@ def parse_args():
     return args
 
 
+def worker_init_fn(worker_id):
+    # RPDataset picks the captions with np.random, seed every loader
+    # worker from its torch seed, which follows the manual seed
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
 if __name__ == "__main__":
     args = parse_args()
     if args.cfg_file is not None:
         cfg_from_file(args.cfg_file)
 
-    assert torch.cuda.is_available(), 'No GPUs..'
+    if cfg.CUDA:
+        assert torch.cuda.is_available(), 'No GPUs..'
+    # the int8 encoders of QUANT.FLAG only run on the CPU
+    assert not (cfg.QUANT.FLAG and cfg.CUDA), 'set CUDA: False with QUANT.FLAG'
 
     print('Using config:')
     pprint.pprint(cfg)
@@ -50,9 +60,9 @@ if __name__ == "__main__":
 
     output_dir = '%s/%s_%s/%s' % (cfg.OUTPUT_DIR, cfg.DATASET_NAME, cfg.GAN.GNET, cfg.CONFIG_NAME)
     encoder_dir = '%s/%s_%s/Model' % (cfg.OUTPUT_DIR, cfg.DATASET_NAME, cfg.ENCODER1)
-    img2textfeature_file = os.path.join(encoder_dir, 'testimg2textfeature.pickle')
-    print(img2textfeature_file)
-    assert os.path.isfile(img2textfeature_file), 'run rp_pre_extraction first!'
+    store = FeatureStore(feature_store_path(encoder_dir))
+    print(store.path)
+    assert store.complete('sent'), 'run rp_pre_extraction first!'
     # Get data loader
     imsize = cfg.TREE.BASE_SIZE * (2 ** (cfg.TREE.BRANCH_NUM - 1))
     dataset = RPDataset(os.path.join(cfg.DATA_DIR, cfg.DATASET_NAME), base_size=cfg.TREE.BASE_SIZE, transform=None)
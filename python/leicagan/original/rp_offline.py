@@ -0,0 +1,80 @@
+from miscc.r_precision import ranks_from_bank, split_scores, format_scores
+from miscc.feature_store import FeatureStore
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='R-precision of precomputed features, '
+                                                 'without the models')
+    parser.add_argument('--store', type=str, default='',
+                        help='feature store of rp_pre_extraction.py (--images), '
+                             'instead of --img_features / --sent_features / --bank')
+    parser.add_argument('--caption', type=int, default=0,
+                        help='with --store, the caption of every image that matches it, '
+                             '-1 draws one per image with --seed')
+    parser.add_argument('--seed', type=int, default=100)
+    parser.add_argument('--img_features', type=str, default='',
+                        help='.npy, N x D image features')
+    parser.add_argument('--sent_features', type=str, default='',
+                        help='.npy, N x D features of the matching captions')
+    parser.add_argument('--mismatch', type=str, required=True,
+                        help='.npy, N x 99 rows of the caption bank')
+    parser.add_argument('--bank', type=str, default='',
+                        help='.npy, T x D caption features the mismatch ids index, '
+                             '--sent_features if empty')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--n_splits', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=-1)
+    args = parser.parse_args()
+    if not args.store and not (args.img_features and args.sent_features):
+        parser.error('--store or both --img_features and --sent_features are required')
+    return args
+
+
+def load_store(args):
+    # img.npy rows are images, sent.npy rows are image * captions_per_image
+    # + caption, the whole of sent.npy is the bank the mismatch ids index
+    store = FeatureStore(args.store)
+    img_features = store.load('img')
+    bank = store.load('sent')
+    captions_per_image = store.index['captions_per_image']
+    if args.caption < 0:
+        texts = np.random.RandomState(args.seed).randint(0, captions_per_image,
+                                                         len(img_features))
+    else:
+        assert args.caption < captions_per_image
+        texts = np.full(len(img_features), args.caption, dtype='int64')
+    rows = np.arange(len(img_features)) * captions_per_image + texts
+    return img_features, bank[rows], bank
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device('cpu') if args.gpu_id < 0 else torch.device('cuda', args.gpu_id)
+    # memory-mapped, every batch reads only its own rows
+    if args.store:
+        img_features, sent_features, bank = load_store(args)
+    else:
+        img_features = np.load(args.img_features, mmap_mode='r')
+        sent_features = np.load(args.sent_features, mmap_mode='r')
+        bank = np.load(args.bank, mmap_mode='r') if args.bank else sent_features
+    mismatch = np.load(args.mismatch, mmap_mode='r')
+    assert len(img_features) == len(sent_features) == len(mismatch)
+
+    start_t = time.time()
+    ranks = ranks_from_bank(img_features, sent_features, bank, mismatch,
+                            args.batch_size, device)
+    mean, std = split_scores(ranks, args.k, args.n_splits)
+    print('%d images against %d captions each, %.2fs' %
+          (len(ranks), mismatch.shape[1] + 1, time.time() - start_t))
+    print('R-precision over %d splits: %s' % (args.n_splits, format_scores(mean, std)))
@@ -9,6 +9,7 @@ import argparse
 import os
 from cfg.config import cfg
 import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 import torchvision.transforms as transforms
 import numpy as np
@@ -17,6 +18,8 @@ import pickle
 from PIL import Image
 from torch.autograd import Variable
 from miscc.utils import load_pickle
+from miscc.quantize import quantize_text_encoder
+from miscc.feature_store import FeatureStore, feature_store_path
 
 dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
 sys.path.append(dir_path)
@@ -37,29 +40,30 @@ def load_imgs(img_path):
 
 
 def prepare_data(data):
-    # index, captions, cap_lens = data
-    index, captions, cap_lens, cls_id, imgs = data
+    # rows: the caption rows of the feature store, index * CAPTIONS_PER_IMAGE + text
+    rows, captions, cap_lens, cls_id, imgs = data
     # sort data by the length in a decreasing order
     sorted_cap_lens, sorted_cap_indices = torch.sort(cap_lens, 0, True)
-    captions = captions[sorted_cap_indices].squeeze()
-
-    imgs = imgs[sorted_cap_indices]
+    captions = captions[sorted_cap_indices].squeeze(2)
+    # the rows follow the captions
+    rows = rows[sorted_cap_indices]
 
     if cfg.CUDA:
         captions = Variable(captions).cuda()
         sorted_cap_lens = Variable(sorted_cap_lens).cuda()
-        imgs.cuda()
     else:
         captions = Variable(captions)
         sorted_cap_lens = Variable(sorted_cap_lens)
 
-    return [index, captions, sorted_cap_lens, imgs, cls_id]
+    return [rows, captions, sorted_cap_lens, imgs, cls_id]
 
 
 class TextDataset(data.Dataset):
     def __init__(self, data_dir, base_size=64,
-                 transform=None, target_transform=None):
+                 transform=None, target_transform=None, load_images=False):
         self.transform = transform
+        # the text features do not need the images
+        self.load_images = load_images
         self.norm = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
@@ -106,7 +110,7 @@ class TextDataset(data.Dataset):
             x_len = cfg.TEXT.WORDS_NUM
         return x, x_len
 
-    def get_img_info(self, img_index):
+    def get_img_info(self, img_index, load_images=True):
         img_data = self.dataset[img_index]
         key = img_data['img_name']
         cls_id = int(str(img_data['cls_index']))
@@ -117,91 +121,107 @@ class TextDataset(data.Dataset):
             key = key + '.jpg'
         else:
             img_name = '%s/images/%s/%s' % (self.data_dir, img_data['img_class'], key)
-        imgs = load_imgs(img_name)
+        imgs = load_imgs(img_name) if load_images else 0
         return key, cls_id, bbox, img_name, imgs
 
+    def keys(self):
+        # the key of every image, in the dataset order
+        return [self.get_img_info(i, False)[0] for i in range(len(self.dataset))]
+
     def __getitem__(self, index): # index of text
         img_index = index // cfg.TEXT.CAPTIONS_PER_IMAGE
         text_index = index % cfg.TEXT.CAPTIONS_PER_IMAGE
-        key, cls_id, bbox, name, imgs = self.get_img_info(img_index)
+        key, cls_id, bbox, name, imgs = self.get_img_info(img_index, self.load_images)
         current_captions = self.dataset[img_index]['text'][text_index]
         current_caps, current_cap_len = self.get_caption(current_captions)
 
-        return img_index, current_caps, current_cap_len, cls_id, imgs
+        return index, current_caps, current_cap_len, cls_id, imgs
 
     def __len__(self):
         return len(self.dataset)*cfg.TEXT.CAPTIONS_PER_IMAGE
 
 
+class ImageDataset(data.Dataset):
+    # the images of a TextDataset, once each
+    def __init__(self, text_dataset):
+        self.text_dataset = text_dataset
+
+    def __getitem__(self, index):
+        return index, self.text_dataset.get_img_info(index)[4]
+
+    def __len__(self):
+        return len(self.text_dataset.dataset)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='extract features of image for calculating the R precision score')
     parser.add_argument('--cfg', dest='cfg_file',
                         help='optional config file',
                         default='..', type=str)
     parser.add_argument('--manualSeed', type=int, help='manual seed')
+    parser.add_argument('--images', action='store_true',
+                        help='also extract the image features of the test images')
     args = parser.parse_args()
     return args
 
 
-def evaluate(dataloader, cnn_model, rnn_model, batch_size):
-    cnn_model.eval()
+def pending_batches(dataset, done, batch_size):
+    # the rows from done on, in order, so that a prefix is always complete
+    return torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, range(done, len(dataset))),
+        batch_size=batch_size, drop_last=False,
+        shuffle=False, num_workers=int(cfg.WORKERS))
+
+
+def extract_text_features(dataset, rnn_model, store, batch_size):
+    # sentence features of every caption, row index * CAPTIONS_PER_IMAGE + text
     rnn_model.eval()
-    count = 0
-    text_features = {}
-    for step, data in enumerate(dataloader, 0):
-        index, captions, cap_lens, _, _ = prepare_data(data)
-        batch_size = captions.size()[0]
-        hidden = rnn_model.init_hidden(batch_size)
-        _, sent_emb = rnn_model(captions, cap_lens, hidden)
-        index.data.cpu().numpy()
-        sent_emb.data.cpu().numpy()
-        for i in range(batch_size):
-            idx = index[i].item()
-            if idx not in text_features.keys():
-                text_features[idx] = [sent_emb[i].data.cpu().numpy()]
-            else:
-                text_features[idx].append(sent_emb[i].data.cpu().numpy())
-            count += 1
-    print('processed %d data'%count) # 29322
-    return text_features
-
-
-def img2info(dataloader, cnn_model, rnn_model, batch_size):
+    done = store.create('sent', len(dataset), cfg.TEXT.EMBEDDING_DIM)
+    if done > 0:
+        print('Resume the text features from row %d' % done)
+    with torch.no_grad():
+        for step, data in enumerate(pending_batches(dataset, done, batch_size), 0):
+            rows, captions, cap_lens, _, _ = prepare_data(data)
+            hidden = rnn_model.init_hidden(captions.size(0))
+            _, sent_emb = rnn_model(captions, cap_lens, hidden)
+            store.write('sent', rows.numpy(), F.normalize(sent_emb, dim=1).cpu().numpy())
+            done += captions.size(0)
+            if (step + 1) % UPDATE_INTERVAL == 0:
+                store.commit('sent', done)
+                print('processed %d / %d captions' % (done, len(dataset)))
+    store.commit('sent', done)
+    return done
+
+
+def extract_image_features(dataset, cnn_model, store, batch_size):
+    # global image features (cnn_code) of every image
     cnn_model.eval()
-    rnn_model.eval()
-    count = 0
-    text_features = {}
-    for step, data in enumerate(dataloader, 0):
-        index, captions, cap_lens, imgs, cls_id = prepare_data(data)
-        hidden = rnn_model.init_hidden(batch_size)
-        _, sent_emb = rnn_model(captions, cap_lens, hidden)
-        _, img_emb = cnn_model(imgs)
-        index.data.cpu().numpy()
-        cls_id.data.cpu().numpy()
-        sent_emb.data.cpu().numpy()
-        img_emb.data.cpu().numpy()
-        for i in range(batch_size):
-            idx = index[i].item()
-            if idx not in text_features.keys():
-                # print(idx)
-                text_features[idx] = [sent_emb[i].data.cpu().numpy()]
-            else:
-                # print('same')
-                text_features[idx].append(sent_emb[i].data.cpu().numpy())
-            count += 1
-    print('processed %d data'%count)
-    return text_features
+    done = store.create('img', len(dataset), cfg.TEXT.EMBEDDING_DIM)
+    if done > 0:
+        print('Resume the image features from row %d' % done)
+    with torch.no_grad():
+        for step, (rows, imgs) in enumerate(pending_batches(dataset, done, batch_size), 0):
+            if cfg.CUDA and not cfg.QUANT.FLAG:
+                imgs = imgs.cuda()
+            _, img_emb = cnn_model(imgs)
+            store.write('img', rows.numpy(), F.normalize(img_emb, dim=1).cpu().numpy())
+            done += imgs.size(0)
+            if (step + 1) % UPDATE_INTERVAL == 0:
+                store.commit('img', done)
+                print('processed %d / %d images' % (done, len(dataset)))
+    store.commit('img', done)
+    return done
 
 
 def build_models():
     text_encoder = RNN_ENCODER(dataset.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
     image_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
     if cfg.TRAIN.NET_E != '':
-        state_dict = torch.load(cfg.TRAIN.NET_E)
+        state_dict = torch.load(cfg.TRAIN.NET_E, map_location=lambda storage, loc: storage)
         text_encoder.load_state_dict(state_dict)
         print('Load', cfg.TRAIN.NET_E)
         name = cfg.TRAIN.NET_E.replace('text_encoder', 'image_encoder')
-        state_dict = torch.load(name)
+        state_dict = torch.load(name, map_location=lambda storage, loc: storage)
         image_encoder.load_state_dict(state_dict)
         print('Load', name)
         istart = cfg.TRAIN.NET_E.rfind('_') + 8
@@ -209,7 +229,11 @@ def build_models():
         start_epoch = cfg.TRAIN.NET_E[istart:iend]
         start_epoch = int(start_epoch) + 1
         print('start_epoch', start_epoch)
-    if cfg.CUDA:
+    if cfg.QUANT.FLAG:
+        # the mismatched captions of rp_main come from the same int8 encoder
+        print('Quantize the text encoder to int8')
+        text_encoder = quantize_text_encoder(text_encoder)
+    elif cfg.CUDA:
         assert (torch.cuda.is_available())
         text_encoder.cuda()
         image_encoder.cuda()
@@ -222,7 +246,8 @@ if __name__ == "__main__":
         cfg_from_file(args.cfg_file)
 
     cfg.GPU_ID = parse_str(cfg.GPU_ID)
-    torch.cuda.set_device(cfg.GPU_ID[0])
+    if cfg.CUDA:
+        torch.cuda.set_device(cfg.GPU_ID[0])
     output_dir = '%s/%s_%s' % (cfg.OUTPUT_DIR, cfg.DATASET_NAME, cfg.ENCODER1)
     model_dir = os.path.join(output_dir, 'Model')
     # image_dir = os.path.join(output_dir, 'Image')
@@ -253,13 +278,16 @@ if __name__ == "__main__":
 
     print('dataset.n_words, dataset.embeddings_num:', dataset.n_words, dataset.embeddings_num)
     assert dataset
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, drop_last=False,
-        shuffle=False, num_workers=int(cfg.WORKERS))
     text_encoder, image_encoder = build_models()
-    text_features = evaluate(dataloader, image_encoder, text_encoder, batch_size)
-    print(len(text_features.keys())) # 29330
-    assert len(text_features.keys()) == len(dataset) / 10
-    save_path_textfeature = os.path.join(model_dir, 'testimg2textfeature.pickle')
-    save_pickle(text_features, save_path_textfeature)
-    print('Congrats, save pickle to %s!'%(save_path_textfeature))
\ No newline at end of file
+    # float16 .npy arrays, memory-mapped by rp_main and rp_offline.py; the
+    # features are L2-normalized, all the readers rank by cosine and
+    # unit vectors keep their precision (and range) in float16
+    store = FeatureStore(feature_store_path(model_dir))
+    store.set_keys(dataset.keys(), captions_per_image=cfg.TEXT.CAPTIONS_PER_IMAGE,
+                   normalized=True)
+    count = extract_text_features(dataset, text_encoder, store, batch_size)
+    print('processed %d captions' % count)
+    if args.images:
+        count = extract_image_features(ImageDataset(dataset), image_encoder, store, batch_size)
+        print('processed %d images' % count)
+    print('Congrats, save the features to %s!' % store.path)
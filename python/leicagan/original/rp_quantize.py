@@ -0,0 +1,177 @@
+from cfg.config import cfg, cfg_from_file
+from datasets import TextDataset, prepare_data
+from model import RNN_ENCODER, CNN_ENCODER
+from trainer import get_encoder_path
+from miscc.quantize import quantize_text_encoder, prepare_image_encoder, calibrate
+from miscc.quantize import convert_image_encoder, save_image_encoder, load_image_encoder
+from miscc.quantize import quantized_image_encoder_path, time_forward
+from miscc.r_precision import ranks_from_bank
+
+import os
+import sys
+import pprint
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Quantize the DAMSM encoders to int8 and '
+                                                 'compare them with fp32 on the CPU')
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file',
+                        default='cfg/RP/1.Extract_text_feature/Bird/TI.yml', type=str)
+    parser.add_argument('--n_calib', type=int, default=500,
+                        help='calibration images, from the train split')
+    parser.add_argument('--n_eval', type=int, default=1000,
+                        help='test images the R-precision is compared on')
+    parser.add_argument('--batch_size', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    args = parser.parse_args()
+    return args
+
+
+def image_batches(dataset, indices, batch_size):
+    # the full size images of dataset[indices]
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices), batch_size=batch_size,
+        drop_last=False, shuffle=False, num_workers=int(cfg.WORKERS))
+    for data in loader:
+        yield data[0][-1]
+
+
+def load_eval_batches(dataset, indices, batch_size):
+    # [(imgs, captions, cap_lens, class_ids)], sorted by caption length
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices), batch_size=batch_size,
+        drop_last=False, shuffle=False, num_workers=int(cfg.WORKERS))
+    batches = []
+    for data in loader:
+        imgs, captions, cap_lens, class_ids, _ = prepare_data(data)
+        if captions.dim() == 1:
+            # squeezed batch of one caption
+            captions = captions.unsqueeze(0)
+        batches.append((imgs[-1], captions, cap_lens, class_ids))
+    return batches
+
+
+def encode(text_encoder, image_encoder, batches):
+    sent_embs, img_codes, class_ids = [], [], []
+    with torch.no_grad():
+        for imgs, captions, cap_lens, cls_ids in batches:
+            hidden = text_encoder.init_hidden(captions.size(0))
+            _, sent_emb = text_encoder(captions, cap_lens, hidden)
+            _, img_code = image_encoder(imgs)
+            sent_embs.append(sent_emb)
+            img_codes.append(img_code)
+            class_ids.append(cls_ids)
+    return torch.cat(sent_embs), torch.cat(img_codes), np.concatenate(class_ids)
+
+
+def r_precision(img_codes, sent_embs, mismatched):
+    # top-1 R-precision, mismatched: N x 99 rows of sent_embs
+    ranks = ranks_from_bank(img_codes, sent_embs, sent_embs, mismatched)
+    return float(np.mean(ranks == 0))
+
+
+def mismatched_captions(class_ids, rng, n=99):
+    # n captions of other classes for every row, drawn once so that both
+    # encoders are ranked against the same ones
+    rows = []
+    for cls_id in class_ids:
+        rows.append(rng.choice(np.flatnonzero(class_ids != cls_id), n))
+    return np.array(rows)
+
+
+def load_fp32_encoders(n_words):
+    text_encoder = RNN_ENCODER(n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
+    text_encoder_path = get_encoder_path(cfg.ENCODER1)
+    state_dict = torch.load(text_encoder_path, map_location=lambda storage, loc: storage)
+    text_encoder.load_state_dict(state_dict)
+    print('Load text encoder from:', text_encoder_path)
+
+    image_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
+    image_encoder_path = get_encoder_path(cfg.ENCODER1, 'image')
+    state_dict = torch.load(image_encoder_path, map_location=lambda storage, loc: storage)
+    image_encoder.load_state_dict(state_dict)
+    print('Load image encoder from:', image_encoder_path)
+    return text_encoder.eval(), image_encoder.eval(), image_encoder_path
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    # int8 kernels only exist on the CPU, compare both there
+    cfg.CUDA = False
+    cfg.QUANT.FLAG = False
+
+    print('Using config:')
+    pprint.pprint(cfg)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    np.random.seed(100)
+    torch.manual_seed(100)
+    rng = np.random.RandomState(100)
+
+    imsize = cfg.TREE.BASE_SIZE * (2 ** (cfg.TREE.BRANCH_NUM - 1))
+    image_transform = transforms.Compose([
+        transforms.Resize(int(imsize * 76 / 64)),
+        transforms.CenterCrop(imsize)])
+    data_dir = os.path.join(cfg.DATA_DIR, cfg.DATASET_NAME)
+    # calibrate on train images, R-precision is computed on the test split
+    calib_set = TextDataset(data_dir, 'train', base_size=cfg.TREE.BASE_SIZE,
+                            transform=image_transform)
+    eval_set = TextDataset(data_dir, 'test', base_size=cfg.TREE.BASE_SIZE,
+                           transform=image_transform)
+    calib_ix = rng.choice(len(calib_set), min(args.n_calib, len(calib_set)), replace=False)
+    eval_ix = rng.choice(len(eval_set), min(args.n_eval, len(eval_set)), replace=False)
+
+    text_encoder, image_encoder, image_encoder_path = load_fp32_encoders(eval_set.n_words)
+
+    #######################################################
+    # (1) Calibrate and save the int8 image encoder
+    #######################################################
+    example_imgs = next(image_batches(calib_set, calib_ix[:2], 2))
+    prepared = prepare_image_encoder(image_encoder, example_imgs)
+    n_calib = calibrate(prepared, image_batches(calib_set, calib_ix, args.batch_size))
+    print('Calibrate on %d images' % n_calib)
+    int8_path = quantized_image_encoder_path(image_encoder_path)
+    save_image_encoder(convert_image_encoder(prepared), int8_path, example_imgs)
+    print('Save int8 image encoder to:', int8_path)
+
+    #######################################################
+    # (2) Speed and R-precision, fp32 vs int8
+    #######################################################
+    batches = load_eval_batches(eval_set, eval_ix, args.batch_size)
+    encoders = {'fp32': (text_encoder, image_encoder),
+                'int8': (quantize_text_encoder(text_encoder), load_image_encoder(int8_path))}
+    results = {}
+    mismatched = None
+    for name in ['fp32', 'int8']:
+        te, ie = encoders[name]
+        text_time = time_forward(lambda b: te(b[1], b[2], te.init_hidden(b[1].size(0))), batches)
+        image_time = time_forward(lambda b: ie(b[0]), batches)
+        sent_embs, img_codes, class_ids = encode(te, ie, batches)
+        if mismatched is None:
+            mismatched = mismatched_captions(class_ids, rng)
+        results[name] = (text_time, image_time, r_precision(img_codes, sent_embs, mismatched),
+                         sent_embs, img_codes)
+
+    fp32, int8 = results['fp32'], results['int8']
+    print('%d test images, batch size %d, %d threads' %
+          (len(eval_ix), args.batch_size, torch.get_num_threads()))
+    print('text encoder : %.1fms fp32, %.1fms int8 per batch, %.2fx' %
+          (fp32[0] * 1000, int8[0] * 1000, fp32[0] / int8[0]))
+    print('image encoder: %.1fms fp32, %.1fms int8 per batch, %.2fx' %
+          (fp32[1] * 1000, int8[1] * 1000, fp32[1] / int8[1]))
+    print('cosine(fp32, int8): sent_emb %.4f, cnn_code %.4f' %
+          (float(F.cosine_similarity(fp32[3], int8[3]).mean()),
+           float(F.cosine_similarity(fp32[4], int8[4]).mean())))
+    print('R-precision (real images): %.4f fp32, %.4f int8, change %+.4f' %
+          (fp32[2], int8[2], int8[2] - fp32[2]))
@@ -1,4 +1,3 @@
-import scipy
 from six.moves import range
 import torch
 import torch.optim as optim
@@ -18,7 +17,11 @@ from miscc.losses import words_loss
 import os
 from miscc.utils import load_pickle
 import numpy as np
-from rp_dataset import get_mis_99
+from rp_dataset import load_mismatch_bank
+from miscc.feature_store import FeatureStore, feature_store_path
+from miscc.r_precision import candidate_ranks, split_scores, format_scores
+from miscc.quantize import quantize_text_encoder, load_image_encoder
+from miscc.quantize import quantized_image_encoder_path
 
 class condGANTrainer(object):
     def __init__(self, output_dir, data_loader, n_words, ixtoword):
@@ -29,8 +32,9 @@ class condGANTrainer(object):
             mkdir_p(self.image_dir)
 
         cfg.GPU_ID = parse_str(cfg.GPU_ID)
-        torch.cuda.set_device(cfg.GPU_ID[0])
-        cudnn.benchmark = True
+        if cfg.CUDA:
+            torch.cuda.set_device(cfg.GPU_ID[0])
+            cudnn.benchmark = True
 
         self.batch_size = cfg.TRAIN.BATCH_SIZE
         self.max_epoch = cfg.TRAIN.MAX_EPOCH
@@ -43,10 +47,21 @@ class condGANTrainer(object):
         data_dir = os.path.join(cfg.DATA_DIR, cfg.DATASET_NAME)
         self.cls2imgid = load_pickle(data_dir + '/test_cls2imgid.pickle')
         encoder_dir = '%s/%s_%s/Model' % (cfg.OUTPUT_DIR, cfg.DATASET_NAME, cfg.ENCODER1)
-        self.img2textfeature = load_pickle(os.path.join(encoder_dir, 'testimg2textfeature.pickle'))
+        # the sentence features of rp_pre_extraction, memory-mapped, and the
+        # 99 mismatched captions of every test image as rows of them
+        self.caption_bank = FeatureStore(feature_store_path(encoder_dir)).load('sent')
+        self.mismatch_ids = load_mismatch_bank(data_dir, data_loader.dataset.class_ids(),
+                                               self.cls2imgid, cfg.TEXT.CAPTIONS_PER_IMAGE,
+                                               cfg.RP.MISMATCH_SEED)
 
 
     def load_encoder(self, encoder, requires_grad_=False, attribute=''):
+        if cfg.QUANT.FLAG and attribute == 'image':
+            # calibrated by rp_quantize.py
+            encoder_path = quantized_image_encoder_path(os.path.join(
+                cfg.OUTPUT_DIR, cfg.DATASET_NAME+'_'+ encoder, 'Model/image_encoder200.pth'))
+            print('Load an int8 image encoder from:', encoder_path)
+            return load_image_encoder(encoder_path)
         if attribute == 'image':
             current_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
             encoder_path = os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME+'_'+ encoder, 'Model/image_encoder200.pth')
@@ -63,6 +78,9 @@ class condGANTrainer(object):
             else:
                 p.requires_grad = False
         current_encoder.eval()
+        if cfg.QUANT.FLAG:
+            print('Quantize the text encoder to int8')
+            return quantize_text_encoder(current_encoder)
         if cfg.CUDA:
             current_encoder.cuda()
         return current_encoder
@@ -241,8 +259,12 @@ class condGANTrainer(object):
             netG = EarlyGLAM_G_NET()
         else:
             print('no generator assigned.')
-        netG.cuda()
-        netG = nn.DataParallel(netG, device_ids=cfg.GPU_ID)
+        if cfg.CUDA:
+            netG.cuda()
+            netG = nn.DataParallel(netG, device_ids=cfg.GPU_ID)
+        else:
+            # keeps the module. prefix of the saved state dict
+            netG = nn.DataParallel(netG)
         netG.apply(weights_init)
         netG.eval()
         # load text encoder:
@@ -258,81 +280,54 @@ class condGANTrainer(object):
         batch_size = self.batch_size
         nz = cfg.GAN.Z_DIM
         noise = Variable(torch.FloatTensor(batch_size, nz), volatile=True)
-        noise = noise.cuda()
+        if cfg.CUDA:
+            noise = noise.cuda()
 
-        rp_results = [0, 0, 0, 0, 0]
-        rp_count = 0
+        ranks = []
         model_dir = cfg.TRAIN.NET_G
         print('Load model:', model_dir)
-        netG.load_state_dict(torch.load(model_dir), strict=False)
+        netG.load_state_dict(torch.load(model_dir, map_location=lambda storage, loc: storage),
+                             strict=False)
         s_tmp = model_dir[:model_dir.rfind('.pth')]
         save_dir = '%s/%s' % (s_tmp, split_dir)
         mkdir_p(save_dir)
         cnt = 0
-        for _ in range(1):
-            for step, data in enumerate(self.data_loader, 0):
-                cnt += batch_size
-                if step % 100 == 0:
-                    print('step: ', step)
-                captions, cap_lens, keys, cls_id = prepare_data(data)
-                hidden = text_encoder.init_hidden(batch_size)
-                words_embs1, sent_emb1 = text_encoder(captions, cap_lens, hidden)
-                words_embs1, sent_emb1 = words_embs1.detach(), sent_emb1.detach()
-                if seg_encoder is not None:
-                    seg_hidden = seg_encoder.init_hidden(batch_size)
-                    words_embs2, sent_emb2 = text_encoder(captions, cap_lens, seg_hidden)
-                    words_embs2, sent_emb2 = words_embs2.detach(), sent_emb2.detach()
-                else:
-                    words_embs2, sent_emb2 = None, None
-
-                mask = (captions == 0)
-                num_words = words_embs1.size(2)
-                if mask.size(1) > num_words:
-                    mask = mask[:, :num_words]
-                # Generate fake images
-                noise.data.normal_(0, 1)
-                fake_imgs, _, _, _, _, _ = netG(noise, sent_emb1, words_embs1, sent_emb2, words_embs2, mask)
-                _, img_feature = image_encoder(fake_imgs[0])
-                for j in range(batch_size):
-                    rp_count += 1
-                    random_texts = get_mis_99(cls_id[j].item(), self.cls2imgid, self.img2textfeature)
-                    rp_result = self.calculate_rp(img_feature[j].detach().cpu(), sent_emb1[j].detach().cpu(),
-                                                  random_texts)
-                    rp_results = np.sum([rp_results, rp_result], axis=0)
-            # model_path = os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME + '_' + cfg.GAN.GNET, cfg.CONFIG_NAME, 'Model')
-            rp1 = round(rp_results[0] / rp_count, 4)
-            rp2 = round((rp_results[0] + rp_results[1]) / rp_count, 4)
-            rp3 = round((rp_results[0] + rp_results[1] + rp_results[2])/ rp_count, 4)
-            rp4 = round((rp_results[0] + rp_results[1] + rp_results[2] + rp_results[3]) / rp_count, 4)
-            rp5 = round((rp_results[0] + rp_results[1] + rp_results[2] + rp_results[3] + rp_results[4])/ rp_count, 4)
-
-            content = 'Recall top1-top5: %s,%s,%s,%s,%s' % (rp1,rp2,rp3,rp4,rp5)
-            # self.write2txt(i, content, model_path)
-            print(content)
-
-    def calculate_rp(self, img_feature, sent_emb, random_texts):
-        score = []
-        # print(img_feature)
-        score_match = scipy.spatial.distance.cosine(img_feature, sent_emb)
-        score.append(score_match)
-        # print('len(random_texts):', len(random_texts))
-        for random_text in random_texts:
-            score_mismatch = scipy.spatial.distance.cosine(img_feature, random_text)
-            score.append(score_mismatch)
-        # print(len(score))
-        result = np.argsort(score)
-        top1 = top2 = top3 = top4 = top5 = 0
-        if result[0] == 0:
-            top1 = 1
-        if result[1] == 0:
-            top2 = 1
-        if result[2] == 0:
-            top3 = 1
-        if result[3] == 0:
-            top4 = 1
-        if result[4] == 0:
-            top5 = 1
-        return top1, top2, top3, top4, top5
+        # volatile is a no-op, only no_grad stops netG keeping its graph
+        with torch.no_grad():
+            for _ in range(1):
+                for step, data in enumerate(self.data_loader, 0):
+                    cnt += batch_size
+                    if step % 100 == 0:
+                        print('step: ', step)
+                    captions, cap_lens, keys, cls_id, index = prepare_data(data)
+                    hidden = text_encoder.init_hidden(batch_size)
+                    words_embs1, sent_emb1 = text_encoder(captions, cap_lens, hidden)
+                    words_embs1, sent_emb1 = words_embs1.detach(), sent_emb1.detach()
+                    if seg_encoder is not None:
+                        seg_hidden = seg_encoder.init_hidden(batch_size)
+                        words_embs2, sent_emb2 = text_encoder(captions, cap_lens, seg_hidden)
+                        words_embs2, sent_emb2 = words_embs2.detach(), sent_emb2.detach()
+                    else:
+                        words_embs2, sent_emb2 = None, None
+
+                    mask = (captions == 0)
+                    num_words = words_embs1.size(2)
+                    if mask.size(1) > num_words:
+                        mask = mask[:, :num_words]
+                    # Generate fake images
+                    noise.data.normal_(0, 1)
+                    fake_imgs, _, _, _, _, _ = netG(noise, sent_emb1, words_embs1, sent_emb2, words_embs2, mask)
+                    _, img_feature = image_encoder(fake_imgs[0])
+                    # the whole batch against its 99 mismatched captions each
+                    random_texts = self.caption_bank[self.mismatch_ids[index.numpy()]]
+                    ranks.append(candidate_ranks(img_feature.detach(), sent_emb1.detach(),
+                                                 random_texts).cpu())
+                # model_path = os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME + '_' + cfg.GAN.GNET, cfg.CONFIG_NAME, 'Model')
+                mean, std = split_scores(torch.cat(ranks).numpy(), 5, cfg.RP.N_SPLITS)
+                content = 'Recall top1-top5 over %d splits: %s' % (cfg.RP.N_SPLITS,
+                                                                   format_scores(mean, std))
+                # self.write2txt(i, content, model_path)
+                print(content)
 
 
 
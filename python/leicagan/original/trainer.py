@@ -10,6 +10,7 @@ from cfg.config import cfg
 from miscc.utils import mkdir_p, parse_str
 from miscc.utils import build_super_images, build_super_images2, build_super_images3
 from miscc.utils import weights_init, load_params, copy_G_params
+from miscc.metrics import MetricsSink
 from model import EarlyGLAM_G_NET
 from model import D_NET64, D_NET128, D_NET256
 from datasets import prepare_data
@@ -20,6 +21,12 @@ import time
 import numpy as np
 
 
+def get_encoder_path(encoder, attribute=''):
+    if attribute == 'image':
+        return os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME+'_'+ encoder, 'Model/image_encoder200.pth')
+    return os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME+'_'+ encoder, 'Model/text_encoder200.pth')
+
+
 class condGANTrainer(object):
     def __init__(self, output_dir, data_loader, n_words, ixtoword):
         if cfg.TRAIN.FLAG:
@@ -43,10 +50,9 @@ class condGANTrainer(object):
     def load_encoder(self, encoder, requires_grad_=False, attribute=''):
         if attribute == 'image':
             current_encoder = CNN_ENCODER(cfg.TEXT.EMBEDDING_DIM)
-            encoder_path = os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME+'_'+ encoder, 'Model/image_encoder200.pth')
         else:
             current_encoder = RNN_ENCODER(self.n_words, nhidden=cfg.TEXT.EMBEDDING_DIM)
-            encoder_path = os.path.join(cfg.OUTPUT_DIR, cfg.DATASET_NAME+'_'+ encoder, 'Model/text_encoder200.pth')
+        encoder_path = get_encoder_path(encoder, attribute)
         state_dict = torch.load(encoder_path, map_location=lambda storage, loc: storage)
         current_encoder.load_state_dict(state_dict)
 
@@ -219,6 +225,11 @@ class condGANTrainer(object):
         if cfg.CUDA:
             noise, fixed_noise = noise.cuda(), fixed_noise.cuda()
 
+        # per-phase timings, a no-op unless cfg.TRAIN.METRICS is set
+        metrics = MetricsSink(cfg.TRAIN.METRICS, run=cfg.CONFIG_NAME,
+                              interval=cfg.TRAIN.METRICS_INTERVAL,
+                              sync=cfg.CUDA).activate()
+
         gen_iterations = 0
         # gen_iterations = start_epoch * self.num_batches
         for epoch in range(start_epoch, self.max_epoch):
@@ -227,21 +238,31 @@ class condGANTrainer(object):
             step = 0
             while step < self.num_batches:
                 ######################################################
-                data = next(data_iter)
-                imgs, captions, cap_lens, class_ids, keys = prepare_data(data)
+                with metrics.phase('data'):
+                    data = prepare_data(next(data_iter))
+                imgs, captions, cap_lens, class_ids, keys = data[:5]
 
-                # encoder text using pretrained text-image matching model, MODEL1
-                hidden = text_encoder.init_hidden(batch_size)
-                # words_embs: batch_size x nef x seq_len
-                # sent_emb: batch_size x nef
-                words_embs1, sent_emb1 = text_encoder(captions, cap_lens, hidden)
-                words_embs1, sent_emb1 = words_embs1.detach(), sent_emb1.detach()
-
-                # ENCODER2
-                if seg_encoder is not None:
-                    seg_hidden = seg_encoder.init_hidden(batch_size)
-                    words_embs2, sent_emb2 = text_encoder(captions, cap_lens, seg_hidden)
-                    words_embs2, sent_emb2 = words_embs2.detach(), sent_emb2.detach()
+                if len(data) > 5:
+                    # precomputed by the frozen text encoders
+                    words_embs1, sent_emb1 = data[5], data[6]
+                else:
+                    with metrics.phase('text_encode'):
+                        # encoder text using pretrained text-image matching model, MODEL1
+                        hidden = text_encoder.init_hidden(batch_size)
+                        # words_embs: batch_size x nef x seq_len
+                        # sent_emb: batch_size x nef
+                        words_embs1, sent_emb1 = text_encoder(captions, cap_lens, hidden)
+                        words_embs1, sent_emb1 = words_embs1.detach(), sent_emb1.detach()
+
+                # ENCODER2, the embeddings of the first text encoder (with
+                # the zero hidden state of seg_encoder)
+                if seg_encoder is not None and len(data) > 5:
+                    words_embs2, sent_emb2 = words_embs1, sent_emb1
+                elif seg_encoder is not None:
+                    with metrics.phase('text_encode'):
+                        seg_hidden = seg_encoder.init_hidden(batch_size)
+                        words_embs2, sent_emb2 = text_encoder(captions, cap_lens, seg_hidden)
+                        words_embs2, sent_emb2 = words_embs2.detach(), sent_emb2.detach()
                 else:
                     words_embs2, sent_emb2 = None, None
 
@@ -251,50 +272,56 @@ class condGANTrainer(object):
                     mask = mask[:, :num_words]
 
                 # (2) Generate fake images
-                noise.data.normal_(0, 1)
-                # fake_imgs, att_maps_w1, att_maps_w2, att_maps_s, mu, logvar
-                if cfg.GAN.GNET == 'EarlyGLAM':
-                    fake_imgs, _, _, _, mu, logvar = netG(noise, sent_emb1, words_embs1, sent_emb2, words_embs2, mask)
-                else:
-                    fake_imgs, _, _, _ = netG(noise, sent_emb1, words_embs1, sent_emb2, words_embs2, mask)
+                with metrics.phase('g_forward'):
+                    noise.data.normal_(0, 1)
+                    # fake_imgs, att_maps_w1, att_maps_w2, att_maps_s, mu, logvar
+                    if cfg.GAN.GNET == 'EarlyGLAM':
+                        fake_imgs, _, _, _, mu, logvar = netG(noise, sent_emb1, words_embs1, sent_emb2, words_embs2, mask)
+                    else:
+                        fake_imgs, _, _, _ = netG(noise, sent_emb1, words_embs1, sent_emb2, words_embs2, mask)
                 # (3) Update D network
                 errD_total = 0
                 D_logs = ''
-                for i in range(len(netsD)):
-                    netsD[i].zero_grad()
-                    errD = discriminator_loss(netsD[i], imgs[i], fake_imgs[i], sent_emb1, real_labels, fake_labels)
-                    # backward and update parameters
-                    errD.backward()
-                    optimizersD[i].step()
-                    errD_total += errD
-                    D_logs += 'errD%d: %.2f ' % (i, errD.item())
+                with metrics.phase('d_step'):
+                    for i in range(len(netsD)):
+                        netsD[i].zero_grad()
+                        errD = discriminator_loss(netsD[i], imgs[i], fake_imgs[i], sent_emb1, real_labels, fake_labels)
+                        # backward and update parameters
+                        errD.backward()
+                        optimizersD[i].step()
+                        errD_total += errD
+                        D_logs += 'errD%d: %.2f ' % (i, errD.item())
 
                 step += 1
                 gen_iterations += 1
 
-                netG.zero_grad()
-                errG_total, G_logs = \
-                    generator_loss(netsD, image_encoder, fake_imgs, real_labels,
-                                   words_embs1, sent_emb1, match_labels, cap_lens, class_ids)
-                kl_loss = KL_loss(mu, logvar)
-                errG_total += kl_loss
-                G_logs += 'kl_loss: %.2f ' % kl_loss.item()
-                # backward and update parameters
-                errG_total.backward()
-                optimizerG.step()
-                for p, avg_p in zip(netG.parameters(), avg_param_G):
-                    avg_p.mul_(0.999).add_(0.001, p.data)
-
-                if gen_iterations % 100 == 0:
-                    print((D_logs + '\n' + G_logs))
-                # save images
-                if gen_iterations % 1000 == 0:
-                    backup_para = copy_G_params(netG)
-                    load_params(netG, avg_param_G)
-                    self.save_img_results(netG, fixed_noise, sent_emb1, words_embs1, sent_emb2, \
-                                          words_embs2, mask, image_encoder, \
-                                          captions, cap_lens, epoch, name='average')
-                    load_params(netG, backup_para)
+                with metrics.phase('g_step'):
+                    netG.zero_grad()
+                    # the DAMSM part is timed as 'damsm' inside generator_loss
+                    errG_total, G_logs = \
+                        generator_loss(netsD, image_encoder, fake_imgs, real_labels,
+                                       words_embs1, sent_emb1, match_labels, cap_lens, class_ids)
+                    kl_loss = KL_loss(mu, logvar)
+                    errG_total += kl_loss
+                    G_logs += 'kl_loss: %.2f ' % kl_loss.item()
+                    # backward and update parameters
+                    errG_total.backward()
+                    optimizerG.step()
+                    for p, avg_p in zip(netG.parameters(), avg_param_G):
+                        avg_p.mul_(0.999).add_(0.001, p.data)
+
+                with metrics.phase('logging'):
+                    if gen_iterations % 100 == 0:
+                        print((D_logs + '\n' + G_logs))
+                    # save images
+                    if gen_iterations % 1000 == 0:
+                        backup_para = copy_G_params(netG)
+                        load_params(netG, avg_param_G)
+                        self.save_img_results(netG, fixed_noise, sent_emb1, words_embs1, sent_emb2, \
+                                              words_embs2, mask, image_encoder, \
+                                              captions, cap_lens, epoch, name='average')
+                        load_params(netG, backup_para)
+                metrics.step(batch_size)
             end_t = time.time()
 
             print(('''[%d/%d][%d]
@@ -307,6 +334,7 @@ class condGANTrainer(object):
                 self.save_model(netG, avg_param_G, netsD, epoch)
 
         self.save_model(netG, avg_param_G, netsD, self.max_epoch)
+        metrics.close()
 
     def save_singleimages(self, images, filenames, save_dir,
                           split_dir, sentenceID=0):
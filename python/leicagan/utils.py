@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import numpy as np
 import os as os
+from PIL import Image
 import random
 import torch
 
@@ -29,13 +30,34 @@ def make_dir(path):
     if not os.path.exists(path):
         os.mkdir(path)
         
+# Read an image straight into size (width, height). JPEGs are decoded by
+# libjpeg at the largest 1/2, 1/4 or 1/8 scale that stays at or above size,
+# so only the remaining factor is left to cv2.resize.
+def imread_resized(img_str, size, interpolation=cv2.INTER_LINEAR):
+    width, height = Image.open(img_str).size
+    factor = min(width / float(size[0]), height / float(size[1]))
+    flags = cv2.IMREAD_COLOR
+    for reduced, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                          (4, cv2.IMREAD_REDUCED_COLOR_4),
+                          (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if factor >= reduced:
+            flags = flag
+            break
+    img = cv2.imread(img_str, flags)
+    if img.shape[1] != size[0] or img.shape[0] != size[1]:
+        img = cv2.resize(img, size, interpolation=interpolation)
+    return img
+
+# Same as cv2.resize(cv2.imread(img_str), (0,0), fx=scale, fy=scale).
+def imread_scaled(img_str, scale):
+    width, height = Image.open(img_str).size
+    return imread_resized(img_str, (int(round(width * scale)), int(round(height * scale))))
+
 def evaluate_images(img_str_real, img_str_fake, img_str_out):
     # Read in images from input file paths.
-    img_real = cv2.imread(img_str_real)
-    img_real = cv2.resize(img_real, (0,0), fx=0.5, fy=0.5) 
+    img_real = imread_scaled(img_str_real, 0.5) 
     height_1, width_1 = img_real.shape[:2]
-    img_fake = cv2.imread(img_str_fake)
-    img_fake = cv2.resize(img_fake, (0,0), fx=0.5, fy=0.5)
+    img_fake = imread_scaled(img_str_fake, 0.5)
     height_2, width_2 = img_fake.shape[:2]
 
     # Find minimum height and width.
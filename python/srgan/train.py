@@ -22,6 +22,7 @@ from tensorboard_logger import configure, log_value
 from keras.datasets import cifar10
 
 from models import Generator, Discriminator, FeatureExtractor
+from metrics import MetricsSink
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -42,6 +43,8 @@ if __name__ == '__main__':
     parser.add_argument('--generatorWeights', type=str, default='', help="path to generator weights (to continue training)")
     parser.add_argument('--discriminatorWeights', type=str, default='', help="path to discriminator weights (to continue training)")
     parser.add_argument('--inType', default='frame', help='input type, one of the following: [frame, cifar]')
+    parser.add_argument('--metrics', type=str, default='', help='.jsonl, .db or .sqlite file for per-phase timings of the SRGAN loop')
+    parser.add_argument('--metricsInterval', type=int, default=100, help='iterations between two metrics records')
 
     opt = parser.parse_args()
     print(opt)
@@ -197,6 +200,7 @@ if __name__ == '__main__':
     optim_discriminator = optim.Adam(discriminator.parameters(), lr=opt.discriminatorLR*0.1)
 
     print('SRGAN training')
+    metrics = MetricsSink(opt.metrics, run=tag, interval=opt.metricsInterval, sync=opt.cuda)
     for epoch in range(opt.nEpochs):
         mean_generator_content_loss = 0.0
         mean_generator_adversarial_loss = 0.0
@@ -204,64 +208,70 @@ if __name__ == '__main__':
         mean_discriminator_loss = 0.0
 
         for i in range(n_samples):
-            low_res = x_train[i * opt.batchSize:(i + 1) * opt.batchSize]
-            high_res_real = y_train[i * opt.batchSize:(i + 1) * opt.batchSize]
+            with metrics.phase('data'):
+                low_res = x_train[i * opt.batchSize:(i + 1) * opt.batchSize]
+                high_res_real = y_train[i * opt.batchSize:(i + 1) * opt.batchSize]
 
             # Generate real and fake inputs
-            if opt.cuda:
-                high_res_real = Variable(high_res_real.cuda())
-                high_res_fake = generator(Variable(low_res).cuda())
-                target_real = Variable(torch.rand(opt.batchSize,1)*0.5 + 0.7).cuda()
-                target_fake = Variable(torch.rand(opt.batchSize,1)*0.3).cuda()
-            else:
-                high_res_real = Variable(high_res_real)
-                high_res_fake = generator(Variable(low_res))
-                target_real = Variable(torch.rand(opt.batchSize,1)*0.5 + 0.7)
-                target_fake = Variable(torch.rand(opt.batchSize,1)*0.3)
+            with metrics.phase('g_forward'):
+                if opt.cuda:
+                    high_res_real = Variable(high_res_real.cuda())
+                    high_res_fake = generator(Variable(low_res).cuda())
+                    target_real = Variable(torch.rand(opt.batchSize,1)*0.5 + 0.7).cuda()
+                    target_fake = Variable(torch.rand(opt.batchSize,1)*0.3).cuda()
+                else:
+                    high_res_real = Variable(high_res_real)
+                    high_res_fake = generator(Variable(low_res))
+                    target_real = Variable(torch.rand(opt.batchSize,1)*0.5 + 0.7)
+                    target_fake = Variable(torch.rand(opt.batchSize,1)*0.3)
 
             high_res_real = high_res_real.float()
             high_res_fake = high_res_fake.float()
 
             ######### Train discriminator #########
-            discriminator.zero_grad()
+            with metrics.phase('d_step'):
+                discriminator.zero_grad()
 
-            discriminator_loss = adversarial_criterion(discriminator(high_res_real), target_real) + \
-                                 adversarial_criterion(discriminator(Variable(high_res_fake.data)), target_fake)
-            mean_discriminator_loss += discriminator_loss.data
-            
-            discriminator_loss.backward()
-            optim_discriminator.step()
+                discriminator_loss = adversarial_criterion(discriminator(high_res_real), target_real) + \
+                                     adversarial_criterion(discriminator(Variable(high_res_fake.data)), target_fake)
+                mean_discriminator_loss += discriminator_loss.data
+
+                discriminator_loss.backward()
+                optim_discriminator.step()
 
             ######### Train generator #########
-            generator.zero_grad()
+            with metrics.phase('g_step'):
+                generator.zero_grad()
 
-            real_features = Variable(feature_extractor(high_res_real).data)
-            fake_features = feature_extractor(high_res_fake)
+                real_features = Variable(feature_extractor(high_res_real).data)
+                fake_features = feature_extractor(high_res_fake)
+
+                generator_content_loss = content_criterion(high_res_fake, high_res_real) + 0.006*content_criterion(fake_features, real_features)
+                mean_generator_content_loss += generator_content_loss.data
+                generator_adversarial_loss = adversarial_criterion(discriminator(high_res_fake), ones_const)
+                mean_generator_adversarial_loss += generator_adversarial_loss.data
+
+                generator_total_loss = generator_content_loss + 1e-3*generator_adversarial_loss
+                mean_generator_total_loss += generator_total_loss.data
+
+                generator_total_loss.backward()
+                optim_generator.step()
 
-            generator_content_loss = content_criterion(high_res_fake, high_res_real) + 0.006*content_criterion(fake_features, real_features)
-            mean_generator_content_loss += generator_content_loss.data
-            generator_adversarial_loss = adversarial_criterion(discriminator(high_res_fake), ones_const)
-            mean_generator_adversarial_loss += generator_adversarial_loss.data
-
-            generator_total_loss = generator_content_loss + 1e-3*generator_adversarial_loss
-            mean_generator_total_loss += generator_total_loss.data
-            
-            generator_total_loss.backward()
-            optim_generator.step()   
-            
             ######### Status and display #########
-            sys.stdout.write('\r[%d/%d][%d/%d] Discriminator_Loss: %.4f Generator_Loss (Content/Advers/Total): %.4f/%.4f/%.4f' % (epoch + 1, opt.nEpochs, i, n_samples,
-            discriminator_loss.data, generator_content_loss.data, generator_adversarial_loss.data, generator_total_loss.data))
-            if i == n_samples - 1:
-                vutils.save_image(low_res,
-                        '%s/alt_%03d.png' % (outf_path, epoch),
-                        normalize=True)
-                vutils.save_image(high_res_real,
-                        '%s/real_%03d.png' % (outf_path, epoch),
-                        normalize=True)
-                vutils.save_image(high_res_fake,
-                        '%s/fake_%03d.png' % (outf_path, epoch),
-                        normalize=True)
+            with metrics.phase('logging'):
+                sys.stdout.write('\r[%d/%d][%d/%d] Discriminator_Loss: %.4f Generator_Loss (Content/Advers/Total): %.4f/%.4f/%.4f' % (epoch + 1, opt.nEpochs, i, n_samples,
+                discriminator_loss.data, generator_content_loss.data, generator_adversarial_loss.data, generator_total_loss.data))
+                if i == n_samples - 1:
+                    vutils.save_image(low_res,
+                            '%s/alt_%03d.png' % (outf_path, epoch),
+                            normalize=True)
+                    vutils.save_image(high_res_real,
+                            '%s/real_%03d.png' % (outf_path, epoch),
+                            normalize=True)
+                    vutils.save_image(high_res_fake,
+                            '%s/fake_%03d.png' % (outf_path, epoch),
+                            normalize=True)
+            metrics.step(opt.batchSize)
 
         sys.stdout.write('\r[%d/%d][%d/%d] Discriminator_Loss: %.4f Generator_Loss (Content/Advers/Total): %.4f/%.4f/%.4f\n' % (epoch + 1, opt.nEpochs, i, n_samples,
         mean_discriminator_loss / n_samples, mean_generator_content_loss / n_samples, 
@@ -275,3 +285,5 @@ if __name__ == '__main__':
         # Do checkpointing
         torch.save(generator.state_dict(), '%s/generator_final.pth' % outc_path)
         torch.save(discriminator.state_dict(), '%s/discriminator_final.pth' % outc_path)
+
+    metrics.close()
@@ -5,7 +5,7 @@ import numpy as np
 import os as os
 import pandas as pd
 import re as re
-from utils import plot_together
+from utils import plot_together, imread_resized
 
 def graph_loss(values, title, eval_folder, axes, colors, labels, legend):
     graph_str_out = eval_folder + title + '.png'
@@ -203,7 +203,7 @@ def image_from_blocks():
         img_out = np.full((y_div, x_div * 2, 3), 0, dtype=int)
         img_in = np.array(avg, dtype='uint8')
         img_out[0 : y_div, 0 : x_div] = img_in
-        img_original = cv2.resize(cv2.imread(f_original), (x_div, y_div))
+        img_original = imread_resized(f_original, (x_div, y_div))
         img_out[0 : y_div * dim, x_div : (x_div * 2)] = img_original
         img_out = cv2.resize(np.array(img_out, dtype='uint8'), (x_res * 2, y_res))
         cv2.imwrite(f_out, img_out)
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import torch
+
+
+# Training loop metrics ############################################
+# The one copy of the module: the AttnGAN, LeicaGAN, SRGAN and DCGAN
+# trainers load it through their own metrics.py, so that their records
+# can be compared.
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on macOS, kilobytes elsewhere
+        rss /= 1024.
+    return rss / 1024.
+
+
+_ACTIVE = None
+
+
+@contextmanager
+def phase(name):
+    # times name on the active MetricsSink, if there is one
+    if _ACTIVE is None:
+        yield
+    else:
+        with _ACTIVE.phase(name):
+            yield
+
+
+class MetricsSink(object):
+    """
+        Every interval steps, records the wall time of each phase, the
+        images/sec and the peak RSS (and peak CUDA memory) of the run.
+        A path ending in .db or .sqlite gets rows in its steps and phases
+        tables, any other path one JSON line per record, and an empty
+        path disables the sink.
+        Phases are exclusive: the time of a nested phase only counts for
+        the inner one, and what no phase covers is reported as 'other'.
+        With sync the CUDA queue is drained at the phase boundaries,
+        otherwise GPU time is charged to the phase that waits for it.
+    """
+    def __init__(self, path, run='', interval=100, sync=False):
+        self.path = path
+        self.run = run
+        self.interval = interval
+        self.sync = sync and torch.cuda.is_available()
+        self.enabled = bool(path)
+        self.db = None
+        self.f = None
+        if self.enabled:
+            out_dir = os.path.dirname(path)
+            if out_dir and not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            if path.endswith(('.db', '.sqlite')):
+                self.db = sqlite3.connect(path)
+                self.db.execute('CREATE TABLE IF NOT EXISTS steps '
+                                '(run TEXT, iteration INTEGER, time REAL, '
+                                'steps INTEGER, wall REAL, images_per_sec REAL, '
+                                'peak_rss_mb REAL, peak_cuda_mb REAL)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS phases '
+                                '(run TEXT, iteration INTEGER, phase TEXT, '
+                                'seconds REAL)')
+                self.db.commit()
+            else:
+                self.f = open(path, 'a')
+        self.iteration = 0
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.stack = []
+        self.steps = 0
+        self.images = 0
+        self.start_t = time.time()
+
+    def activate(self):
+        # makes the module level phase() time on this sink
+        global _ACTIVE
+        _ACTIVE = self
+        return self
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        start_t = time.time()
+        self.stack.append(0.)
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            elapsed = time.time() - start_t
+            inner = self.stack.pop()
+            self.phases[name] = self.phases.get(name, 0.) + elapsed - inner
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def step(self, n_images):
+        self.iteration += 1
+        self.steps += 1
+        self.images += n_images
+        if self.enabled and self.iteration % self.interval == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.enabled or self.steps == 0:
+            return
+        wall = time.time() - self.start_t
+        phases = dict(self.phases)
+        phases['other'] = max(wall - sum(phases.values()), 0.)
+        record = {'run': self.run,
+                  'iteration': self.iteration,
+                  'time': time.time(),
+                  'steps': self.steps,
+                  'wall': wall,
+                  'images_per_sec': self.images / wall,
+                  'peak_rss_mb': peak_rss_mb(),
+                  'peak_cuda_mb': None,
+                  'phases': phases}
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2. ** 20
+        if self.db is not None:
+            self.db.execute('INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.run, self.iteration, record['time'],
+                             self.steps, wall, record['images_per_sec'],
+                             record['peak_rss_mb'], record['peak_cuda_mb']))
+            self.db.executemany('INSERT INTO phases VALUES (?, ?, ?, ?)',
+                                [(self.run, self.iteration, name, seconds)
+                                 for name, seconds in sorted(phases.items())])
+            self.db.commit()
+        else:
+            self.f.write(json.dumps(record, sort_keys=True) + '\n')
+            self.f.flush()
+        self.reset()
+
+    def close(self):
+        global _ACTIVE
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+        if self.f is not None:
+            self.f.close()
+        if _ACTIVE is self:
+            _ACTIVE = None